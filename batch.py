@@ -0,0 +1,241 @@
+"""Generate meal plans and their cooking instructions in bulk from a JSONL file of plan requests.
+
+Each input line is one plan request; only name and meals are required, the rest defaults to
+the guest settings of the app. meals is the text of the meals box or a list of its lines.
+
+    {"id": "veggie-1", "name": "Veggie week", "meals": ["Lunch: lentil curry", "Dinner: tofu stir fry"],
+     "days": 5, "existing_ingredients": "rice", "preferences": {"calories": 1800},
+     "kitchen": {"stove_burner": 2, "oven_rack": 1}, "user": "catalogue@example.com"}
+
+Results are appended to a JSONL file, or saved to the database as plans of the request's user
+(or --user), created if needed:
+
+    python -m batch plan_requests.jsonl --output plans.jsonl --concurrency 8
+    python -m batch plan_requests.jsonl --save --user catalogue@example.com
+
+Finished requests are recorded in a checkpoint file (the output or input file name plus
+.checkpoint); run the same command again to resume after an interruption.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+import jobs
+import llm_cache
+import llm_client
+# Imported for its after_flush listener, which indexes saved plans for search
+import plan_search
+from llm import chat_completion
+from models import CookingInstruction, MealPlan, Session, User, init_db
+from prompts import cooking_instructions_messages, meal_plan_messages
+from scheduler import recipes_from_plan, total_time
+from structured_recipes import KITCHEN_EQUIPMENT, recipe_steps, save_recipes
+
+logger = logging.getLogger('batch')
+
+# The guest defaults of the app
+DEFAULT_PREFERENCES = {
+    'style': "Simple and minimal", 'calories': 2000, 'macro_protein': 35, 'macro_fat': 25, 'macro_carbs': 40,
+    'additional_preference': "", 'temp_unit': "Celsius", 'liquid_unit': "ml", 'mass_unit': "grams",
+}
+DEFAULT_DAYS = 7
+REPORT_INTERVAL_SECONDS = 30
+
+
+def read_requests(path):
+    """(request id, request) pairs of a JSONL file; requests without an id are keyed by line number."""
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, start=1):
+            if line.strip():
+                request = json.loads(line)
+                yield str(request.get('id') or f"line-{number}"), request
+
+
+def read_checkpoint(path):
+    """Ids of the requests a previous run finished, from its checkpoint file."""
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding='utf-8') as f:
+        return {json.loads(line)['id'] for line in f if line.strip()}
+
+
+def generate(request, parallel=True, use_cache=True):
+    """Generate the plan and cooking instructions of one request, like the app does for a guest."""
+    meals = request['meals']
+    if isinstance(meals, list):
+        meals = '\n'.join(f"- {meal}" for meal in meals)
+    preferences = {**DEFAULT_PREFERENCES, **request.get('preferences', {})}
+    kitchen = {**dict.fromkeys(KITCHEN_EQUIPMENT, 0), **request.get('kitchen', {})}
+    days = request.get('days', DEFAULT_DAYS)
+    existing_ingredients = request.get('existing_ingredients', '')
+    started = time.perf_counter()
+
+    # The same generation as the background meal plan job of the app
+    plan = jobs.meal_plan({
+        'plan_name': request['name'], 'meals': meals, 'preferences': preferences, 'days': days,
+        'existing_ingredients': existing_ingredients, 'kitchen': kitchen, 'parallel': parallel,
+        'messages': meal_plan_messages(request['name'], meals, preferences, days, existing_ingredients, kitchen),
+        'use_cache': use_cache,
+    }, None)
+    instructions, timing = chat_completion(
+        cooking_instructions_messages(request['name'], days, plan['plan'], kitchen), 0,
+        call_name='cooking_instructions', use_cache=use_cache)
+    steps = recipe_steps(plan['recipes']) if plan['recipes'] else recipes_from_plan(plan['plan'])
+    return {
+        'name': request['name'], 'days': days, 'existing_ingredients': existing_ingredients,
+        'style': preferences['style'], 'plan': plan['plan'], 'recipes': plan['recipes'], 'cooking_instructions': instructions,
+        'total_time': total_time(steps, kitchen, instructions),
+        'timings': [plan['timing'], timing], 'seconds': time.perf_counter() - started,
+    }
+
+
+def save(result, email):
+    """Store a generated plan with its recipes and cooking instructions as a plan of the user with email."""
+    with Session() as session:
+        user = session.query(User).filter_by(email=email).first()
+        if not user:
+            user = User(email=email, name=email.split('@')[0])
+            session.add(user)
+        meal_plan = MealPlan(user=user, name=result['name'], days=result['days'], cooking_plan=result['plan'],
+                             existing_ingredients=result['existing_ingredients'], style=result.get('style'))
+        session.add(meal_plan)
+        if result['recipes']:
+            save_recipes(session, meal_plan, result['recipes'])
+        session.add(CookingInstruction(meal_plan=meal_plan, total_time=result['total_time'],
+                                       instructions=result['cooking_instructions']))
+        session.commit()
+        return meal_plan.id
+
+
+class Report:
+    """Throughput, latency and token counts of a run, logged periodically and returned at the end."""
+
+    def __init__(self, skipped):
+        self.started = time.perf_counter()
+        self.last_logged = self.started
+        self.skipped = skipped
+        self.done = self.failed = 0
+        self.seconds = []
+        self.tokens = {'prompt_tokens': 0, 'completion_tokens': 0}
+
+    def add(self, result=None):
+        if result is None:
+            self.failed += 1
+            return
+        self.done += 1
+        self.seconds.append(result['seconds'])
+        for timing in result['timings']:
+            for name in self.tokens:
+                self.tokens[name] += timing.get(name) or 0
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        p50, p95 = np.percentile(self.seconds, [50, 95]) if self.seconds else (0.0, 0.0)
+        return {
+            'done': self.done, 'failed': self.failed, 'skipped': self.skipped, 'seconds': round(elapsed, 1),
+            'plans_per_minute': round(self.done / elapsed * 60, 2) if elapsed else 0.0,
+            'plan_seconds_p50': round(float(p50), 2), 'plan_seconds_p95': round(float(p95), 2),
+            **self.tokens,
+            'ai_requests': llm_client.stats['calls'], 'ai_retries': llm_client.stats['retries'],
+            'cache_hits': llm_cache.stats['hits'],
+        }
+
+    def log_periodically(self):
+        if time.perf_counter() - self.last_logged >= REPORT_INTERVAL_SECONDS:
+            self.last_logged = time.perf_counter()
+            logger.info("Progress: %s", json.dumps(self.summary()))
+
+
+def run(args):
+    checkpoint_path = f"{args.output or args.input}.checkpoint"
+    finished = read_checkpoint(checkpoint_path)
+    pending = ((request_id, request) for request_id, request in read_requests(args.input)
+               if request_id not in finished)
+    report = Report(skipped=len(finished))
+    if finished:
+        logger.info("Resuming: %d requests were finished by an earlier run", len(finished))
+
+    output = open(args.output, 'a', encoding='utf-8') if args.output else None
+    checkpoint = open(checkpoint_path, 'a', encoding='utf-8')
+    executor = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix='batch')
+    in_flight = {}
+    try:
+        # At most two requests per worker are read ahead, so the input can be any size
+        while True:
+            while len(in_flight) < args.concurrency * 2:
+                request_id, request = next(pending, (None, None))
+                if request_id is None:
+                    break
+                future = executor.submit(generate, request, not args.single_request, not args.bypass_cache)
+                in_flight[future] = (request_id, request)
+            if not in_flight:
+                break
+            completed, _ = wait(in_flight, timeout=REPORT_INTERVAL_SECONDS, return_when=FIRST_COMPLETED)
+            for future in completed:
+                request_id, request = in_flight.pop(future)
+                entry = {'id': request_id}
+                try:
+                    result = future.result()
+                    if args.save:
+                        entry['meal_plan_id'] = save(result, request.get('user') or args.user)
+                    if output:
+                        output.write(json.dumps({'id': request_id, **result}) + '\n')
+                        output.flush()
+                    report.add(result)
+                except Exception as e:
+                    logger.exception("Request %s failed", request_id)
+                    report.add()
+                    if not args.skip_failed:
+                        continue
+                    entry['error'] = str(e)
+                # Recorded after the result is stored, so an interrupted run repeats at most the
+                # requests that were in flight
+                checkpoint.write(json.dumps(entry) + '\n')
+                checkpoint.flush()
+            report.log_periodically()
+    except KeyboardInterrupt:
+        logger.warning("Interrupted; run the same command again to resume")
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        checkpoint.close()
+        if output:
+            output.close()
+    executor.shutdown()
+    return report.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('input', help="JSONL file of plan requests")
+    parser.add_argument('--output', help="JSONL file to append the generated plans to")
+    parser.add_argument('--save', action='store_true', help="save the plans to the database")
+    parser.add_argument('--user', default='batch@localhost',
+                        help="email of the user that owns saved plans of requests without a user")
+    parser.add_argument('--concurrency', type=int, default=4, help="plans generated at the same time")
+    parser.add_argument('--single-request', action='store_true',
+                        help="generate each plan in one request instead of one request per meal")
+    parser.add_argument('--bypass-cache', action='store_true', help="do not use the AI response cache")
+    parser.add_argument('--skip-failed', action='store_true',
+                        help="record failed requests as finished instead of retrying them on resume")
+    args = parser.parse_args()
+    if not args.output and not args.save:
+        parser.error("give --output, --save or both")
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    init_db()
+    plan_search.init_search()
+    summary = run(args)
+    logger.info("Finished: %s", json.dumps(summary))
+    json.dump(summary, sys.stdout)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+"""Reproducible benchmarks of the app, run offline against a fake OpenAI-compatible server."""
@@ -0,0 +1,207 @@
+"""A fake OpenAI-compatible chat completions server with configurable latency and token rate.
+
+It answers every request with a plausible meal plan, recipe, adjustment or cooking plan in the
+formats the app parses, streamed or not, with token usage. Start it on its own and point the
+app at it:
+
+    python -m benchmarks.fake_openai --port 8765 --latency 0.5 --tokens-per-second 80
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=fake streamlit run cooking_planner.py
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHARS_PER_TOKEN = 4
+# Streamed chunks are sent at most this often, each with the tokens generated since the last one
+STREAM_INTERVAL_SECONDS = 0.02
+
+DISHES = [
+    ('Breakfast', 'Spinach Omelette', 'pan-fried', 420,
+     [('eggs', 14, ''), ('spinach', 350, 'g'), ('milk', 200, 'ml'), ('olive oil', 2, 'tbsp')],
+     [('Whisk the eggs with the milk', 5, [], True), ('Wilt the spinach', 4, ['large_pan', 'stove_burner'], True),
+      ('Cook the omelettes', 15, ['large_pan', 'stove_burner'], True)]),
+    ('Lunch', 'Chicken Rice Bowl', 'boiled and roasted', 650,
+     [('chicken breast', 1.2, 'kg'), ('rice', 500, 'g'), ('broccoli', 600, 'g'), ('soy sauce', 4, 'tbsp')],
+     [('Cook the rice', 25, ['rice_cooker'], False), ('Roast the chicken', 30, ['oven_rack'], False),
+      ('Steam the broccoli', 8, ['medium_pot', 'stove_burner'], True)]),
+    ('Dinner', 'Salmon with Roasted Vegetables', 'roasted', 700,
+     [('salmon fillet', 1, 'kg'), ('sweet potato', 800, 'g'), ('zucchini', 400, 'g'), ('lemon', 2, '')],
+     [('Chop the vegetables', 10, [], True), ('Roast the vegetables', 35, ['oven_rack'], False),
+      ('Bake the salmon', 15, ['oven_rack'], False)]),
+]
+
+
+def _recipe(index, label=None):
+    meal, name, method, calories, ingredients, steps = DISHES[index % len(DISHES)]
+    return {'label': label or meal, 'name': name, 'cooking_method': method, 'calories_per_day': calories,
+            'ingredients': ingredients, 'steps': steps}
+
+
+def _recipe_markdown(recipe):
+    return '\n'.join([
+        f"### {recipe['label']}: {recipe['name']}",
+        f"**Cooking method**: {recipe['cooking_method']}",
+        f"**Calories**: {recipe['calories_per_day']} per day",
+        "**Ingredients**",
+        *(f"- {name}: {quantity:g} {unit}".rstrip() for name, quantity, unit in recipe['ingredients']),
+        "**Equipment**",
+        *sorted({f"- {e.replace('_', ' ')}" for _, _, equipment, _ in recipe['steps'] for e in equipment}),
+        "**Instructions**",
+        *(f"{n}. {description} ({minutes} min)" for n, (description, minutes, _, _) in enumerate(recipe['steps'], 1)),
+    ])
+
+
+def _meals(prompt):
+    # The meal lines of a meal plan prompt, e.g. "- Breakfast: eggs"
+    match = re.search(r'The dishes I want to cook are (.+?)(?:\n- The existing|\n- Besides)', prompt, re.S)
+    lines = [line.strip(' -*') for line in (match.group(1) if match else '').splitlines()]
+    return [line.split(':')[0].strip() for line in lines if line] or [meal for meal, *_ in DISHES]
+
+
+def answer(body):
+    """The text of a fake answer to a chat completions request body."""
+    prompt = body['messages'][-1]['content']
+    response_format = body.get('response_format') or {}
+    if response_format.get('type') == 'json_schema':
+        name = response_format['json_schema']['name']
+        if name == 'recipe':
+            meal = re.search(r'The meal to write the recipe for is (.+)', prompt)
+            label = meal.group(1).split(':')[0].strip() if meal else None
+            recipe = _recipe(random.randrange(len(DISHES)), label)
+            return json.dumps({
+                'name': recipe['name'], 'cooking_method': recipe['cooking_method'],
+                'calories_per_day': recipe['calories_per_day'],
+                'ingredients': [{'name': n, 'quantity': q, 'unit': u} for n, q, u in recipe['ingredients']],
+                'steps': [{'description': d, 'duration_minutes': m, 'equipment': e, 'hands_on': h}
+                          for d, m, e, h in recipe['steps']],
+            })
+        if name == 'plan_adjustment_route':
+            return json.dumps({'rewrite': [1], 'remove': [], 'add': []})
+        return '{}'
+    if 'Cooking plan for' in prompt:
+        plan_name = re.search(r'Cooking plan for (.+)', prompt).group(1).strip()
+        steps = [f"- Minute {minute}: {step}" for minute, step in enumerate(
+            ['Preheat the oven', 'Start the rice', 'Chop the vegetables', 'Roast the vegetables and chicken',
+             'Cook the omelettes', 'Bake the salmon', 'Portion and pack the meals'], start=0)]
+        return '\n'.join([f"Cooking plan for {plan_name}", "**Total time**: 95 minutes", "**Steps**", *steps])
+    if 'Return only this recipe' in prompt or 'write a new recipe' in prompt:
+        heading = re.search(r'###\s*(.+)', prompt)
+        label = heading.group(1).split(':')[0].strip() if heading else 'Snack'
+        return _recipe_markdown(_recipe(random.randrange(len(DISHES)), label))
+    plan_name = re.search(r'Recipes for (.+)', prompt)
+    recipes = [_recipe(i, meal) for i, meal in enumerate(_meals(prompt))]
+    return '\n'.join([f"Recipes for {plan_name.group(1).strip() if plan_name else 'my plan'}", "**Recipes**",
+                      '\n\n'.join(_recipe_markdown(recipe) for recipe in recipes)])
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.2
+    tokens_per_second = 100.0
+    error_rate = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=()):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests += 1
+        if random.random() < self.error_rate:
+            self._send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}},
+                            headers=[('Retry-After', '1')])
+            return
+        text = answer(body)
+        usage = {'prompt_tokens': len(json.dumps(body['messages'])) // CHARS_PER_TOKEN,
+                 'completion_tokens': len(text) // CHARS_PER_TOKEN}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        time.sleep(self.latency)
+        if body.get('stream'):
+            self._stream(body, text, usage)
+            return
+        if self.tokens_per_second:
+            time.sleep(usage['completion_tokens'] / self.tokens_per_second)
+        self._send_json(200, {
+            'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': body['model'],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+            'usage': usage,
+        })
+
+    def _chunk(self, body, delta=None, finish_reason=None, usage=None):
+        chunk = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                 'model': body['model'],
+                 'choices': [] if usage else [{'index': 0, 'delta': delta or {}, 'finish_reason': finish_reason}]}
+        if usage:
+            chunk['usage'] = usage
+        data = f"data: {json.dumps(chunk)}\n\n".encode('utf-8')
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream(self, body, text, usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        chars_per_chunk = max(1, int((self.tokens_per_second or 1e6) * STREAM_INTERVAL_SECONDS * CHARS_PER_TOKEN))
+        for start in range(0, len(text), chars_per_chunk):
+            self._chunk(body, {'content': text[start:start + chars_per_chunk]})
+            if self.tokens_per_second:
+                time.sleep(STREAM_INTERVAL_SECONDS)
+        self._chunk(body, finish_reason='stop')
+        if (body.get('stream_options') or {}).get('include_usage'):
+            self._chunk(body, usage=usage)
+        done = b"data: [DONE]\n\n"
+        self.wfile.write(f"{len(done):x}\r\n".encode('ascii') + done + b"\r\n0\r\n\r\n")
+        self.wfile.flush()
+
+
+def start(port=0, latency=0.2, tokens_per_second=100.0, error_rate=0.0):
+    """Serve the fake API on 127.0.0.1:port (0 picks a free port) from a daemon thread.
+
+    latency is the delay before the first token, tokens_per_second the generation rate (0 for
+    instant answers) and error_rate the share of requests answered with a 429 and Retry-After.
+    Returns the server; its base URL for OPENAI_BASE_URL is base_url(server).
+    """
+    handler = type('Handler', (FakeOpenAIHandler,), {'latency': latency, 'tokens_per_second': tokens_per_second,
+                                                     'error_rate': error_rate})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, name='fake-openai', daemon=True).start()
+    return server
+
+
+def base_url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument('--tokens-per-second', type=float, default=100.0, help="generation rate, 0 for instant")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with a 429")
+    args = parser.parse_args()
+    server = start(args.port, args.latency, args.tokens_per_second, args.error_rate)
+    print(f"Fake OpenAI API on {base_url(server)}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,421 @@
+"""Load-test a running app with concurrent simulated users and find where latency collapses.
+
+Each simulated user is a websocket session speaking Streamlit's protocol, like a browser tab:
+it signs in (or continues as a guest), edits the kitchen and preferences, generates, adjusts
+and saves a plan and browses the saved plans, with some think time between actions.
+Concurrency ramps up in stages; each stage reports throughput, latency percentiles, error
+rates and the memory of the app process, and the stage where latency collapses is flagged.
+
+By default a fake OpenAI server and the app are started on free ports with a temporary
+database, so nothing leaves the machine:
+
+    python -m benchmarks.load_test --users 1,2,4,8,16,32 --stage-seconds 60 --output load.json
+
+To load an app started yourself, run it with FPREP_LOAD_TEST_LOGIN=1 (for signed-in users)
+and OPENAI_BASE_URL pointing at python -m benchmarks.fake_openai, and pass its URL and pid:
+
+    python -m benchmarks.load_test --url http://127.0.0.1:8501 --pid 12345
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+from urllib.parse import urlencode
+
+import numpy as np
+from streamlit.proto.Alert_pb2 import Alert
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.NumberInput_pb2 import NumberInput
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+from tornado.websocket import websocket_connect
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, 'cooking_planner.py')
+MEALS = "- Breakfast: omelette\n- Lunch: chicken rice bowl\n- Dinner: salmon and vegetables"
+ADJUSTMENTS = ("Make the lunch vegetarian", "Use less oil in the breakfast", "Add more protein to the dinner")
+SEARCH_TERMS = ("salmon", "chicken", "week", "omelette")
+# Latency has collapsed when the p95 of a stage is this many times the p95 of the first stage,
+# or when more than MAX_ERROR_RATE of its actions failed
+COLLAPSE_FACTOR = 3.0
+MAX_ERROR_RATE = 0.05
+# Actions that call the AI; their latency includes the fake server's
+AI_ACTIONS = {'generate', 'adjust', 'save_plan'}
+
+
+class ActionError(Exception):
+    """An action of a simulated user failed: the app showed an error, or a widget it needed was missing."""
+
+
+class AppSession:
+    """One simulated browser tab: a websocket session that reruns the script with widget states."""
+
+    def __init__(self, url, query=None, timeout=120.0):
+        self.ws_url = url.replace('http', 'ws', 1).rstrip('/') + '/_stcore/stream'
+        self.query_string = urlencode(query or {})
+        self.timeout = timeout
+        self.page_script_hash = ''
+        # delta path -> (element type, element proto, fragment id) of everything on the page
+        self.elements = {}
+        # Widget values set so far, sent with every rerun like the browser does
+        self.values = {}
+        # Cacheable messages by hash, since the server sends repeats of them as references
+        self._cache = {}
+        self._ws = None
+
+    async def open(self):
+        self._ws = await websocket_connect(self.ws_url, subprotocols=['streamlit'])
+        await self.rerun()
+
+    def close(self):
+        if self._ws is not None:
+            self._ws.close()
+            self._ws = None
+
+    def widget(self, kind, label):
+        """(id, fragment id) of the first widget of a type whose label starts with label, or None."""
+        for element_type, element, fragment_id in self.elements.values():
+            if element_type == kind and getattr(element, kind).label.startswith(label):
+                return getattr(element, kind).id, fragment_id
+        return None
+
+    def has_widget(self, kind, label):
+        return self.widget(kind, label) is not None
+
+    def set(self, kind, label, value):
+        """Set a text, number or toggle widget; the value is sent with the next rerun."""
+        found = self.widget(kind, label)
+        if found is None:
+            raise ActionError(f"No {kind} {label!r} on the page")
+        state = WidgetState(id=found[0])
+        if kind in ('text_input', 'text_area'):
+            state.string_value = value
+        elif kind == 'checkbox':
+            state.bool_value = value
+        elif self._number_type(found[0]) == NumberInput.INT:
+            state.int_value = int(value)
+        else:
+            state.double_value = float(value)
+        self.values[found[0]] = state
+
+    def _number_type(self, widget_id):
+        for element_type, element, _ in self.elements.values():
+            if element_type == 'number_input' and element.number_input.id == widget_id:
+                return element.number_input.data_type
+        return NumberInput.FLOAT
+
+    async def click(self, label):
+        found = self.widget('button', label)
+        if found is None:
+            raise ActionError(f"No button {label!r} on the page")
+        widget_id, fragment_id = found
+        await self.rerun([WidgetState(id=widget_id, trigger_value=True)], fragment_id)
+
+    async def rerun(self, triggers=(), fragment_id=''):
+        """Send a rerun and wait until the script (or fragment) has finished, including st.rerun() runs.
+
+        Raises ActionError for exceptions and error alerts the run showed.
+        """
+        message = BackMsg()
+        message.rerun_script.query_string = self.query_string
+        message.rerun_script.page_script_hash = self.page_script_hash
+        message.rerun_script.fragment_id = fragment_id
+        message.rerun_script.widget_states.widgets.extend(
+            [*(state for widget_id, state in self.values.items()
+               if widget_id not in {trigger.id for trigger in triggers}), *triggers])
+        await self._ws.write_message(message.SerializeToString(), binary=True)
+        errors = await asyncio.wait_for(self._read_until_finished(), self.timeout)
+        if errors:
+            raise ActionError(errors[0][:200])
+
+    async def _read_until_finished(self):
+        errors, run_paths, full_run = [], set(), True
+        while True:
+            data = await self._ws.read_message()
+            if data is None:
+                raise ConnectionError("The app closed the websocket")
+            msg = ForwardMsg()
+            msg.ParseFromString(data)
+            if msg.WhichOneof('type') == 'ref_hash':
+                msg = self._cache[msg.ref_hash]
+            elif msg.metadata.cacheable:
+                self._cache[msg.hash] = msg
+            kind = msg.WhichOneof('type')
+            if kind == 'new_session':
+                self.page_script_hash = msg.new_session.page_script_hash
+                full_run = not msg.new_session.fragment_ids_this_run
+                run_paths = set()
+            elif kind == 'delta' and msg.delta.WhichOneof('type') == 'new_element':
+                path = tuple(msg.metadata.delta_path)
+                element = msg.delta.new_element
+                element_type = element.WhichOneof('type')
+                run_paths.add(path)
+                self.elements[path] = (element_type, element, msg.delta.fragment_id)
+                if element_type == 'exception':
+                    errors.append(f"{element.exception.type}: {element.exception.message}")
+                elif element_type == 'alert' and element.alert.format == Alert.ERROR:
+                    errors.append(element.alert.body)
+            elif kind == 'script_finished':
+                status = msg.script_finished
+                if status == ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    continue
+                if full_run:
+                    # Like the browser, drop what the finished run did not draw again
+                    self.elements = {path: value for path, value in self.elements.items() if path in run_paths}
+                if status == ForwardMsg.FINISHED_WITH_COMPILE_ERROR:
+                    errors.append("The script failed to compile")
+                return errors
+
+
+async def _think(seconds):
+    if seconds:
+        await asyncio.sleep(random.uniform(0.5, 1.5) * seconds)
+
+
+async def journey(app, number, signed_in, think_seconds, record):
+    """One visit of a simulated user, recording (action, seconds, error or None) for every action."""
+    query = {'load_test_user': f"load-user-{number}@example.com"} if signed_in else None
+    session = AppSession(app, query)
+
+    async def act(name, step):
+        started = time.perf_counter()
+        try:
+            await step()
+        except (ActionError, ConnectionError, asyncio.TimeoutError, OSError) as e:
+            record(name, time.perf_counter() - started, f"{type(e).__name__}: {e}")
+            raise
+        record(name, time.perf_counter() - started, None)
+        await _think(think_seconds)
+
+    async def kitchen():
+        session.set('number_input', 'Stove burners', random.randint(1, 4))
+        session.set('number_input', 'Oven racks', random.randint(1, 2))
+        session.set('number_input', 'Large pans', random.randint(1, 2))
+        await session.click("Save Kitchen Setup")
+
+    async def preferences():
+        session.set('number_input', 'Daily calorie goal', random.choice((1800, 2000, 2200, 2500)))
+        await session.click("Save Preferences")
+
+    async def generate():
+        session.set('text_input', 'Meal Plan Name', f"Week {random.randint(1, 52)}")
+        session.set('text_area', 'List your existing ingredients', "eggs, rice 500 g")
+        session.set('text_area', 'What do you want for your meal?', MEALS)
+        await session.click("Generate Meal Plan")
+
+    async def adjust():
+        await session.click("Adjust meal plan")
+        session.set('text_area', 'What would you like to adjust', random.choice(ADJUSTMENTS))
+        await session.click("Submit Adjustment")
+
+    async def browse():
+        session.set('text_input', 'Search meal plans', random.choice(SEARCH_TERMS))
+        await session.rerun()
+        if session.has_widget('button', "Older plans"):
+            await session.click("Older plans")
+
+    try:
+        await act('open', session.open)
+        if not signed_in:
+            await act('guest', lambda: session.click("Continue as Guest"))
+        await act('kitchen', kitchen)
+        await act('preferences', preferences)
+        await act('generate', generate)
+        await act('adjust', adjust)
+        await act('save_plan', lambda: session.click("Save Meal Plan"))
+        await act('browse', browse)
+        return True
+    except (ActionError, ConnectionError, asyncio.TimeoutError, OSError):
+        return False
+    finally:
+        session.close()
+
+
+def _summary(values):
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'count': len(values), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99),
+            'max': float(max(values))}
+
+
+def rss_bytes(pid):
+    """{pid: resident memory in bytes} of a process and its children, read from /proc."""
+    usage, pending = {}, [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                rss = next(line for line in f if line.startswith('VmRSS:'))
+            usage[current] = int(rss.split()[1]) * 1024
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pending.extend(int(child) for child in f.read().split())
+        except (OSError, StopIteration):
+            continue
+    return usage
+
+
+async def run_stage(app, users, seconds, think_seconds, signed_in_share, pid):
+    """Keep users simulated users busy for seconds and summarize what they saw."""
+    records = []
+    journeys = {'completed': 0, 'failed': 0}
+    deadline = time.perf_counter() + seconds
+
+    def record(name, duration, error):
+        records.append((name, duration, error))
+
+    async def user(number):
+        while time.perf_counter() < deadline:
+            signed_in = random.random() < signed_in_share
+            completed = await journey(app, number, signed_in, think_seconds, record)
+            journeys['completed' if completed else 'failed'] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(number) for number in range(users)))
+    elapsed = time.perf_counter() - started
+    durations = [duration for _, duration, error in records if error is None]
+    errors = [error for _, _, error in records if error is not None]
+    memory = rss_bytes(pid) if pid else {}
+    return {
+        'users': users,
+        'seconds': elapsed,
+        'actions': len(records),
+        'throughput_per_second': len(durations) / elapsed,
+        'journeys': journeys,
+        'errors': len(errors),
+        'error_rate': len(errors) / len(records) if records else 0.0,
+        'error_examples': sorted(set(errors))[:5],
+        'latency': _summary(durations),
+        'latency_without_ai': _summary([d for name, d, error in records
+                                        if error is None and name not in AI_ACTIONS]),
+        'by_action': {name: _summary([d for n, d, error in records if n == name and error is None])
+                      for name in sorted({name for name, _, _ in records})},
+        'memory_bytes': {str(p): rss for p, rss in memory.items()},
+        'memory_total_bytes': sum(memory.values()),
+    }
+
+
+def find_collapse(stages):
+    """The first stage whose p95 latency is COLLAPSE_FACTOR times the first stage's, or whose error
+    rate is above MAX_ERROR_RATE, as {'users', 'reason'}; None if latency held up."""
+    baseline = stages[0]['latency']['p95'] if stages and stages[0]['latency'] else None
+    for stage in stages:
+        if stage['error_rate'] > MAX_ERROR_RATE:
+            return {'users': stage['users'], 'reason': f"{stage['error_rate']:.0%} of actions failed"}
+        if baseline and stage['latency'] and stage['latency']['p95'] > COLLAPSE_FACTOR * baseline:
+            return {'users': stage['users'],
+                    'reason': f"p95 latency {stage['latency']['p95']:.2f} s is "
+                              f"{stage['latency']['p95'] / baseline:.1f} times the {baseline:.2f} s of "
+                              f"{stages[0]['users']} user(s)"}
+    return None
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_until_up(url, seconds=60):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=2) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError(f"{url} did not come up in {seconds} s")
+
+
+def start_servers(args, directory):
+    """Start the fake OpenAI server and the app on free ports; returns (app URL, app process, processes)."""
+    fake_port, app_port = _free_port(), _free_port()
+    fake = subprocess.Popen([sys.executable, '-m', 'benchmarks.fake_openai', '--port', str(fake_port),
+                             '--latency', str(args.latency), '--tokens-per-second', str(args.tokens_per_second)],
+                            cwd=ROOT, stdout=subprocess.DEVNULL)
+    env = {**os.environ, 'OPENAI_BASE_URL': f"http://127.0.0.1:{fake_port}/v1", 'OPENAI_API_KEY': 'fake',
+           'FPREP_DATABASE_URL': f"sqlite:///{os.path.join(directory, 'load_test.db')}",
+           'FPREP_LOAD_TEST_LOGIN': '1'}
+    app = subprocess.Popen([sys.executable, '-m', 'streamlit', 'run', APP, '--server.port', str(app_port),
+                            '--server.address', '127.0.0.1', '--server.headless', 'true',
+                            '--server.fileWatcherType', 'none', '--browser.gatherUsageStats', 'false'],
+                           cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{app_port}"
+    _wait_until_up(f"{url}/_stcore/health")
+    return url, app, [fake, app]
+
+
+async def ramp(args, url, pid):
+    stages = []
+    for users in map(int, args.users.split(',')):
+        print(f"{users} user(s) for {args.stage_seconds:.0f} s...", file=sys.stderr, flush=True)
+        stage = await run_stage(url, users, args.stage_seconds, args.think_seconds, args.signed_in_share, pid)
+        stages.append(stage)
+        latency = stage['latency'] or {'p50': float('nan'), 'p95': float('nan')}
+        print(f"  {stage['throughput_per_second']:.2f} actions/s, p50 {latency['p50']:.2f} s, "
+              f"p95 {latency['p95']:.2f} s, {stage['error_rate']:.1%} errors, "
+              f"{stage['memory_total_bytes'] / 2 ** 20:.0f} MiB", file=sys.stderr, flush=True)
+        if args.stop_at_collapse and find_collapse(stages):
+            break
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help="URL of a running app; by default one is started with a fake OpenAI server")
+    parser.add_argument('--pid', type=int, help="process id of the app at --url, to report its memory")
+    parser.add_argument('--users', default='1,2,4,8,16,32', help="comma-separated concurrency of each stage")
+    parser.add_argument('--stage-seconds', type=float, default=60.0, help="duration of each stage")
+    parser.add_argument('--think-seconds', type=float, default=1.0, help="mean pause between actions of a user")
+    parser.add_argument('--signed-in-share', type=float, default=0.5,
+                        help="share of journeys made by signed-in users instead of guests")
+    parser.add_argument('--latency', type=float, default=0.5, help="fake API seconds before the first token")
+    parser.add_argument('--tokens-per-second', type=float, default=100.0, help="fake API generation rate")
+    parser.add_argument('--stop-at-collapse', action='store_true', help="skip the stages after latency collapsed")
+    parser.add_argument('--output', help="JSON file to write, standard output if not given")
+    args = parser.parse_args()
+
+    processes = []
+    try:
+        if args.url:
+            url, pid = args.url, args.pid
+        else:
+            url, app, processes = start_servers(args, tempfile.mkdtemp(prefix='fprep-load-'))
+            pid = app.pid
+        started_at = datetime.utcnow()
+        stages = asyncio.run(ramp(args, url, pid))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    collapse = find_collapse(stages)
+    print(f"Latency collapsed at {collapse['users']} users: {collapse['reason']}" if collapse
+          else "Latency held up at every stage", file=sys.stderr)
+    report = {
+        'meta': {'started_at': started_at.isoformat(timespec='seconds') + 'Z', 'url': url,
+                 'think_seconds': args.think_seconds, 'signed_in_share': args.signed_in_share,
+                 'fake_api': None if args.url else {'latency': args.latency,
+                                                    'tokens_per_second': args.tokens_per_second}},
+        'stages': stages,
+        'collapse': collapse,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
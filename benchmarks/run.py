@@ -0,0 +1,381 @@
+"""Benchmark the app offline against the fake OpenAI server and write the results as JSON.
+
+Measures cold start, rerun latency per view, end-to-end plan generation, database operations
+with 10 to 100k stored plans, the effect of compressing the plan texts on database size and
+plan listing, and memory per session. Nothing leaves the machine: the app talks
+to benchmarks.fake_openai and a temporary SQLite database.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --plan-counts 10,1000 --repeat 3 --latency 0.5 --tokens-per-second 80
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from benchmarks import fake_openai
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, 'cooking_planner.py')
+TIMEOUT = 120
+MEALS = "- Breakfast: omelette\n- Lunch: chicken rice bowl\n- Dinner: salmon and vegetables"
+SEARCH_TERMS = ('salmon', 'chick', 'week 7')
+PAGE_SIZE = 10
+# Rows are inserted in batches of this many when seeding a database
+SEED_BATCH = 5000
+
+
+def _log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def _summary(values):
+    """count, mean, p50, p95 and max of a list of durations in seconds."""
+    p50, p95 = np.percentile(values, [50, 95])
+    return {'count': len(values), 'mean': float(np.mean(values)), 'p50': float(p50), 'p95': float(p95),
+            'max': float(max(values))}
+
+
+def _timed(function, repeat):
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - started)
+    return _summary(durations)
+
+
+def _click(at, label):
+    button = next(b for b in at.button if b.label.startswith(label))
+    started = time.perf_counter()
+    button.click().run()
+    if at.exception:
+        raise RuntimeError(f"{label!r} raised: {at.exception[0].value}")
+    return time.perf_counter() - started
+
+
+def _fill(elements, label, value):
+    next(e for e in elements if e.label.startswith(label)).input(value)
+
+
+def _guest_session(**state):
+    """A guest AppTest session that saved its preferences, with state set before the first run."""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP, default_timeout=TIMEOUT)
+    for key, value in state.items():
+        at.session_state[key] = value
+    at.run()
+    _click(at, "Continue as Guest")
+    _click(at, "Save Preferences")
+    return at
+
+
+def _generate(at, plan_name="Week plan"):
+    """Fill in the plan form, click Generate and return how long the run took."""
+    _fill(at.text_input, "Meal Plan Name", plan_name)
+    _fill(at.text_area, "List your existing ingredients", "eggs, rice 500 g")
+    _fill(at.text_area, "What do you want for your meal?", MEALS)
+    at.run()
+    seconds = _click(at, "Generate Meal Plan")
+    if not at.session_state.cooking_plan:
+        raise RuntimeError("No meal plan was generated")
+    return seconds
+
+
+def bench_startup():
+    """The first script run of the process, which imports the app and creates the database, and a later one."""
+    from streamlit.testing.v1 import AppTest
+
+    results = {}
+    for name in ('cold_seconds', 'warm_seconds'):
+        started = time.perf_counter()
+        AppTest.from_file(APP, default_timeout=TIMEOUT).run()
+        results[name] = time.perf_counter() - started
+    return results
+
+
+def bench_reruns(repeat):
+    """Rerun latency of the full script with every tab, and of each view in those reruns.
+
+    AppTest cannot drive the segmented control of lazy views, so per view the app's own
+    fprep_view_run_seconds observations are reported instead of timing lazy reruns.
+    """
+    import metrics
+
+    results = {'all_tabs': _timed(_guest_session().run, repeat)}
+    for row in metrics.summaries():
+        if row['name'] == 'fprep_view_run_seconds':
+            results[f"view[{row['labels']['view']}]"] = {k: row[k] for k in ('count', 'p50', 'p95', 'p99')}
+    return results
+
+
+def bench_generation(repeat):
+    """End-to-end meal plan generation for each parallel/streaming combination, and saving a plan
+    with its cooking instructions generated in the script run."""
+    results = {}
+    for parallel in (True, False):
+        for streaming in (True, False):
+            durations = []
+            for _ in range(repeat):
+                at = _guest_session(bypass_cache=True, parallel_recipes=parallel, streaming_mode=streaming)
+                durations.append(_generate(at))
+            results[f"parallel={parallel},streaming={streaming}"] = _summary(durations)
+    durations = []
+    for _ in range(repeat):
+        at = _guest_session(bypass_cache=True, background_jobs=False)
+        _generate(at)
+        durations.append(_click(at, "Save Meal Plan"))
+        if not at.session_state.cooking_instructions:
+            raise RuntimeError("No cooking instructions were generated")
+    results['save_and_cooking_instructions'] = _summary(durations)
+    return results
+
+
+def _seed(engine, count, compressed=True):
+    """Insert one user with count plans of three recipes each and their cooking instructions, spaced
+    an hour apart. With compressed=False the large texts are stored as plain text, as before they
+    were compressed."""
+    from sqlalchemy import Text, bindparam, insert
+
+    from models import CookingInstruction, MealPlan, Recipe, RecipeIngredient, User
+
+    plan_text = fake_openai.answer({'messages': [{'role': 'user', 'content': f"Recipes for plan\n{MEALS}"}]})
+    instructions = fake_openai.answer({'messages': [{'role': 'user', 'content': "Cooking plan for Week"}]})
+    # Explicit plain-text parameters bypass the CompressedText type of the columns
+    plans, recipe_rows, instruction_rows = insert(MealPlan), insert(Recipe), insert(CookingInstruction)
+    if not compressed:
+        plans = plans.values(cooking_plan=bindparam('cooking_plan', type_=Text),
+                             existing_ingredients=bindparam('existing_ingredients', type_=Text))
+        recipe_rows = recipe_rows.values(instructions=bindparam('instructions', type_=Text))
+        instruction_rows = instruction_rows.values(instructions=bindparam('instructions', type_=Text))
+    recipes = [(f"{meal}: {name}", ingredients) for meal, name, _, _, ingredients, _ in fake_openai.DISHES]
+    started_at = datetime.utcnow() - timedelta(hours=count)
+    with engine.begin() as connection:
+        user_id = connection.execute(insert(User).values(email='bench@example.com')).inserted_primary_key[0]
+        for first in range(1, count + 1, SEED_BATCH):
+            ids = range(first, min(first + SEED_BATCH, count + 1))
+            connection.execute(plans, [
+                {'id': i, 'user_id': user_id, 'name': f"Week {i}", 'days': 5, 'existing_ingredients': '',
+                 'created_at': started_at + timedelta(hours=i), 'cooking_plan': plan_text} for i in ids])
+            connection.execute(recipe_rows, [
+                {'id': (i - 1) * len(recipes) + n, 'meal_plan_id': i, 'name': name, 'ingredients': '',
+                 'instructions': ''} for i in ids for n, (name, _) in enumerate(recipes, 1)])
+            connection.execute(instruction_rows, [
+                {'id': i, 'meal_plan_id': i, 'total_time': '1 h 35 min', 'instructions': instructions} for i in ids])
+            connection.execute(insert(RecipeIngredient), [
+                {'recipe_id': (i - 1) * len(recipes) + n, 'meal_plan_id': i, 'name': ingredient, 'quantity': quantity,
+                 'unit': unit}
+                for i in ids for n, (_, ingredients) in enumerate(recipes, 1)
+                for ingredient, quantity, unit in ingredients])
+    return user_id
+
+
+def bench_database(count, directory, repeat):
+    """Plan listing, search, grocery totals and saving with count stored plans of one user."""
+    from sqlalchemy import select
+
+    import models
+    import plan_search
+    from plan_history import plans_page
+    from structured_recipes import parse_recipe, render_recipe, save_recipes, stored_grocery_totals
+
+    path = os.path.join(directory, f"plans_{count}.db")
+    engine = models.make_engine(f"sqlite:///{path}")
+    models.init_db(engine)
+    started = time.perf_counter()
+    user_id = _seed(engine, count)
+    results = {'seed_seconds': time.perf_counter() - started}
+    started = time.perf_counter()
+    plan_search.init_search(engine)
+    results['search_backfill_seconds'] = time.perf_counter() - started
+
+    recipe_text = fake_openai.answer({'messages': [{'role': 'user', 'content': ''}], 'response_format': {
+        'type': 'json_schema', 'json_schema': {'name': 'recipe'}}})
+    recipe = parse_recipe(recipe_text, 'Lunch: bowl', 'Lunch')
+
+    def save_plan():
+        with models.Session(bind=engine) as session:
+            meal_plan = models.MealPlan(user_id=user_id, name="Benchmark plan", days=5, existing_ingredients='',
+                                        cooking_plan=render_recipe(recipe))
+            session.add(meal_plan)
+            save_recipes(session, meal_plan, [recipe])
+            session.commit()
+
+    with models.Session(bind=engine) as session:
+        first_page, _ = plans_page(session, user_id, PAGE_SIZE)
+        middle = session.execute(select(models.MealPlan.created_at, models.MealPlan.id)
+                                 .where(models.MealPlan.user_id == user_id)
+                                 .order_by(models.MealPlan.created_at.desc(), models.MealPlan.id.desc())
+                                 .offset(count // 2).limit(1)).one()
+        page_ids = [plan.id for plan in first_page]
+        results['plans_page_first'] = _timed(lambda: plans_page(session, user_id, PAGE_SIZE), repeat)
+        results['plans_page_middle'] = _timed(lambda: plans_page(session, user_id, PAGE_SIZE, after=tuple(middle)),
+                                              repeat)
+        results['plans_page_name_filter'] = _timed(lambda: plans_page(session, user_id, PAGE_SIZE, name='week 7'),
+                                                   repeat)
+        for term in SEARCH_TERMS:
+            results[f"search_page[{term}]"] = _timed(lambda: plan_search.search_page(session, user_id, term,
+                                                                                     PAGE_SIZE), repeat)
+        results['grocery_totals_page'] = _timed(lambda: stored_grocery_totals(session, page_ids), repeat)
+    results['save_plan_with_recipes'] = _timed(save_plan, repeat)
+    engine.dispose()
+    results['file_bytes'] = sum(os.path.getsize(p) for p in (path, f"{path}-wal") if os.path.exists(p))
+    return results
+
+
+def bench_text_compression(count, directory, repeat):
+    """Database file size and plan listing time with count plans stored as plain text and loaded
+    with every column, as before, and after compress_text converted them and the texts are deferred."""
+    from sqlalchemy import select
+    from sqlalchemy.orm import joinedload, undefer
+
+    import compress_text
+    import models
+    from plan_history import plans_page
+
+    path = os.path.join(directory, f"text_{count}.db")
+    engine = models.make_engine(f"sqlite:///{path}")
+    models.init_db(engine)
+    user_id = _seed(engine, count, compressed=False)
+
+    def file_bytes():
+        with engine.connect() as connection:
+            connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        return sum(os.path.getsize(p) for p in (path, f"{path}-wal") if os.path.exists(p))
+
+    # Each listing gets its own session, like a script run of the app, so nothing is served from
+    # the identity map of an earlier one
+    def eager_page():
+        with models.Session(bind=engine) as session:
+            return session.scalars(
+                select(models.MealPlan).options(undefer('*'), joinedload(models.MealPlan.cooking_instruction)
+                                                .undefer(models.CookingInstruction.instructions))
+                .where(models.MealPlan.user_id == user_id)
+                .order_by(models.MealPlan.created_at.desc(), models.MealPlan.id.desc()).limit(PAGE_SIZE)
+            ).unique().all()
+
+    def page():
+        with models.Session(bind=engine) as session:
+            return plans_page(session, user_id, PAGE_SIZE)
+
+    def open_plan():
+        with models.Session(bind=engine) as session:
+            plan = session.get(models.MealPlan, count // 2)
+            return plan.cooking_plan, plan.cooking_instruction.instructions
+
+    results = {'before': {'file_bytes': file_bytes(), 'plans_page_all_columns': _timed(eager_page, repeat)}}
+    started = time.perf_counter()
+    compress_text.compress_all(engine)
+    compress_text.vacuum(engine)
+    results['migration_seconds'] = time.perf_counter() - started
+    results['after'] = {'file_bytes': file_bytes(), 'plans_page_all_columns': _timed(eager_page, repeat),
+                        'plans_page': _timed(page, repeat), 'open_one_plan': _timed(open_plan, repeat)}
+    engine.dispose()
+    return results
+
+
+def bench_memory(sessions):
+    """Python heap growth per guest session holding a generated plan, traced with tracemalloc."""
+    kept = [_guest_session()]  # the first session pays for one-off caches, so it is not counted
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(sessions):
+        at = _guest_session(bypass_cache=True)
+        _generate(at, f"Memory plan {i}")
+        kept.append(at)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    growth = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return {'sessions': sessions, 'bytes_per_session': growth / sessions,
+            'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help="JSON file to write, standard output if not given")
+    parser.add_argument('--plan-counts', default='10,1000,100000', help="comma-separated stored plan counts")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per measurement")
+    parser.add_argument('--sessions', type=int, default=5, help="guest sessions for the memory measurement")
+    parser.add_argument('--latency', type=float, default=0.2, help="fake API seconds before the first token")
+    parser.add_argument('--tokens-per-second', type=float, default=200.0, help="fake API generation rate")
+    parser.add_argument('--skip', default='', help="comma-separated sections to skip, e.g. database,memory")
+    args = parser.parse_args()
+    skip = set(filter(None, args.skip.split(',')))
+    started_at = datetime.utcnow()
+
+    server = fake_openai.start(latency=args.latency, tokens_per_second=args.tokens_per_second)
+    directory = tempfile.mkdtemp(prefix='fprep-bench-')
+    # Set before the app modules are imported, since they read their configuration on import
+    os.environ.update({
+        'OPENAI_BASE_URL': fake_openai.base_url(server), 'OPENAI_API_KEY': 'fake',
+        'FPREP_DATABASE_URL': f"sqlite:///{os.path.join(directory, 'app.db')}",
+    })
+    os.environ.pop('FPREP_JOB_QUEUE', None)
+    sys.path.insert(0, ROOT)
+
+    import streamlit
+
+    results = {}
+    sections = [
+        ('startup', bench_startup),
+        ('reruns', lambda: bench_reruns(args.repeat)),
+        ('generation', lambda: bench_generation(args.repeat)),
+        ('database', lambda: {count: bench_database(count, directory, args.repeat)
+                              for count in map(int, args.plan_counts.split(','))}),
+        ('text_compression', lambda: {count: bench_text_compression(count, directory, args.repeat)
+                                      for count in map(int, args.plan_counts.split(','))}),
+        ('memory', lambda: bench_memory(args.sessions)),
+    ]
+    for name, function in sections:
+        if name in skip:
+            continue
+        _log(f"Running {name}...")
+        started = time.perf_counter()
+        results[name] = function()
+        _log(f"  {name} took {time.perf_counter() - started:.1f} s")
+
+    import metrics
+
+    report = {
+        'meta': {
+            'started_at': started_at.isoformat(timespec='seconds') + 'Z', 'commit': _git_commit(),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'streamlit': streamlit.__version__,
+            'fake_api': {'latency': args.latency, 'tokens_per_second': args.tokens_per_second,
+                         'requests': server.requests},
+            'repeat': args.repeat,
+        },
+        'results': results,
+        # The app's own metrics over the whole run, e.g. fprep_llm_call_seconds and fprep_view_run_seconds
+        'app_metrics': metrics.summaries(),
+    }
+    server.shutdown()
+    text = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        _log(f"Wrote {args.output}")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
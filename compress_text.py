@@ -0,0 +1,93 @@
+"""Convert the large text columns of existing rows to the compressed CompressedText format.
+
+Rows written before these columns were compressed are still read correctly, but take their
+full size on disk. Run this once after upgrading; running it again only converts rows that
+are not converted yet:
+
+    python -m compress_text
+    python -m compress_text --vacuum    # also give the freed space of a SQLite file back to the disk
+"""
+import argparse
+import logging
+import os
+
+from sqlalchemy import bindparam, column, inspect, select, table, text, update
+
+from models import CompressedText, CookingInstruction, MealPlan, Recipe, engine
+
+logger = logging.getLogger('compress_text')
+
+COLUMNS = [(MealPlan, 'cooking_plan'), (MealPlan, 'existing_ingredients'), (Recipe, 'instructions'),
+           (CookingInstruction, 'instructions')]
+BATCH_SIZE = 1000
+
+
+def _to_binary(bind, table_name, column_name):
+    """On PostgreSQL the column is TEXT until now; make it BYTEA holding the same UTF-8 text."""
+    if bind.dialect.name != 'postgresql':
+        return
+    types = {c['name']: c['type'] for c in inspect(bind).get_columns(table_name)}
+    if types[column_name].python_type is str:
+        with bind.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {table_name} ALTER COLUMN {column_name} TYPE BYTEA "
+                                    f"USING convert_to({column_name}, 'UTF8')"))
+
+
+def compress_column(model, column_name, bind=None, batch_size=BATCH_SIZE):
+    """Rewrite the values of one column that are not in the CompressedText format yet. Returns how many."""
+    bind = bind or engine
+    mapped = model.__table__
+    _to_binary(bind, mapped.name, column_name)
+    # The same column without its type, so values are read as stored
+    raw = table(mapped.name, column('id'), column(column_name))
+    statement = (update(mapped).where(mapped.c.id == bindparam('row_id'))
+                 .values({column_name: bindparam('value')}))
+    converted, last_id = 0, 0
+    while True:
+        with bind.begin() as connection:
+            rows = connection.execute(select(raw.c.id, raw.c[column_name]).where(raw.c.id > last_id)
+                                      .order_by(raw.c.id).limit(batch_size)).all()
+            if not rows:
+                return converted
+            last_id = rows[-1][0]
+            values = [{'row_id': row_id, 'value': CompressedText.decode(value)}
+                      for row_id, value in rows if value is not None and not CompressedText.is_current(value)]
+            if values:
+                connection.execute(statement, values)
+                converted += len(values)
+
+
+def compress_all(bind=None, batch_size=BATCH_SIZE):
+    """Convert every CompressedText column. Returns {"table.column": rows converted}."""
+    return {f"{model.__tablename__}.{name}": compress_column(model, name, bind, batch_size)
+            for model, name in COLUMNS}
+
+
+def vacuum(bind=None):
+    """Rebuild a SQLite file so the space freed by compression is given back to the disk."""
+    bind = bind or engine
+    if bind.dialect.name != 'sqlite':
+        return
+    with bind.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.execute(text("VACUUM"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="rows converted per transaction")
+    parser.add_argument('--vacuum', action='store_true', help="rebuild the SQLite file afterwards")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    path = engine.url.database if engine.dialect.name == 'sqlite' else None
+    size_before = os.path.getsize(path) if path and os.path.exists(path) else None
+    for name, count in compress_all(batch_size=args.batch_size).items():
+        logger.info("%s: %d rows compressed", name, count)
+    if args.vacuum:
+        vacuum()
+        if size_before is not None:
+            logger.info("Database file: %d bytes before, %d bytes after", size_before, os.path.getsize(path))
+
+
+if __name__ == '__main__':
+    main()
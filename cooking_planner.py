@@ -1,117 +1,64 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Text, DateTime
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 from datetime import datetime
+import time
+import uuid
 import streamlit as st
-import openai
-from openai import OpenAI
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import os
 from dotenv import load_dotenv
 # from google.oauth2 import id_token
 # from google.auth.transport import requests as google_requests
 import streamlit.components.v1 as components
+from models import Session, init_db, User, Kitchen, Preference, MealPlan, CookingInstruction
+from llm import CONTINUE_PROMPT, chat_completion, stream_chat_completion
+import llm_cache
+import llm_client
+import metrics
+import single_flight
+from recipe_fanout import generate_meal_plan, split_meals
+from scheduler import format_minutes, recipes_from_plan, schedule, tasks_from_recipes, total_time
+from structured_recipes import KITCHEN_EQUIPMENT, InvalidRecipe, recipe_steps, save_recipes, stored_grocery_totals
+from grocery import aggregate, format_quantity, with_grocery_list
+from plan_adjustment import adjust_sections, plan_changes
+from prompts import adjustment_messages, cooking_instructions_messages, meal_plan_messages
+import plan_archive
+import plan_cache
+import plan_search
+import recipe_index
+import guest_store
+import jobs
 
 load_dotenv()
-# openai.api_key = os.getenv("OPENAI_API_KEY")
-# client=OpenAI()
-client = OpenAI(
-    api_key = os.environ.get("OPENAI_API_KEY"),
-)
-model = 'gpt-4o-mini'
 
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
+LOAD_TEST_LOGIN = os.getenv("FPREP_LOAD_TEST_LOGIN") == "1"
+PREFERENCE_FIELDS = [col.name for col in Preference.__table__.columns if col.name not in ('id', 'user_id')]
 
-Base = declarative_base()
-
-
-class User(Base):
-    __tablename__ = 'users'
-
-    id = Column(Integer, primary_key=True)
-    email = Column(String, unique=True, nullable=False)
-    google_id = Column(String, unique=True)
-    name = Column(String)
-
-    kitchen = relationship("Kitchen", back_populates="user", uselist=False, cascade="all, delete")
-    preference = relationship("Preference", back_populates="user", uselist=False, cascade="all, delete")
-    meal_plans = relationship("MealPlan", back_populates="user", cascade="all, delete")
-
-
-class Kitchen(Base):
-    __tablename__ = 'kitchens'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
-    stove_burner = Column(Integer)
-    oven_rack = Column(Integer)
-    sous_vide_bag = Column(Integer)
-    large_pan = Column(Integer)
-    medium_pan = Column(Integer)
-    small_pan = Column(Integer)
-    large_pot = Column(Integer)
-    medium_pot = Column(Integer)
-    small_pot = Column(Integer)
-    food_processor = Column(Integer)
-    blender_cup = Column(Integer)
-    crock_pot = Column(Integer)
-    rice_cooker = Column(Integer)
-    thermometer = Column(Integer)
-    user = relationship("User", back_populates="kitchen")
-
-
-class Preference(Base):
-    __tablename__ = 'preferences'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
-    style = Column(String)
-    calories = Column(Integer)
-    macro_protein = Column(Integer)
-    macro_fat = Column(Integer)
-    macro_carbs = Column(Integer)
-    additional_preference = Column(Text)
-    temp_unit = Column(String)
-    liquid_unit = Column(String)
-    mass_unit = Column(String)
-    user = relationship("User", back_populates="preference")
-
-
-class MealPlan(Base):
-    __tablename__ = 'meal_plans'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
-    name = Column(String)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    cooking_plan = Column(Text)
-    days = Column(Integer)
-    existing_ingredients = Column(Text)
-    user = relationship("User", back_populates="meal_plans")
-    recipes = relationship("Recipe", back_populates="meal_plan", cascade="all, delete")
-    cooking_instruction = relationship("CookingInstruction", back_populates="meal_plan", uselist=False, cascade="all, delete")
-
-class Recipe(Base):
-    __tablename__ = 'recipes'
-    id = Column(Integer, primary_key=True)
-    meal_plan_id = Column(Integer, ForeignKey('meal_plans.id'))
-    name = Column(String)
-    ingredients = Column(Text)
-    instructions = Column(Text)
-    meal_plan = relationship("MealPlan", back_populates="recipes")
-
-class CookingInstruction(Base):
-    __tablename__ = 'cooking_instructions'
-    id = Column(Integer, primary_key=True)
-    meal_plan_id = Column(Integer, ForeignKey('meal_plans.id'))
-    total_time = Column(String)
-    instructions = Column(Text)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    meal_plan = relationship("MealPlan", back_populates="cooking_instruction")
-
-engine = create_engine('sqlite:///cooking_app.db')
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-session = Session()
+
+# The engine and schema are set up once per process; every script run gets its own short-lived session
+@st.cache_resource
+def get_session_factory():
+    metrics.instrument_sessions(Session)
+    metrics.start()
+    init_db()
+    plan_search.init_search()
+    plan_archive.start()
+    jobs.recover()
+    return Session
+
+
+script_started = time.perf_counter()
+session = get_session_factory()()
+# Close the session of this browser's previous run, so its connection goes back to the pool
+if st.session_state.get('db_session') is not None:
+    st.session_state.db_session.close()
+st.session_state.db_session = session
 
 # Initialize session state variables
 if 'user' not in st.session_state:
     st.session_state.user = None
+elif st.session_state.user is not None:
+    # The user was loaded by an earlier run's session; use this run's copy so nothing stale is shared
+    st.session_state.user = session.merge(st.session_state.user)
 if 'is_guest' not in st.session_state:
     st.session_state.is_guest = False
 if 'guest_kitchen' not in st.session_state:
@@ -126,16 +73,33 @@ if 'guest_preferences' not in st.session_state:
     st.session_state.guest_preferences = {
         'style': "Simple and minimal",
         'calories': 2000,
-        'marco_protein': 170,
-        'marco_fat': 90,
-        'macro_carbs': 130,
+        'macro_protein': 35,
+        'macro_fat': 25,
+        'macro_carbs': 40,
         'additional_preference': "",
         'temp_unit': "Celsius",
         'liquid_unit': "ml",
         'mass_unit': "grams"
     }
 if 'guest_meal_plans' not in st.session_state:
-    st.session_state.guest_meal_plans = []
+    # Bounded per session: only the newest plans stay in memory, the older ones are spilled to disk
+    ctx = get_script_run_ctx()
+    st.session_state.guest_meal_plans = guest_store.GuestPlans(ctx.session_id if ctx else uuid.uuid4().hex)
+if 'streaming_mode' not in st.session_state:
+    st.session_state.streaming_mode = True
+if 'parallel_recipes' not in st.session_state:
+    st.session_state.parallel_recipes = True
+if 'bypass_cache' not in st.session_state:
+    st.session_state.bypass_cache = False
+# Requests of generation calls currently streaming into session state, keyed by state key
+if 'active_streams' not in st.session_state:
+    st.session_state.active_streams = {}
+if 'generation_timings' not in st.session_state:
+    st.session_state.generation_timings = []
+if 'lazy_views' not in st.session_state:
+    st.session_state.lazy_views = False
+if 'background_jobs' not in st.session_state:
+    st.session_state.background_jobs = True
 
 
 # Google Sign-In Component
@@ -193,10 +157,43 @@ def handle_auth_message():
             st.rerun()
 
 
+# Helper function to sign in the simulated users of load tests (benchmarks.load_test) by email,
+# from the load_test_user query parameter. Only enabled with FPREP_LOAD_TEST_LOGIN=1, never in production.
+def handle_load_test_login():
+    email = st.query_params.get('load_test_user')
+    if not LOAD_TEST_LOGIN or not email or st.session_state.user:
+        return
+    user = session.query(User).filter_by(email=email).first()
+    if not user:
+        user = User(email=email, name=email.split('@')[0])
+        session.add(user)
+        session.commit()
+    st.session_state.user = user
+    st.session_state.is_guest = False
+
+
+handle_load_test_login()
+
 # Main app
 st.title("FPrep 👨‍🍳")
 st.markdown('''From **F***ck Meal Prep to **EFF**icient Meal Prep! (powered by AI)''')
 
+# Helper function to show the process-wide metrics to admins (FPREP_ADMIN_EMAILS)
+def show_metrics_panel():
+    with st.expander("Debug: metrics"):
+        st.caption("Latency percentiles over the most recent calls of this server process, in milliseconds")
+        st.dataframe([{'metric': row['name'], 'labels': ', '.join(f"{k}={v}" for k, v in row['labels'].items()),
+                       'count': row['count'], 'p50': row['p50'] * 1000, 'p95': row['p95'] * 1000,
+                       'p99': row['p99'] * 1000} for row in metrics.summaries()],
+                     hide_index=True, use_container_width=True)
+        st.dataframe([{'counter': name, 'labels': ', '.join(f"{k}={v}" for k, v in labels.items()), 'value': value}
+                      for name, value, labels in metrics.counters()], hide_index=True, use_container_width=True)
+        st.dataframe([{'gauge': name, 'labels': ', '.join(f"{k}={v}" for k, v in labels.items()), 'value': value}
+                      for name, value, labels in metrics.gauges()], hide_index=True, use_container_width=True)
+        st.download_button("Download Prometheus metrics", metrics.render(), file_name='fprep_metrics.prom',
+                           mime='text/plain')
+
+
 # Sidebar for authentication
 with st.sidebar:
     st.subheader("Login / Sign Up")
@@ -224,6 +221,27 @@ with st.sidebar:
             st.session_state.is_guest = False
             st.rerun()
 
+    st.toggle("Stream AI responses as they are generated", key='streaming_mode')
+    st.toggle("Generate recipes in parallel, one request per meal", key='parallel_recipes')
+    st.toggle("Generate cooking instructions in the background", key='background_jobs', disabled=jobs.QUEUE_MODE,
+              help="The instructions keep generating while you use the rest of the app.")
+    st.toggle("Load only the selected view", key='lazy_views',
+              help="Shows a view switcher instead of tabs, and runs only the view that is open.")
+    st.toggle("Bypass the AI response cache", key='bypass_cache',
+              help="Always ask the AI for a fresh answer, even for a request it has answered before.")
+    st.caption(f"Response cache: {llm_cache.stats['hits']} hits, {llm_cache.stats['misses']} misses, "
+               f"{llm_cache.entry_count()} stored answers")
+    st.caption(f"AI requests: {llm_client.stats['calls']} sent, {llm_client.stats['retries']} retried, "
+               f"{llm_client.stats['throttled_seconds']:.0f} s waiting for rate limits, "
+               f"{single_flight.stats['coalesced']} saved by sharing an identical request in flight")
+    if st.session_state.is_guest and len(st.session_state.guest_meal_plans):
+        usage = st.session_state.guest_meal_plans.usage()
+        st.caption(f"Guest plans: {usage['plans_in_memory']} in memory ({usage['bytes_in_memory'] / 1024:.0f} KB), "
+                   f"{usage['plans_spilled']} on disk ({usage['bytes_spilled'] / 1024:.0f} KB), "
+                   f"at most {guest_store.MAX_PLANS} kept")
+    if st.session_state.user and metrics.is_admin(st.session_state.user.email):
+        show_metrics_panel()
+
     @st.dialog("How to use FPrep (powered by AI)")
     def how_to_click():
         st.markdown("""
@@ -269,17 +287,12 @@ window.addEventListener('message', function(e) {
 """
 components.html(js, height=0)
 
-# App Navigation
-tab1, tab2, tab3, tab4 = st.tabs(["Update Kitchen", "Update Preferences", "Create Meal & Cooking Plan", "View Plans"])
-
 # Helper function to get user's kitchen data
 def get_kitchen_data():
     if st.session_state.user:
         kitchen = st.session_state.user.kitchen
         if kitchen:
-            return {col.name: getattr(kitchen, col.name)
-                    for col in Kitchen.__table__.columns
-                    if col.name != 'id' and col.name != 'user_id'}
+            return {name: getattr(kitchen, name) for name in KITCHEN_EQUIPMENT}
         return {}
     else:  # Guest mode
         return st.session_state.guest_kitchen
@@ -290,16 +303,219 @@ def get_preferences():
     if st.session_state.user:
         pref = st.session_state.user.preference
         if pref:
-            return {col.name: getattr(pref, col.name)
-                    for col in Preference.__table__.columns
-                    if col.name != 'id' and col.name != 'user_id'}
+            return {name: getattr(pref, name) for name in PREFERENCE_FIELDS}
         return {}
     else:  # Guest mode
         return st.session_state.guest_preferences
 
 
-# Handle different menu selections
-with tab1:
+# Helper function to find a generation call that a rerun cut off after some tokens had arrived
+def interrupted_stream(state_key):
+    request = st.session_state.active_streams.get(state_key)
+    if request and request['received'] and st.session_state.get(state_key):
+        return request
+    return None
+
+
+# Helper function to run a generation call and store its text in st.session_state[state_key].
+# In streaming mode the text is rendered into placeholder and written to session state as it
+# arrives, so a rerun mid-stream keeps the tokens received so far. With resume=True, an
+# interrupted stream of the same messages continues from that partial text.
+def generate_into_state(state_key, call_name, messages, temperature, placeholder, spinner_text, resume=False):
+    prefix = ''
+    request_messages = messages
+    interrupted = interrupted_stream(state_key)
+    if resume and interrupted and interrupted['messages'] == messages:
+        prefix = st.session_state[state_key]
+        request_messages = messages + [{'role': 'assistant', 'content': prefix},
+                                       {'role': 'user', 'content': CONTINUE_PROMPT}]
+
+    if st.session_state.streaming_mode:
+        request = {'call': call_name, 'messages': messages, 'temperature': temperature, 'received': False}
+        st.session_state.active_streams[state_key] = request
+        last_render = 0.0
+
+        def on_delta(text):
+            nonlocal last_render
+            request['received'] = True
+            st.session_state[state_key] = text
+            # Throttle rendering, every markdown update is sent to the browser
+            if time.perf_counter() - last_render >= 0.1:
+                placeholder.markdown(text)
+                last_render = time.perf_counter()
+
+        text, timing = stream_chat_completion(request_messages, temperature, on_delta, call_name=call_name,
+                                              prefix=prefix, use_cache=not st.session_state.bypass_cache)
+        placeholder.empty()
+        del st.session_state.active_streams[state_key]
+    else:
+        with st.spinner(spinner_text):
+            text, timing = chat_completion(request_messages, temperature, call_name=call_name,
+                                           use_cache=not st.session_state.bypass_cache)
+        text = prefix + text
+
+    st.session_state[state_key] = text
+    record_generation_timing(timing)
+    return text
+
+
+# Helper function to keep the timings of the latest generation calls
+def record_generation_timing(timing):
+    st.session_state.generation_timings.append(timing)
+    del st.session_state.generation_timings[:-50]
+
+
+# Helper function to show the timing of the latest generation call with one of the given names
+def show_generation_timing(*call_names):
+    for timing in reversed(st.session_state.generation_timings):
+        if timing['call'] in call_names:
+            if timing.get('cached'):
+                st.caption(f"Served from the response cache in {timing['total'] * 1000:.0f} ms")
+            elif timing.get('shared'):
+                st.caption(f"Shared the answer to an identical request, ready after {timing['total']:.1f} s")
+            else:
+                details = ''
+                if timing.get('sections_total'):
+                    details = f", {timing['sections_changed']} of {timing['sections_total']} recipes regenerated"
+                if timing.get('reused'):
+                    details += f", {timing['reused']} saved recipes reused"
+                if timing.get('prompt_tokens') is not None:
+                    details += f", {timing['prompt_tokens']:,} prompt + {timing['completion_tokens']:,} completion tokens"
+                st.caption(f"First token after {timing['ttft']:.1f} s, finished in {timing['total']:.1f} s{details}")
+            return
+
+
+# Helper function to replace the grocery list of the current plan with one summed locally from its recipes
+def add_grocery_list(existing_ingredients):
+    preferences = get_preferences()
+    st.session_state.cooking_plan = with_grocery_list(
+        st.session_state.cooking_plan, existing_ingredients, preferences['liquid_unit'], preferences['mass_unit'])
+
+
+# Helper function to offer saved recipes similar to each requested meal (recipe_index) as an
+# instant alternative to generating them. Recipes of other users are offered without their plan
+# name. Returns {meal line position: recipe_index.similar match} of the recipes picked for reuse.
+def reuse_choices(meals):
+    preferences, kitchen = get_preferences(), get_kitchen_data()
+    user_id = st.session_state.user.id if st.session_state.user else None
+    matches = [(i, meal, recipe_index.similar(meal, user_id, style=preferences.get('style'), kitchen=kitchen))
+               for i, meal in enumerate(split_meals(meals or ''))]
+    matches = [(i, meal, found) for i, meal, found in matches if found]
+    if not matches:
+        return {}
+    picks = {}
+    with st.expander(f"Reuse saved recipes ({len(matches)} of your meals have similar ones)"):
+        st.caption("A reused recipe is added instantly and uses no AI tokens. Its quantities are scaled to "
+                   "your number of days.")
+        for i, meal, found in matches:
+            options = {"Generate a new recipe": None}
+            for match in found:
+                source = match['plan_name'] or "another user's plan"
+                options[f"Reuse {match['name']} from {source} ({match['score']:.0%} match)"] = match
+            choice = options[st.selectbox(meal, list(options), key=f"reuse_{i}")]
+            if choice:
+                picks[i] = choice
+    return picks
+
+
+# Helper function to get the recipe steps of the current plan, structured when the plan has them
+def current_recipe_steps():
+    if st.session_state.get('plan_recipes'):
+        return recipe_steps(st.session_state.plan_recipes)
+    return recipes_from_plan(st.session_state.cooking_plan)
+
+
+# Helper function to store cooking instructions in the guest's copy of the saved plan
+def store_guest_instructions(instructions_text, total):
+    st.session_state.guest_meal_plans.update(st.session_state.saved_meal_plan_name,
+                                             cooking_instructions=instructions_text, total_time=total)
+
+
+# Helper function to poll the background job whose id is in st.session_state[state_key],
+# and hand its result to on_done once it is done
+@st.fragment(run_every=jobs.POLL_SECONDS)
+def show_job(state_key, description, on_done):
+    job = jobs.get(st.session_state[state_key])
+    if job is None:
+        st.error(f"Error {description}: the job was not found")
+        st.session_state[state_key] = None
+        return
+    if job['status'] == 'dead':
+        st.error(f"Error {description}: {job['error']}")
+        if st.button("Try again", key=f"retry_{state_key}"):
+            jobs.requeue(job['id'])
+            st.rerun()
+        return
+    if job['status'] != 'done':
+        retrying = f" Retrying after an error: {job['error']}" if job['status'] == 'queued' and job['attempts'] else ""
+        st.info(f"{description.capitalize()} in the background ({job['status']}, waited {job['waited']:.0f} s, "
+                f"running for {job['ran']:.0f} s). You can keep using the app.{retrying}")
+        return
+
+    on_done(job['result'])
+    record_generation_timing(job['result']['timing'])
+    st.session_state[state_key] = None
+    st.rerun()
+
+
+# Helper function to take over the result of a background meal-plan job
+def finish_plan_job(result):
+    st.session_state.cooking_plan = result['plan']
+    st.session_state.plan_recipes = result['recipes']
+    st.session_state.meal_plan_generated = True
+
+
+# Helper function to take over the result of a background meal-plan adjustment job
+def finish_adjustment_job(result):
+    st.session_state.cooking_plan = result['plan']
+    st.session_state.plan_recipes = None
+    st.session_state.adjusting_meal_plan = False
+
+
+# Helper function to take over the result of a background cooking-instructions job;
+# the job has already saved it to the database for signed-in users
+def finish_instructions_job(result):
+    st.session_state.cooking_instructions = result['instructions']
+    if not st.session_state.user:
+        store_guest_instructions(result['instructions'], result['total_time'])
+    st.session_state.generating_instructions = False
+
+
+# Helper function to show the local timeline of recipe steps, with "what-if" equipment counts
+def show_local_schedule(recipes, kitchen, key):
+    if not recipes:
+        return
+    tasks = tasks_from_recipes(recipes)
+    with st.expander("Equipment-aware timeline (computed locally)"):
+        st.caption("Change the equipment counts to see how the timeline would change. Nothing is saved.")
+        used = sorted({column for t in tasks for column in t['equipment'] if column in kitchen})
+        what_if = dict(kitchen)
+        columns = st.columns(4)
+        cooks = columns[0].number_input("Cooks", min_value=1, value=1, key=f"{key}_cooks")
+        for i, column in enumerate(used, start=1):
+            what_if[column] = columns[i % 4].number_input(column.replace('_', ' ').capitalize(), min_value=0,
+                                                          value=int(kitchen.get(column) or 0),
+                                                          key=f"{key}_{column}")
+
+        result = schedule(tasks, what_if, cooks=cooks)
+        st.markdown(f"**Total time**: {format_minutes(result['makespan'])} "
+                    f"(no schedule can be shorter than {format_minutes(result['lower_bound'])})")
+        if result['missing_equipment']:
+            st.warning("Some steps need equipment you don't have: "
+                       f"{', '.join(c.replace('_', ' ') for c in result['missing_equipment'])}. "
+                       "They were scheduled as if you had one.")
+        st.dataframe([{'Start': format_minutes(e['start']), 'End': format_minutes(e['end']),
+                       'Recipe': e['recipe'], 'Step': e['name'],
+                       'Equipment': ', '.join(c.replace('_', ' ') for c in e['equipment']),
+                       'Hands-on': e['hands_on']}
+                      for e in result['entries']], hide_index=True)
+        st.markdown("**Critical path**: " + " → ".join(result['critical_path']))
+
+
+# Each view is a fragment, so a widget inside it reruns only that view instead of the whole app
+@st.fragment
+@metrics.timed('fprep_view_run_seconds', view='kitchen')
+def kitchen_view():
     # st.subheader("Update Kitchen Setup")
 
     kitchen_data = get_kitchen_data()
@@ -356,7 +572,9 @@ with tab1:
             st.success("Kitchen setup saved for this session!")
             st.info("Sign in to save your kitchen setup permanently.")
 
-with tab2:
+@st.fragment
+@metrics.timed('fprep_view_run_seconds', view='preferences')
+def preferences_view():
     # st.subheader("Update Cooking Preferences")
 
     preferences = get_preferences()
@@ -410,12 +628,17 @@ with tab2:
             st.success("Preferences saved for this session!")
             st.info("Sign in to save your preferences permanently.")
 
-with tab3:
+@st.fragment
+@metrics.timed('fprep_view_run_seconds', view='meal_plan')
+def meal_plan_view():
     # st.subheader("Generate Meal Plan")
 
     # Initialize session state variables for this page
     if 'cooking_plan' not in st.session_state:
         st.session_state.cooking_plan = None
+    # Structured recipes behind cooking_plan, when the plan was generated per meal
+    if 'plan_recipes' not in st.session_state:
+        st.session_state.plan_recipes = None
     if 'meal_plan_generated' not in st.session_state:
         st.session_state.meal_plan_generated = False
     if 'adjusting_meal_plan' not in st.session_state:
@@ -428,92 +651,67 @@ with tab3:
         st.session_state.saved_meal_plan_id = None
     if 'generating_instructions' not in st.session_state:
         st.session_state.generating_instructions = False
+    # Background jobs generating the plan, its adjustment or the cooking instructions, while one is queued or running
+    for job_key in ('plan_job_id', 'adjustment_job_id', 'instructions_job_id'):
+        if job_key not in st.session_state:
+            st.session_state[job_key] = None
 
     # Check if we're in the cooking instructions phase
     if st.session_state.meal_plan_saved and st.session_state.generating_instructions:
         st.markdown(f"Generating Cooking Instructions for {st.session_state.saved_meal_plan_name}")
 
-        with st.spinner("Generating detailed cooking instructions..."):
-            try:
-                # Get kitchen setup data for equipment availability
-                kitchen_data = get_kitchen_data()
-
-                # Prepare the cooking instructions prompt
-                system_prompt = """You are a professional chef who is experienced in cooking multiple dishes simultaneously in a very efficient way.
-                    Create detailed step-by-step cooking instructions that utilize equipment efficiently and minimize waiting time."""
-
-                cooking_user_prompt = f'''
-                    Please help write a cooking plan, step by step, that is tailored to my needs below.
-                    Step 1: Understand all the information that you need to write a cooking plan for my needs.
-                    - I have very limited time, so I want to cook all meals for all {st.session_state.saved_meal_plan_days} days at once, then store the meals for the week. 
-                    - The recipes I want to cook are the section **Recipes** in {st.session_state.cooking_plan}
-                    - For my cooking equipment, besides the basic equipment like knives, spatulas, spoons, forks, mixing bowls, measuring cups, etc., the list of the equipment I have is in {kitchen_data}
-
-                    Step 2: Generate the cooking plan, step by step. The goal of the cooking plan is to make the cooking as efficient as possible with little waiting time.
-                    The plan should meet the following criteria:
-                    - Have very minimal in-cooking equipment washing time
-                    - Utilize all the equipment as much as possible to prepare or cook multiple ingredients simultaneously. 
-                    - Include the steps and time for washing produce and washing equipment, if any.
-                    - Estimate the time taken for each step. 
-                    - Sum up the time from all the steps to get the estimated total time.
-                    - Because the food is cooked and stored for the week ahead, include the storing and packing step. 
-                    The cooking plan should start from the minute 0 as the starting point of the cooking timeline, then add each step with the step's duration. 
-                    
-                    Step 3: Export the output in the format below. Ensure that the output does not include any XML tags. 
-                    Cooking plan for {st.session_state.saved_meal_plan_name}
-                    **Total time**: (estimated total time)
-                    **Steps**
-                    - (cooking step)
-                    '''
-
-                cooking_response = client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {'role': 'system', 'content': system_prompt},
-                        {'role': 'user', 'content': cooking_user_prompt}
-                    ],
-                    temperature=0
+        try:
+            # Get kitchen setup data for equipment availability
+            kitchen_data = get_kitchen_data()
+
+            # Only the recipes are sent, without the grocery list and calories
+            messages = cooking_instructions_messages(st.session_state.saved_meal_plan_name,
+                                                     st.session_state.saved_meal_plan_days,
+                                                     st.session_state.cooking_plan, kitchen_data)
+
+            if st.session_state.background_jobs or jobs.QUEUE_MODE:
+                # Generated on the server's job executor, so a rerun does not cancel it;
+                # the job saves the instructions to the database itself
+                if not st.session_state.instructions_job_id:
+                    st.session_state.instructions_job_id = jobs.submit(
+                        'cooking_instructions',
+                        {'messages': messages, 'temperature': 0, 'recipes': current_recipe_steps(),
+                         'kitchen': kitchen_data, 'use_cache': not st.session_state.bypass_cache},
+                        user_id=st.session_state.user.id if st.session_state.user else None,
+                        meal_plan_id=st.session_state.saved_meal_plan_id if st.session_state.user else None
+                    )
+                show_job('instructions_job_id', "generating detailed cooking instructions", finish_instructions_job)
+            else:
+                # Store cooking instructions in session state, continuing a stream a rerun cut off
+                generate_into_state(
+                    'cooking_instructions', 'cooking_instructions', messages,
+                    0, st.empty(), "Generating detailed cooking instructions...", resume=True
                 )
 
-                # Store cooking instructions in session state
-                st.session_state.cooking_instructions = cooking_response.choices[0].message.content
-
-                # Extract total time if possible
-                total_time = "Unknown"
+                # Total time is the makespan of the local equipment-aware schedule of the recipes,
+                # or what the model wrote if the recipe steps could not be found
                 instructions_text = st.session_state.cooking_instructions
-
-                # Try to extract total time using regex
-                import re
-
-                time_match = re.search(r'\*\*Total time\*\*: (.*?)(?:\r|\n|$)', instructions_text)
-                if time_match:
-                    total_time = time_match.group(1).strip()
+                total = total_time(current_recipe_steps(), kitchen_data, instructions_text)
 
                 # Save to database
                 if st.session_state.user and st.session_state.saved_meal_plan_id:
                     # For logged-in users, save to database
                     cooking_instruction = CookingInstruction(
                         meal_plan_id=st.session_state.saved_meal_plan_id,
-                        total_time=total_time,
+                        total_time=total,
                         instructions=instructions_text
                     )
                     session.add(cooking_instruction)
                     session.commit()
                 elif not st.session_state.user:
-                    # For guest users, store in session state
-                    # Find the correct meal plan in guest_meal_plans
-                    for i, plan in enumerate(st.session_state.guest_meal_plans):
-                        if plan.get('name') == st.session_state.saved_meal_plan_name:
-                            st.session_state.guest_meal_plans[i]['cooking_instructions'] = instructions_text
-                            st.session_state.guest_meal_plans[i]['total_time'] = total_time
-                            break
+                    store_guest_instructions(instructions_text, total)
 
                 st.session_state.generating_instructions = False
                 st.rerun()
 
-            except Exception as e:
-                st.error(f"Error generating cooking instructions: {str(e)}")
-                st.session_state.generating_instructions = False
+        except Exception as e:
+            st.error(f"Error generating cooking instructions: {str(e)}")
+            st.session_state.generating_instructions = False
 
     # If we've finished saving and have instructions, display them
     elif st.session_state.meal_plan_saved and st.session_state.cooking_instructions:
@@ -523,17 +721,27 @@ with tab3:
         st.markdown(st.session_state.cooking_plan)
         st.divider()
         st.markdown(st.session_state.cooking_instructions)
+        show_generation_timing('cooking_instructions')
+        show_local_schedule(current_recipe_steps(), get_kitchen_data(), key='saved_plan_schedule')
+        if interrupted_stream('cooking_instructions'):
+            st.warning("Generation was interrupted. The instructions above are what was received so far.")
+            if st.button("Resume generation", key="resume_cooking_instructions"):
+                st.session_state.generating_instructions = True
+                st.rerun()
 
         # Option to go back to create a new meal plan
         if st.button("Create a New Meal Plan"):
             # Reset all states
             st.session_state.cooking_plan = None
+            st.session_state.plan_recipes = None
             st.session_state.meal_plan_generated = False
             st.session_state.adjusting_meal_plan = False
             st.session_state.meal_plan_saved = False
             st.session_state.cooking_instructions = None
             st.session_state.saved_meal_plan_id = None
             st.session_state.generating_instructions = False
+            st.session_state.instructions_job_id = None
+            st.session_state.active_streams = {}
             st.rerun()
 
 
@@ -545,6 +753,9 @@ with tab3:
         existing_ingredients = st.text_area("List your existing ingredients (comma-separated)")
         meals = st.text_area('''What do you want for your meal? Write each meal and dish on a separate line. For example: "-Breakfast: shrimp salad"''')
 
+        # Saved recipes picked for reuse instead of generation, by position of the meal line
+        reuse_picks = reuse_choices(meals)
+
         # Generate button
         generate_button = st.button("Generate Meal Plan")
 
@@ -554,65 +765,82 @@ with tab3:
                 st.warning("Please provide a name for your meal plan.")
             else:
                 preferences = get_preferences()
-                system_prompt = """You are an experienced chef. You have many experiences in cooking healthy dishes. Create a detailed meal plan with recipes and cooking instructions."""
-
-                recipe_user_prompt = f'''
-                                Please help write a meal plan and grocery list tailored to my needs.
-
-                                Step 1: Understand all the information that you need to write a cooking plan for my  needs.
-                                - My cooking style is {preferences['style']}
-                                - My daily calories need is {preferences['calories']} calories
-                                - My protein, fat, carbs percentage distribution of the daily calories are respectively: {preferences['macro_protein']}%, {preferences['macro_fat']}%, {preferences['macro_carbs']}%
-                                - My additional preference is {preferences['additional_preference']} 
-                                - My units for temperature unit, liquid unit, and mass unit are: {preferences['temp_unit']}, {preferences['liquid_unit']}, {preferences['mass_unit']}
-                                - I want to cook for {days} for the next week.
-                                - The dishes I want to cook are {meals}
-                                - The existing ingredients that I want to incorporate into the recipes, if possible, are {existing_ingredients}.
-                                - For my cooking equipment, besides the basic equipment like knives, spatulas, spoons, forks, mixing bowls, measuring cups, etc., the list of the equipment I have is in {kitchen_data}
-
-                                Step 2: Generate the recipes for each meal given in Step 1. For each meal:
-                                - Give the meal a name
-                                - State the cooking method
-                                - Estimate the calories for this meal for one day
-                                - Write the recipe. Ensure that the recipe meets the needs in Step 1 and use the cooking equipment only listed in Step 1.
-                                  -- Ingredients: List the ingredients. All ingredients must have the amount needed for the recipe.
-                                  -- Equipment: List the equipment needed for the recipe
-                                  -- Instructions: List the steps to cook the recipe
-
-                                Step 3: Combine the ingredient lists from the three meals into one list. This will be my grocery list.
-                                - This grocery list is split into two sections:
-                                  -- 1. Ingredients I already have
-                                  -- 2. Ingredients I need to buy.  All ingredients must have the amount needed for the recipes.
-                                - For each ingredient, state the amount needed for that ingredient. If two recipes share the same ingredient, list how much of that ingredient is needed for each meal. For example: "Mixed greens: 5 cups for breakfast, 5 cups for dinner".
-
-                                Step 4: Export the output in the format below. Ensure that the output does not include any XML tags.
-                                Recipes for {plan_name}
-                                **Recipes**
-                                (Meal name generated in step 2): (recipe for the meal)
-
-                                **Grocery list**
-                                (summarized list of ingredients in step 3)'''
-
-
-                with st.spinner("Generating your meal plan..."):
-                    try:
-                        recipe_response = client.chat.completions.create(
-                            model=model,
-                            messages=[{'role': 'system', 'content': system_prompt},
-                                      {'role': 'user', 'content': recipe_user_prompt}],
-                            temperature=0.1
-                        )
-                        # Store the cooking plan in session state
-                        st.session_state.cooking_plan = recipe_response.choices[0].message.content
+                messages = meal_plan_messages(plan_name, meals, preferences, days, existing_ingredients,
+                                              kitchen_data)
+                meal_list = split_meals(meals)
+                reused = {i: recipe for i, recipe in (
+                    (i, recipe_index.reusable_recipe(session, match, meal_list[i], days))
+                    for i, match in reuse_picks.items()) if recipe}
+
+                # One concurrent request per meal that is not reused, merged with a locally built grocery list
+                structured = bool(reused) or (st.session_state.parallel_recipes and len(meal_list) > 1)
+
+                try:
+                    if jobs.QUEUE_MODE:
+                        # Only enqueued here; a worker process generates the plan
+                        st.session_state.plan_job_id = jobs.submit('meal_plan', {
+                            'plan_name': plan_name, 'meals': meals, 'preferences': preferences, 'days': days,
+                            'existing_ingredients': existing_ingredients, 'kitchen': kitchen_data,
+                            'parallel': st.session_state.parallel_recipes,
+                            'messages': messages,
+                            'use_cache': not st.session_state.bypass_cache,
+                            'reused': reused,
+                        }, user_id=st.session_state.user.id if st.session_state.user else None)
+                        st.session_state.meal_plan_generated = False
+                    else:
+                        # Store the cooking plan in session state. It is marked as generated up front
+                        # so a partial plan from an interrupted stream is still shown after a rerun.
                         st.session_state.meal_plan_generated = True
-
-                    except Exception as e:
-                        st.error(f"Error generating meal plan: {str(e)}")
+                        if structured:
+                            progress = st.progress(0.0, text="Generating your recipes...")
+                            try:
+                                plan, recipes, timing = generate_meal_plan(
+                                    plan_name, meals, preferences, days, existing_ingredients, kitchen_data,
+                                    on_progress=lambda done, total: progress.progress(
+                                        done / total, text=f"{done} of {total} recipes ready"),
+                                    use_cache=not st.session_state.bypass_cache, reused=reused
+                                )
+                                st.session_state.cooking_plan = plan
+                                st.session_state.plan_recipes = recipes
+                                record_generation_timing(timing)
+                            except InvalidRecipe as e:
+                                # Fall back to the free-text plan of the single request below
+                                st.warning(f"{e}. Generating the plan as a single request instead.")
+                                structured = False
+                            progress.empty()
+                        if not structured:
+                            st.session_state.plan_recipes = None
+                            generate_into_state(
+                                'cooking_plan', 'meal_plan', messages,
+                                0.1, st.empty(), "Generating your meal plan..."
+                            )
+                            add_grocery_list(existing_ingredients)
+
+                except Exception as e:
+                    st.error(f"Error generating meal plan: {str(e)}")
+
+        if st.session_state.plan_job_id:
+            show_job('plan_job_id', "generating your meal plan", finish_plan_job)
 
         # Display meal plan if it exists
         if st.session_state.meal_plan_generated and st.session_state.cooking_plan:
             st.subheader("Your Cooking Plan")
             st.text_area("Generated Cooking Plan", value=st.session_state.cooking_plan, height=300)
+            show_generation_timing('meal_plan', 'meal_plan_adjustment')
+
+            # Resume a generation that a rerun cut off mid-stream
+            interrupted = interrupted_stream('cooking_plan')
+            if interrupted:
+                st.warning("Generation was interrupted. The plan above is what was received so far.")
+                if st.button("Resume generation", key="resume_cooking_plan"):
+                    try:
+                        generate_into_state('cooking_plan', interrupted['call'], interrupted['messages'],
+                                            interrupted['temperature'], st.empty(),
+                                            "Resuming your meal plan...", resume=True)
+                        add_grocery_list(existing_ingredients)
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"Error resuming meal plan: {str(e)}")
 
             # Adjust meal plan button
             if not st.session_state.adjusting_meal_plan:
@@ -630,31 +858,51 @@ with tab3:
 
                 if st.button("Submit Adjustment", key="submit_adjustment"):
                     if adjustment_request:
-                        with st.spinner("Adjusting your meal plan..."):
-                            try:
-                                # Call to adjust the meal plan
-                                adjustment_response = client.chat.completions.create(
-                                    model=model,
-                                    messages=[
-                                        {'role': 'system',
-                                         'content': "You are a professional chef assistant. Modify the meal plan according to the user's request."},
-                                        {'role': 'user',
-                                         'content': f'''Here is my current meal plan:\n\n{st.session_state.cooking_plan}\n\nPlease adjust it as follows: {adjustment_request}.
-                                                        Output format: Keep the current format of the {st.session_state.cooking_plan}.'''}
-                                    ],
-                                    temperature=0.1
-                                )
-
-                                # Update the meal plan in session state
-                                st.session_state.cooking_plan = adjustment_response.choices[0].message.content
-                                st.session_state.adjusting_meal_plan = False
-                                st.success("Meal plan adjusted successfully!")
+                        try:
+                            use_cache = not st.session_state.bypass_cache
+                            if jobs.QUEUE_MODE:
+                                # Only enqueued here; a worker process rewrites the plan
+                                st.session_state.adjustment_job_id = jobs.submit('meal_plan_adjustment', {
+                                    'plan': st.session_state.cooking_plan, 'request': adjustment_request,
+                                    'existing_ingredients': existing_ingredients,
+                                    'preferences': get_preferences(), 'use_cache': use_cache,
+                                }, user_id=st.session_state.user.id if st.session_state.user else None)
                                 st.rerun()
-                            except Exception as e:
-                                st.error(f"Error adjusting meal plan: {str(e)}")
+                            # Only the recipes the request touches are regenerated and spliced back in
+                            changes = plan_changes(st.session_state.cooking_plan, adjustment_request,
+                                                   use_cache=use_cache)
+                            if changes is not None:
+                                progress = st.progress(0.0, text="Adjusting your meal plan...")
+                                plan, timing = adjust_sections(
+                                    st.session_state.cooking_plan, changes, adjustment_request,
+                                    existing_ingredients, get_preferences(),
+                                    on_progress=lambda done, total: progress.progress(
+                                        done / total, text=f"{done} of {total} recipes adjusted"),
+                                    use_cache=use_cache
+                                )
+                                progress.empty()
+                                st.session_state.cooking_plan = plan
+                                record_generation_timing(timing)
+                            else:
+                                # The change applies to the whole plan, so it is rewritten in one request
+                                generate_into_state('cooking_plan', 'meal_plan_adjustment',
+                                                    adjustment_messages(st.session_state.cooking_plan,
+                                                                        adjustment_request),
+                                                    0.1, st.empty(), "Adjusting your meal plan...")
+                            # The rewritten plan no longer matches the structured recipes
+                            st.session_state.plan_recipes = None
+                            add_grocery_list(existing_ingredients)
+                            st.session_state.adjusting_meal_plan = False
+                            st.success("Meal plan adjusted successfully!")
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"Error adjusting meal plan: {str(e)}")
                     else:
                         st.warning("Please describe what you'd like to adjust.")
 
+                if st.session_state.adjustment_job_id:
+                    show_job('adjustment_job_id', "adjusting your meal plan", finish_adjustment_job)
+
                 if st.button("Cancel Adjustment", key="cancel_adjustment"):
                     st.session_state.adjusting_meal_plan = False
                     st.rerun()
@@ -675,14 +923,17 @@ with tab3:
                 if st.session_state.user:
                     meal_plan = MealPlan(
                         user_id=st.session_state.user.id,
+                        style=get_preferences().get('style'),
                         **new_meal_plan
                     )
                     session.add(meal_plan)
+                    if st.session_state.plan_recipes:
+                        save_recipes(session, meal_plan, st.session_state.plan_recipes)
                     session.commit()
                     meal_plan_id = meal_plan.id
                     st.success("Meal plan created and saved to your account!")
                 else:
-                    st.session_state.guest_meal_plans.append(new_meal_plan)
+                    st.session_state.guest_meal_plans.add(new_meal_plan)
                     st.success("Meal plan created!")
                     st.info("Sign in to save your meal plan permanently.")
 
@@ -697,63 +948,133 @@ with tab3:
                 st.rerun()
 
 
-with tab4:
+@st.fragment
+@metrics.timed('fprep_view_run_seconds', view='plans')
+def plans_view():
     # st.subheader("Your Meal Plans")
 
-    # Get meal plans based on authentication status
-    if st.session_state.user:
-        plans = session.query(MealPlan).filter_by(user_id=st.session_state.user.id).order_by(MealPlan.created_at.desc()).all()
-        if not plans:
-            st.info("You haven't created any meal plans yet. Go to 'Create Meal Plan' to get started!")
-    else:
-        plans = sorted(st.session_state.guest_meal_plans, key=lambda x: x.get('created_at', ''), reverse=True)
-        if not plans:
-            st.info("You haven't created any meal plans in this session. Go to 'Create Meal Plan' to get started!")
-            st.warning("Note: Guest meal plans are only stored for the current session.")
-
     # Date filter
     with st.expander("Filter and Search"):
         start_date = st.date_input("Meal plan creation date filter (start date)", value=None, key="start_date")
         end_date = st.date_input("Meal plan creation date filter (end date)", value=None, key="end_date")
 
         # Search filter
-        search_term = st.text_input("Search meal plans by name")
-
-    # Apply filters
-    filtered_plans = []
-    for plan in plans:
-        name = plan['name'] if isinstance(plan, dict) else plan.name
-        created = plan.get('created_at') if isinstance(plan, dict) else plan.created_at.date()
-
-        if search_term and search_term.lower() not in name.lower():
-            continue
-        if start_date and created.date() <= start_date:
-            continue
-        if end_date and created.date() >= end_date:
-            continue
-        filtered_plans.append(plan)
-
-    plans = filtered_plans
+        search_term = st.text_input("Search meal plans",
+                                    help="Searches plan names, recipes, grocery lists and cooking instructions.")
+    page_size = st.selectbox("Plans per page", [5, 10, 25, 50], index=1, key="plans_page_size")
+
+    # Get meal plans based on authentication status
+    if st.session_state.user:
+        # Cursors of the pages before the current one; a new filter starts again from the newest plan
+        page_filter = (st.session_state.user.id, start_date, end_date, search_term, page_size)
+        if st.session_state.get('plans_page_filter') != page_filter:
+            st.session_state.plans_page_filter = page_filter
+            st.session_state.plans_page_cursors = [None]
+        cursors = st.session_state.plans_page_cursors
+        highlights = {}
+        if search_term and plan_search.available():
+            # Full-text search, best match first, with the matches highlighted
+            with metrics.timer('fprep_plan_list_seconds', kind='search'):
+                results, next_cursor = plan_archive.search_page(session, st.session_state.user.id, search_term,
+                                                                page_size, after=cursors[-1],
+                                                                start_date=start_date, end_date=end_date)
+            plans = [plan_cache.summary(plan) for plan, _, _ in results]
+            highlights = {plan: (name, snippet) for plan, (_, name, snippet) in zip(plans, results)}
+            if not plans and len(cursors) == 1:
+                st.info("No meal plans match your search.")
+        else:
+            # Served from the plan list cache, without a query, until the user's plans change
+            with metrics.timer('fprep_plan_list_seconds', kind='page'):
+                plans, next_cursor = plan_cache.plans_page(session, st.session_state.user.id, page_size,
+                                                           after=cursors[-1], start_date=start_date,
+                                                           end_date=end_date, name=search_term)
+            if not plans and len(cursors) == 1:
+                st.info("You haven't created any meal plans yet. Go to 'Create Meal Plan' to get started!")
+    else:
+        if not len(st.session_state.guest_meal_plans):
+            st.info("You haven't created any meal plans in this session. Go to 'Create Meal Plan' to get started!")
+            st.warning("Note: Guest meal plans are only stored for the current session.")
+        plans = st.session_state.guest_meal_plans.plans(name=search_term, start_date=start_date, end_date=end_date)
+
     # Display meal plans
     for i, p in enumerate(plans):
-        if isinstance(p, dict):  # Guest meal plan
-            instructions = p.get('cooking_instructions')
-            total_time = p.get('total_time')
+        if isinstance(p, guest_store.GuestPlan):  # Summary of a guest meal plan
             with st.container(border=True):
                 st.markdown(
-                    f"#### {p['name']} (Created: {p['created_at'].date() if isinstance(p['created_at'], datetime) else 'today'})")
-                st.markdown(f'''Total cooking time: {total_time}''')
-                with st.expander("Meal and Grocery Plan"):
-                    st.markdown(p['cooking_plan'])
-                with st.expander("Cooking Instructions"):
-                    st.markdown(instructions)
-
-        else:  # Database meal plan
+                    f"#### {p.name} (Created: {p.created_at.date() if isinstance(p.created_at, datetime) else 'today'})")
+                st.markdown(f'''Total cooking time: {p.total_time}''')
+                # The plan texts are only decompressed, or read back from disk, when opened
+                if st.toggle("Show plan and cooking instructions", key=f"guest_plan_details_{p.seq}"):
+                    plan = st.session_state.guest_meal_plans.plan(p.seq)
+                    if plan is None:
+                        st.info("This plan is no longer stored for this session.")
+                        continue
+                    with st.expander("Meal and Grocery Plan"):
+                        st.markdown(plan['cooking_plan'])
+                    with st.expander("Cooking Instructions"):
+                        st.markdown(plan.get('cooking_instructions'))
+
+        else:  # Summary of a database meal plan, in the main database or archived
             with st.container(border=True):
-                st.markdown(f"### {p.name} (Created: {p.created_at.date()})")
-                st.markdown(f'''Total cooking time: {total_time}''')
-                with st.expander("Meal and Grocery Plan"):
-                    st.markdown(p.cooking_plan)
-                with st.expander("Cooking Instructions"):
-                    if p.cooking_instruction and p.cooking_instruction.instructions:
-                        st.markdown(p.cooking_instruction.instructions)
+                name, snippet = highlights.get(p, (p.name, None))
+                st.markdown(f"### {name} (Created: {p.created_at.date()}{', archived' if p.archived else ''})")
+                if snippet and snippet != name:
+                    st.caption(snippet)
+                st.markdown(f'''Total cooking time: {p.total_time}''')
+                # The plan itself is only read, and its texts decompressed, when opened
+                if st.toggle("Show plan and cooking instructions",
+                             key=f"plan_details_{'archived_' if p.archived else ''}{p.id}"):
+                    if p.archived:
+                        # Rebuilt from the archive's compressed copy of the plan
+                        p = plan_archive.open_plan(p.id)
+                        plan_totals = plan_archive.grocery_totals(p) if p else None
+                    else:
+                        p = session.get(MealPlan, p.id)
+                        plan_totals = stored_grocery_totals(session, [p.id]).get(p.id) if p else None
+                    if p is None:
+                        st.info("This plan was archived or deleted since the list was loaded.")
+                        continue
+                    with st.expander("Meal and Grocery Plan"):
+                        st.markdown(p.cooking_plan)
+                        if plan_totals:
+                            # Sum the per-recipe totals again so "cups" and "ml" of one ingredient end up in one row
+                            preferences = get_preferences()
+                            totals = aggregate(plan_totals, preferences['liquid_unit'], preferences['mass_unit'])
+                            st.markdown("**Ingredient totals across recipes**")
+                            st.dataframe([{'Ingredient': row['name'], 'Amount': format_quantity(row['quantity'], row['unit']),
+                                           'Recipes': len({recipe_id for recipe_id, _, _ in row['amounts']})}
+                                          for row in totals], hide_index=True)
+                    with st.expander("Cooking Instructions"):
+                        if p.cooking_instruction and p.cooking_instruction.instructions:
+                            st.markdown(p.cooking_instruction.instructions)
+
+    # Page through saved plans
+    if st.session_state.user:
+        col1, col2 = st.columns(2)
+        with col1:
+            if len(st.session_state.plans_page_cursors) > 1 and st.button("Newer plans", key="newer_plans"):
+                st.session_state.plans_page_cursors.pop()
+                st.rerun()
+        with col2:
+            if next_cursor and st.button("Older plans", key="older_plans"):
+                st.session_state.plans_page_cursors.append(next_cursor)
+                st.rerun()
+
+
+# App Navigation
+VIEWS = {
+    "Update Kitchen": kitchen_view,
+    "Update Preferences": preferences_view,
+    "Create Meal & Cooking Plan": meal_plan_view,
+    "View Plans": plans_view,
+}
+if st.session_state.lazy_views:
+    # Only the selected view runs, instead of every tab on every rerun
+    active_view = st.segmented_control("View", list(VIEWS), key='active_view') or next(iter(VIEWS))
+    VIEWS[active_view]()
+else:
+    for tab, view in zip(st.tabs(list(VIEWS)), VIEWS.values()):
+        with tab:
+            view()
+metrics.observe('fprep_script_run_seconds', time.perf_counter() - script_started,
+                lazy_views=st.session_state.lazy_views)
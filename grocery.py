@@ -0,0 +1,242 @@
+import re
+from fractions import Fraction
+
+import numpy as np
+
+# Factor to the base unit of each dimension: millilitres for volume, grams for mass.
+# Plain "oz"/"ounce" is read as mass, "fl oz" as volume.
+VOLUME_UNITS = {
+    'ml': 1.0, 'milliliter': 1.0, 'millilitre': 1.0,
+    'l': 1000.0, 'liter': 1000.0, 'litre': 1000.0,
+    'cup': 236.588, 'c': 236.588,
+    'fl oz': 29.5735, 'fluid ounce': 29.5735,
+    'tbsp': 14.7868, 'tablespoon': 14.7868, 'tsp': 4.92892, 'teaspoon': 4.92892,
+    'pint': 473.176, 'quart': 946.353, 'gallon': 3785.41,
+}
+MASS_UNITS = {
+    'g': 1.0, 'gram': 1.0, 'mg': 0.001, 'milligram': 0.001,
+    'kg': 1000.0, 'kilogram': 1000.0,
+    'lb': 453.592, 'pound': 453.592,
+    'oz': 28.3495, 'ounce': 28.3495,
+}
+VOLUME, MASS, COUNT = 0, 1, 2
+
+# The unit options of the Preferences tab, as (unit name shown, factor from the base unit)
+LIQUID_PREFERENCES = {'ml': ('ml', 1.0), 'liters': ('liters', 1000.0), 'cups': ('cups', 236.588),
+                      'ounces': ('fl oz', 29.5735)}
+MASS_PREFERENCES = {'grams': ('g', 1.0), 'kilograms': ('kg', 1000.0), 'pounds': ('lb', 453.592)}
+
+_UNIT_PATTERN = '|'.join(sorted((re.escape(u) for u in [*VOLUME_UNITS, *MASS_UNITS]), key=len, reverse=True))
+_NUMBER = r'(\d+\s+\d+/\d+|\d+/\d+|\d+(?:\.\d+)?|[½⅓⅔¼¾⅛])'
+_VULGAR = {'½': Fraction(1, 2), '⅓': Fraction(1, 3), '⅔': Fraction(2, 3), '¼': Fraction(1, 4), '¾': Fraction(3, 4),
+           '⅛': Fraction(1, 8)}
+
+
+def _number(text):
+    text = text.strip()
+    if text in _VULGAR:
+        return float(_VULGAR[text])
+    return float(sum(Fraction(part) for part in text.split()))
+
+
+def normalize_unit(unit):
+    """Return (dimension, factor to the base unit, unit key) for a unit as written."""
+    key = (unit or '').strip().lower().rstrip('.')
+    key = re.sub(r'^fluid ounces?$|^fl\.? ?oz\.?$', 'fl oz', key)
+    if key not in VOLUME_UNITS and key not in MASS_UNITS and key.endswith('s'):
+        key = key[:-1]
+    if key in VOLUME_UNITS:
+        return VOLUME, VOLUME_UNITS[key], key
+    if key in MASS_UNITS:
+        return MASS, MASS_UNITS[key], key
+    return COUNT, 1.0, key
+
+
+def normalize_name(name):
+    """Grouping key for an ingredient name: lower case, singular, without notes in brackets."""
+    name = re.sub(r'\(.*?\)', '', name or '').strip().lower()
+    name = re.sub(r'\s+', ' ', name.split(',')[0]).strip()
+    words = name.split(' ')
+    last = words[-1]
+    if last.endswith('ies') and len(last) > 4:
+        last = last[:-3] + 'y'
+    elif last.endswith('oes'):
+        last = last[:-2]
+    elif last.endswith('s') and not last.endswith(('ss', 'us', 'is')) and len(last) > 3:
+        last = last[:-1]
+    return ' '.join(words[:-1] + [last])
+
+
+def parse_amount(text):
+    """Parse "1 1/2 cups" or "200g" into (quantity, unit, rest of the text); quantity is None if absent."""
+    match = re.match(r'\s*' + _NUMBER + r'\s*(?:(' + _UNIT_PATTERN + r')s?\b\.?)?\s*(?:of\s+)?(.*)', text, re.I)
+    if not match:
+        return None, '', text.strip()
+    return _number(match.group(1)), (match.group(2) or '').strip(), match.group(3).strip()
+
+
+def parse_line(line):
+    """Parse an ingredient line like "Mixed greens: 5 cups", "200 g chicken breast" or "milk 300 ml".
+
+    Returns (name, quantity, unit); quantity is None when no amount is given.
+    """
+    line = re.sub(r'^\s*(?:[-*•]|\d+[.)])\s*', '', line).strip()
+    if ':' in line:
+        name, amount = line.split(':', 1)
+        quantity, unit, rest = parse_amount(amount)
+        if quantity is None and unit == '':
+            return name.strip(), None, ''
+        # "Eggs: 14 large" keeps the word after the number as its unit
+        if not unit and rest:
+            unit = rest.split(' ')[0]
+        return name.strip(), quantity, unit
+    quantity, unit, rest = parse_amount(line)
+    if quantity is None:
+        trailing = re.match(r'(.+?)\s+' + _NUMBER + r'\s*(' + _UNIT_PATTERN + r')?s?\.?$', line, re.I)
+        if trailing:
+            return trailing.group(1).strip(), _number(trailing.group(2)), (trailing.group(3) or '').strip()
+    return rest or line, quantity, unit
+
+
+def ingredient_lines_from_plan(plan_text):
+    """(recipe label, ingredient line) pairs from the Ingredients sections of a markdown plan."""
+    recipes_section = re.split(r'\*\*Grocery list\*\*', plan_text or '', flags=re.I)[0]
+    lines, label, in_ingredients = [], None, False
+    for line in recipes_section.splitlines():
+        stripped = line.strip()
+        heading = re.match(r'#{2,4}\s*(.+)', stripped)
+        if heading:
+            label, in_ingredients = heading.group(1).split(':')[0].strip(' *'), False
+        elif re.match(r'[-*]?\s*\**\s*ingredients\b', stripped, re.I):
+            in_ingredients = True
+        elif re.match(r'[-*]?\s*\**\s*(instructions|equipment|steps|cooking method|calories)\b', stripped, re.I):
+            in_ingredients = False
+        elif in_ingredients and re.match(r'(?:[-*•]|\d+[.)])\s+', stripped):
+            lines.append((label or 'plan', stripped))
+    return lines
+
+
+def aggregate(items, liquid_unit='ml', mass_unit='grams'):
+    """Sum ingredient amounts per ingredient across recipes, converting units.
+
+    items are (recipe label, name, quantity, unit) tuples; the label can be any value that tells
+    the recipes apart, such as a Recipe id. All amounts of one ingredient and dimension (volume,
+    mass or count) are converted to the preferred liquid or mass unit and summed in one
+    vectorized pass. Returns a list of dicts with 'key', 'name', 'quantity'
+    (None if no amount could be read), 'unit', 'dimension' and per-recipe 'amounts'.
+    """
+    if not items:
+        return []
+    factors, quantities, group_index = [], [], []
+    groups, keys = {}, []
+    for label, name, quantity, unit in items:
+        dimension, factor, unit_key = normalize_unit(unit)
+        key = (normalize_name(name), dimension, unit_key if dimension == COUNT else '')
+        if key not in groups:
+            groups[key] = {'index': len(keys), 'name': name.strip(), 'unit': unit_key, 'amounts': [],
+                           'has_quantity': False}
+            keys.append(key)
+        group = groups[key]
+        group['amounts'].append((label, quantity, unit))
+        group['has_quantity'] |= quantity is not None
+        factors.append(factor)
+        quantities.append(np.nan if quantity is None else quantity)
+        group_index.append(group['index'])
+
+    quantities = np.array(quantities, dtype=float)
+    base = np.nan_to_num(quantities * np.array(factors))
+    totals = np.bincount(np.array(group_index), weights=base, minlength=len(keys))
+
+    liquid_name, liquid_factor = LIQUID_PREFERENCES.get(liquid_unit, LIQUID_PREFERENCES['ml'])
+    mass_name, mass_factor = MASS_PREFERENCES.get(mass_unit, MASS_PREFERENCES['grams'])
+    target = np.array([liquid_factor if k[1] == VOLUME else mass_factor if k[1] == MASS else 1.0 for k in keys])
+    converted = totals / target
+
+    result = []
+    for i, key in enumerate(keys):
+        group = groups[key]
+        unit = liquid_name if key[1] == VOLUME else mass_name if key[1] == MASS else group['unit']
+        result.append({
+            'key': key[0], 'name': group['name'], 'dimension': key[1], 'unit': unit,
+            'quantity': float(converted[i]) if group['has_quantity'] else None,
+            'amounts': group['amounts'],
+        })
+    return result
+
+
+def format_quantity(quantity, unit):
+    if quantity is None:
+        return 'as needed'
+    rounded = round(quantity, 2) if quantity < 10 else round(quantity, 1) if quantity < 100 else round(quantity)
+    return f"{rounded:g} {unit}".strip()
+
+
+def _existing(existing_ingredients, liquid_unit, mass_unit):
+    """Existing ingredients by grouping key, with the amount on hand if one was written."""
+    items = [('existing', *parse_line(entry)) for entry in (existing_ingredients or '').split(',') if entry.strip()]
+    on_hand = {}
+    for row in aggregate(items, liquid_unit, mass_unit):
+        on_hand.setdefault(row['key'], []).append(row)
+    return on_hand
+
+
+def split_have_and_buy(totals, existing_ingredients, liquid_unit='ml', mass_unit='grams'):
+    """Split aggregated totals into what is already at home and what still has to be bought.
+
+    Existing ingredients match by grouping key only, so "oil" does not cover "olive oil". One
+    without an amount covers the whole need; with an amount in the same dimension and unit, only
+    the rest is left to buy. An amount that cannot be converted to the one needed covers nothing.
+    """
+    on_hand = _existing(existing_ingredients, liquid_unit, mass_unit)
+    have, buy = [], []
+    for row in totals:
+        stocks = on_hand.get(row['key'], [])
+        stock = next((s for s in stocks if s['dimension'] == row['dimension'] and s['quantity'] is not None
+                      and (row['dimension'] != COUNT or s['unit'] == row['unit'])), None)
+        if any(s['quantity'] is None for s in stocks):
+            have.append(row)
+        elif stock is not None and row['quantity'] is None:
+            have.append(row)
+        elif stock is not None:
+            used = min(stock['quantity'], row['quantity'])
+            if used > 0:
+                have.append({**row, 'quantity': used})
+            if row['quantity'] - used > 1e-9:
+                buy.append({**row, 'quantity': row['quantity'] - used})
+        else:
+            buy.append(row)
+    return have, buy
+
+
+def _grocery_line(row):
+    line = f"- {row['name']}: {format_quantity(row['quantity'], row['unit'])}"
+    labels = [label for label, _, _ in row['amounts']]
+    if len(labels) > 1:
+        parts = [f"{format_quantity(q, u) if q is not None else 'some'} for {label.lower()}"
+                 for label, q, u in row['amounts']]
+        line += f" ({', '.join(parts)})"
+    elif labels:
+        line += f" (for {labels[0].lower()})"
+    return line
+
+
+def grocery_list(items, existing_ingredients, liquid_unit='ml', mass_unit='grams'):
+    """Markdown grocery list of (recipe label, name, quantity, unit) items, split in two sections."""
+    have, buy = split_have_and_buy(aggregate(items, liquid_unit, mass_unit), existing_ingredients,
+                                   liquid_unit, mass_unit)
+    return '\n'.join(["1. Ingredients I already have", *([_grocery_line(r) for r in have] or ["- (none)"]), "",
+                      "2. Ingredients I need to buy", *([_grocery_line(r) for r in buy] or ["- (none)"])])
+
+
+def items_from_plan(plan_text):
+    """Grocery items parsed from the ingredient lines of a markdown plan."""
+    return [(label, *parse_line(line)) for label, line in ingredient_lines_from_plan(plan_text)]
+
+
+def with_grocery_list(plan_text, existing_ingredients, liquid_unit='ml', mass_unit='grams'):
+    """Replace the **Grocery list** section of a plan with one computed from its recipes."""
+    recipes_part = re.split(r'\*\*Grocery list\*\*', plan_text or '', flags=re.I)[0].rstrip()
+    items = items_from_plan(recipes_part)
+    if not items:
+        return plan_text
+    return f"{recipes_part}\n\n**Grocery list**\n{grocery_list(items, existing_ingredients, liquid_unit, mass_unit)}"
@@ -0,0 +1,250 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+import zlib
+from collections import namedtuple
+from datetime import datetime
+
+import metrics
+
+# Guest plans live in the server's memory for as long as the browser session does, so each
+# session keeps only its newest plans in memory, with their long texts compressed, and spills
+# the older ones to files under SPILL_DIR/<session id>. A session's files are removed when its
+# store is garbage collected, or once not used for TTL_SECONDS if the server stopped before that.
+MEMORY_PLANS = int(os.environ.get("FPREP_GUEST_MEMORY_PLANS", "3"))
+MAX_PLANS = int(os.environ.get("FPREP_GUEST_MAX_PLANS", "50"))  # the oldest plans beyond this are dropped
+COMPRESS_MIN_BYTES = int(os.environ.get("FPREP_GUEST_COMPRESS_MIN_BYTES", "512"))
+SPILL_DIR = os.environ.get("FPREP_GUEST_SPILL_DIR", os.path.join(tempfile.gettempdir(), "fprep-guest-plans"))
+TTL_SECONDS = float(os.environ.get("FPREP_GUEST_TTL_SECONDS", str(24 * 3600)))
+CLEANUP_INTERVAL_SECONDS = 600
+
+# The long texts of a plan, compressed when larger than COMPRESS_MIN_BYTES
+TEXT_FIELDS = ('cooking_plan', 'cooking_instructions', 'existing_ingredients')
+# Rough size in bytes of an entry besides its texts: the dict, its keys and small values
+ENTRY_OVERHEAD = 600
+
+# What the View Plans list shows of a plan; GuestPlans.plan(seq) reads the rest when it is opened
+GuestPlan = namedtuple('GuestPlan', ['seq', 'name', 'created_at', 'days', 'total_time'])
+
+_stores = weakref.WeakSet()
+_lock = threading.Lock()
+_last_cleanup = 0.0
+
+stats = {'spilled': 0, 'dropped': 0, 'expired_sessions': 0, 'missing': 0}
+
+
+def _pack(text):
+    data = (text or '').encode('utf-8')
+    return zlib.compress(data) if len(data) >= COMPRESS_MIN_BYTES else text
+
+
+def _unpack(value):
+    return zlib.decompress(value).decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _entry_size(entry):
+    return ENTRY_OVERHEAD + sum(len(value or '') for value in entry['texts'].values())
+
+
+def cleanup_expired(now=None):
+    """Remove the spill directories of sessions not used for TTL_SECONDS, except those of the live
+    sessions of this process. Returns how many."""
+    global _last_cleanup
+    now = now or time.time()
+    _last_cleanup = now
+    removed = 0
+    try:
+        directories = os.listdir(SPILL_DIR)
+    except FileNotFoundError:
+        return 0
+    live = {store.directory for store in list(_stores)}
+    for name in directories:
+        path = os.path.join(SPILL_DIR, name)
+        if path in live:
+            continue
+        try:
+            if now - os.path.getmtime(path) > TTL_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        except OSError:
+            continue
+    with _lock:
+        stats['expired_sessions'] += removed
+    return removed
+
+
+class GuestPlans:
+    """The saved plans of one guest session, newest last, with at most MEMORY_PLANS of them in memory."""
+
+    def __init__(self, session_id):
+        self.directory = os.path.join(SPILL_DIR, re.sub(r'[^\w-]', '_', session_id))
+        self._entries = []  # in memory: {'seq', 'name', 'created_at', 'days', 'total_time', 'texts'}
+        self._spilled = []  # on disk: GuestPlan
+        self._spilled_sizes = {}  # seq -> bytes of its file
+        self._next_seq = 0
+        self._lock = threading.Lock()
+        weakref.finalize(self, shutil.rmtree, self.directory, True)
+        _stores.add(self)
+
+    def __len__(self):
+        return len(self._entries) + len(self._spilled)
+
+    def add(self, plan):
+        """Store a plan dict with a name, created_at and its texts."""
+        entry = {'seq': self._next_seq, 'name': plan['name'], 'created_at': plan.get('created_at') or datetime.utcnow(),
+                 'days': plan.get('days'), 'total_time': plan.get('total_time'),
+                 'texts': {field: _pack(plan.get(field)) for field in TEXT_FIELDS}}
+        with self._lock:
+            self._next_seq += 1
+            self._entries.append(entry)
+            while len(self._entries) > MEMORY_PLANS:
+                self._spill(self._entries.pop(0))
+            while len(self) > MAX_PLANS:
+                self._drop_oldest()
+        if time.time() - _last_cleanup > CLEANUP_INTERVAL_SECONDS:
+            cleanup_expired()
+
+    def _path(self, seq):
+        return os.path.join(self.directory, f"{seq:06d}.json.z")
+
+    def _touch(self):
+        """Mark the spill directory as used, so other processes' cleanup_expired keeps it."""
+        if self._spilled:
+            try:
+                os.utime(self.directory)
+            except FileNotFoundError:
+                pass
+
+    def _spill(self, entry):
+        os.makedirs(self.directory, exist_ok=True)
+        record = {**entry, 'created_at': entry['created_at'].isoformat(),
+                  'texts': {field: _unpack(value) for field, value in entry['texts'].items()}}
+        data = zlib.compress(json.dumps(record).encode('utf-8'))
+        with open(self._path(entry['seq']), 'wb') as f:
+            f.write(data)
+        self._spilled.append(GuestPlan(entry['seq'], entry['name'], entry['created_at'], entry['days'],
+                                       entry['total_time']))
+        self._spilled_sizes[entry['seq']] = len(data)
+        with _lock:
+            stats['spilled'] += 1
+
+    def _forget(self, seq):
+        """Drop a spilled plan from the list, e.g. because its file is gone."""
+        self._spilled = [plan for plan in self._spilled if plan.seq != seq]
+        self._spilled_sizes.pop(seq, None)
+
+    def _load(self, seq):
+        """A spilled entry, or None if its file was removed meanwhile; the plan is then dropped."""
+        try:
+            with open(self._path(seq), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._forget(seq)
+            with _lock:
+                stats['missing'] += 1
+            return None
+        record = json.loads(zlib.decompress(data))
+        record['created_at'] = datetime.fromisoformat(record['created_at'])
+        return record
+
+    def _drop_oldest(self):
+        if self._spilled:
+            seq = self._spilled[0].seq
+            self._forget(seq)
+            try:
+                os.remove(self._path(seq))
+            except FileNotFoundError:
+                pass
+        else:
+            self._entries.pop(0)
+        with _lock:
+            stats['dropped'] += 1
+
+    def _plan(self, entry):
+        texts = entry['texts']
+        return {'name': entry['name'], 'created_at': entry['created_at'], 'days': entry['days'],
+                'total_time': entry['total_time'], **{field: _unpack(texts.get(field)) for field in TEXT_FIELDS}}
+
+    def plans(self, name=None, start_date=None, end_date=None):
+        """GuestPlan summaries, newest first, of the plans whose name contains name and that were
+        created between start_date and end_date. No plan text is read or decompressed."""
+        def wanted(plan):
+            return ((not name or name.lower() in plan.name.lower())
+                    and (not start_date or plan.created_at.date() >= start_date)
+                    and (not end_date or plan.created_at.date() <= end_date))
+
+        with self._lock:
+            self._touch()
+            summaries = [GuestPlan(entry['seq'], entry['name'], entry['created_at'], entry['days'],
+                                   entry['total_time']) for entry in self._entries] + self._spilled
+        return sorted(filter(wanted, summaries), key=lambda plan: plan.created_at, reverse=True)
+
+    def plan(self, seq):
+        """The full plan dict of a GuestPlan, or None if it is no longer stored."""
+        with self._lock:
+            self._touch()
+            for entry in self._entries:
+                if entry['seq'] == seq:
+                    return self._plan(entry)
+            if any(plan.seq == seq for plan in self._spilled):
+                entry = self._load(seq)
+                if entry is not None:
+                    return self._plan(entry)
+        return None
+
+    def update(self, name, **values):
+        """Set values (e.g. cooking_instructions) of the newest plan with this name."""
+        with self._lock:
+            for entry in reversed(self._entries):
+                if entry['name'] == name:
+                    for field, value in values.items():
+                        if field in TEXT_FIELDS:
+                            entry['texts'][field] = _pack(value)
+                        else:
+                            entry[field] = value
+                    return True
+            for plan in reversed(self._spilled):
+                if plan.name == name:
+                    entry = self._load(plan.seq)
+                    if entry is None:
+                        return False
+                    entry['texts'] = {field: _pack(value) for field, value in entry['texts'].items()}
+                    entry['texts'].update({f: _pack(v) for f, v in values.items() if f in TEXT_FIELDS})
+                    entry.update({f: v for f, v in values.items() if f not in TEXT_FIELDS})
+                    self._forget(plan.seq)
+                    self._spill(entry)
+                    self._spilled.sort()
+                    return True
+        return False
+
+    def usage(self):
+        """Plans and bytes of this session, in memory and spilled to disk."""
+        with self._lock:
+            return {'plans_in_memory': len(self._entries), 'plans_spilled': len(self._spilled),
+                    'bytes_in_memory': sum(_entry_size(entry) for entry in self._entries),
+                    'bytes_spilled': sum(self._spilled_sizes.values())}
+
+
+def usage():
+    """Guest storage of every live session of this process, summed."""
+    totals = {'sessions': 0, 'plans_in_memory': 0, 'plans_spilled': 0, 'bytes_in_memory': 0, 'bytes_spilled': 0}
+    for store in list(_stores):
+        totals['sessions'] += 1
+        for key, value in store.usage().items():
+            totals[key] += value
+    return totals
+
+
+@metrics.gauge_collector
+def _usage_gauges():
+    totals = usage()
+    return [('fprep_guest_sessions', totals['sessions'], {}),
+            ('fprep_guest_plans', totals['plans_in_memory'], {'storage': 'memory'}),
+            ('fprep_guest_plans', totals['plans_spilled'], {'storage': 'disk'}),
+            ('fprep_guest_bytes', totals['bytes_in_memory'], {'storage': 'memory'}),
+            ('fprep_guest_bytes', totals['bytes_spilled'], {'storage': 'disk'})]
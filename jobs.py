@@ -0,0 +1,271 @@
+import json
+import logging
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, or_, select, update
+
+# Imported for its after_flush listener, which indexes the instructions workers save for search
+import plan_search
+from models import CookingInstruction, GenerationJob, Session
+from grocery import with_grocery_list
+from llm import chat_completion
+from plan_adjustment import adjust_plan
+from recipe_fanout import generate_meal_plan, split_meals
+from scheduler import total_time
+from structured_recipes import InvalidRecipe
+
+logger = logging.getLogger(__name__)
+
+# Generation jobs are rows of generation_jobs. In the default mode they run on a thread pool
+# owned by the server process, so they keep running when the script run that started them is
+# interrupted by a rerun. With FPREP_JOB_QUEUE=1 the app only enqueues them, and separate
+# `python -m worker` processes claim and run them.
+QUEUE_MODE = os.environ.get("FPREP_JOB_QUEUE", "0") == "1"
+WORKERS = int(os.environ.get("FPREP_JOB_WORKERS", "2"))
+POLL_SECONDS = float(os.environ.get("FPREP_JOB_POLL_SECONDS", "1"))
+# A claimed job belongs to its worker until the lease runs out; a running worker renews it,
+# so a job is only picked up again when its worker died.
+LEASE_SECONDS = int(os.environ.get("FPREP_JOB_LEASE_SECONDS", "120"))
+MAX_ATTEMPTS = int(os.environ.get("FPREP_JOB_MAX_ATTEMPTS", "3"))
+RETRY_DELAY_SECONDS = 5  # doubled after every failed attempt
+
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='generation-job')
+
+# Job kind -> function(payload, job) returning the JSON-serializable result
+HANDLERS = {}
+
+
+def handler(kind):
+    def register(function):
+        HANDLERS[kind] = function
+        return function
+    return register
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+
+def submit(kind, payload, user_id=None, meal_plan_id=None):
+    """Store a queued job and, unless an external worker drains the queue, start it here. Returns the job id."""
+    with Session() as session:
+        job = GenerationJob(kind=kind, user_id=user_id, meal_plan_id=meal_plan_id, payload=json.dumps(payload),
+                            attempts=0, max_attempts=MAX_ATTEMPTS, available_at=datetime.utcnow())
+        session.add(job)
+        session.commit()
+        job_id = job.id
+    if not QUEUE_MODE:
+        _executor.submit(_work, job_id)
+    return job_id
+
+
+def _due(now):
+    return or_(GenerationJob.available_at.is_(None), GenerationJob.available_at <= now)
+
+
+def _lease_expired(now):
+    return or_(GenerationJob.lease_until.is_(None), GenerationJob.lease_until < now)
+
+
+def claim(worker, job_id=None):
+    """Atomically take the oldest runnable job, or job_id if it is runnable, and lease it to worker.
+
+    A job is runnable when it is queued and due, or running with an expired lease. The claim is
+    one UPDATE ... RETURNING, so two workers can never take the same job: SQLite serializes the
+    writes, and on databases with row locks the candidate is picked with SKIP LOCKED.
+    Returns the claimed job id or None.
+    """
+    now = datetime.utcnow()
+    runnable = or_(and_(GenerationJob.status == 'queued', _due(now)), and_(GenerationJob.status == 'running',
+                                                                            _lease_expired(now)))
+    candidate = select(GenerationJob.id).where(runnable).order_by(GenerationJob.id).limit(1)
+    if job_id is not None:
+        candidate = candidate.where(GenerationJob.id == job_id)
+    candidate = candidate.with_for_update(skip_locked=True).scalar_subquery()
+    with Session() as session:
+        claimed = session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.id == candidate, runnable)
+            .values(status='running', worker=worker, attempts=func.coalesce(GenerationJob.attempts, 0) + 1,
+                    lease_until=now + timedelta(seconds=LEASE_SECONDS), started_at=now, finished_at=None)
+            .returning(GenerationJob.id)
+        ).scalar()
+        session.commit()
+    return claimed
+
+
+def _renew_lease(job_id, worker, stop):
+    while not stop.wait(LEASE_SECONDS / 3):
+        with Session() as session:
+            session.execute(update(GenerationJob)
+                            .where(GenerationJob.id == job_id, GenerationJob.worker == worker,
+                                   GenerationJob.status == 'running')
+                            .values(lease_until=datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)))
+            session.commit()
+
+
+def _finish(job_id, worker, **values):
+    """Store the outcome of a job, unless its lease expired and another worker took it over."""
+    with Session() as session:
+        finished = session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.id == job_id, GenerationJob.worker == worker, GenerationJob.status == 'running')
+            .values(lease_until=None, **values)
+        ).rowcount
+        session.commit()
+    if not finished:
+        logger.warning("Generation job %s was taken over by another worker; dropping this result", job_id)
+
+
+def execute(job_id, worker):
+    """Run a claimed job and record its result. A failed job is retried later with a growing delay,
+    and moved to the dead-letter status 'dead' after its last attempt."""
+    with Session() as session:
+        job = session.get(GenerationJob, job_id)
+        session.expunge(job)
+    stop = threading.Event()
+    threading.Thread(target=_renew_lease, args=(job_id, worker, stop), daemon=True).start()
+    try:
+        result = HANDLERS[job.kind](json.loads(job.payload), job)
+    except Exception as e:
+        logger.exception("Generation job %s (%s) failed, attempt %s", job_id, job.kind, job.attempts)
+        if job.attempts < (job.max_attempts or MAX_ATTEMPTS):
+            delay = RETRY_DELAY_SECONDS * 2 ** (job.attempts - 1)
+            _finish(job_id, worker, status='queued', error=str(e),
+                    available_at=datetime.utcnow() + timedelta(seconds=delay))
+        else:
+            _finish(job_id, worker, status='dead', error=str(e), finished_at=datetime.utcnow())
+    else:
+        _finish(job_id, worker, status='done', result=json.dumps(result), error=None,
+                finished_at=datetime.utcnow())
+    finally:
+        stop.set()
+
+
+def _work(job_id):
+    """Run one job on this process's executor, and schedule its retry here if it failed."""
+    worker = worker_name()
+    if claim(worker, job_id) is None:
+        return
+    execute(job_id, worker)
+    with Session() as session:
+        job = session.get(GenerationJob, job_id)
+        if job.status == 'queued':
+            _run_later(job_id, job.available_at)
+
+
+def _run_later(job_id, available_at):
+    delay = max(0.0, ((available_at or datetime.utcnow()) - datetime.utcnow()).total_seconds())
+    timer = threading.Timer(delay, _executor.submit, args=(_work, job_id))
+    timer.daemon = True
+    timer.start()
+
+
+def dead_letter_expired():
+    """Move running jobs whose lease expired on their last attempt to 'dead'. Returns how many."""
+    now = datetime.utcnow()
+    with Session() as session:
+        count = session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.status == 'running', _lease_expired(now),
+                   GenerationJob.attempts >= func.coalesce(GenerationJob.max_attempts, MAX_ATTEMPTS))
+            .values(status='dead', error='The worker stopped before finishing the last attempt', finished_at=now)
+        ).rowcount
+        session.commit()
+    return count
+
+
+def requeue(job_id):
+    """Queue a dead job again with a fresh set of attempts."""
+    with Session() as session:
+        session.execute(update(GenerationJob).where(GenerationJob.id == job_id, GenerationJob.status == 'dead')
+                        .values(status='queued', attempts=0, error=None, available_at=datetime.utcnow(),
+                                finished_at=None))
+        session.commit()
+    if not QUEUE_MODE:
+        _executor.submit(_work, job_id)
+
+
+def get(job_id):
+    """State of a job as a dict: status, result, error, attempts and how long it waited and ran, in seconds."""
+    with Session() as session:
+        job = session.get(GenerationJob, job_id)
+        if job is None:
+            return None
+        now = datetime.utcnow()
+        return {
+            'id': job.id, 'kind': job.kind, 'status': job.status, 'attempts': job.attempts or 0,
+            'result': json.loads(job.result) if job.result else None,
+            'error': job.error,
+            'waited': ((job.started_at or now) - job.created_at).total_seconds(),
+            'ran': ((job.finished_at or now) - job.started_at).total_seconds() if job.started_at else 0.0,
+        }
+
+
+def recover():
+    """Start the jobs that are runnable here, e.g. left behind by a previous server process.
+    Run once per process; does nothing in queue mode, where the workers pick them up."""
+    if QUEUE_MODE:
+        return 0
+    dead_letter_expired()
+    now = datetime.utcnow()
+    with Session() as session:
+        pending = session.execute(select(GenerationJob.id, GenerationJob.available_at).where(or_(
+            GenerationJob.status == 'queued',
+            and_(GenerationJob.status == 'running', _lease_expired(now))))).all()
+    for job_id, available_at in pending:
+        _run_later(job_id, available_at)
+    return len(pending)
+
+
+@handler('meal_plan')
+def meal_plan(payload, job):
+    """Generate a meal plan, one concurrent request per meal or as a single request, reusing the
+    saved recipes picked for some meals."""
+    reused = payload.get('reused')
+    if reused or (payload['parallel'] and len(split_meals(payload['meals'])) > 1):
+        try:
+            plan, recipes, timing = generate_meal_plan(
+                payload['plan_name'], payload['meals'], payload['preferences'], payload['days'],
+                payload['existing_ingredients'], payload['kitchen'], use_cache=payload['use_cache'], reused=reused)
+            return {'plan': plan, 'recipes': recipes, 'timing': timing}
+        except InvalidRecipe as e:
+            # Fall back to the free-text plan of a single request
+            logger.warning("%s; generating the plan as a single request instead", e)
+    plan, timing = chat_completion(payload['messages'], 0.1, call_name='meal_plan', use_cache=payload['use_cache'])
+    preferences = payload['preferences']
+    plan = with_grocery_list(plan, payload['existing_ingredients'], preferences['liquid_unit'],
+                             preferences['mass_unit'])
+    return {'plan': plan, 'recipes': None, 'timing': timing}
+
+
+@handler('meal_plan_adjustment')
+def meal_plan_adjustment(payload, job):
+    """Adjust a meal plan as the user asked, regenerating only the recipes the change touches."""
+    plan, timing = adjust_plan(payload['plan'], payload['request'], payload['existing_ingredients'],
+                               payload['preferences'], use_cache=payload['use_cache'])
+    return {'plan': plan, 'recipes': None, 'timing': timing}
+
+
+@handler('cooking_instructions')
+def cooking_instructions(payload, job):
+    """Generate the cooking instructions of a plan and save them to CookingInstruction if the plan is saved."""
+    instructions, timing = chat_completion(payload['messages'], payload['temperature'],
+                                           call_name='cooking_instructions', use_cache=payload.get('use_cache', True))
+    result = {
+        'instructions': instructions,
+        'total_time': total_time(payload['recipes'], payload['kitchen'], instructions),
+        'timing': timing,
+    }
+    if job.meal_plan_id:
+        with Session() as session:
+            # A retried attempt may follow one that saved its row but could not record the result
+            if not session.query(CookingInstruction).filter_by(meal_plan_id=job.meal_plan_id).first():
+                session.add(CookingInstruction(meal_plan_id=job.meal_plan_id, total_time=result['total_time'],
+                                               instructions=instructions))
+                session.commit()
+    return result
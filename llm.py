@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import threading
+import time
+
+import llm_cache
+import llm_client
+import metrics
+import single_flight
+from prompts import count_tokens
+
+logger = logging.getLogger(__name__)
+
+model = 'gpt-4o-mini'
+
+# Sent after a partial answer when a stream is resumed, so the model picks up where it stopped
+CONTINUE_PROMPT = "Continue exactly where you stopped. Do not repeat anything you already wrote."
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def submit_async(coro):
+    """Schedule a coroutine on the process-wide event loop thread and return its concurrent future."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='llm-event-loop', daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _loop)
+
+
+def run_async(coro):
+    """Run a coroutine on the process-wide event loop thread and wait for its result."""
+    return submit_async(coro).result()
+
+
+def _timing(call_name, started, first_token_at, finished, text, cached=False, prompt_estimate=None, usage=None,
+            shared=False):
+    source = 'cache' if cached else 'shared' if shared else 'api'
+    metrics.observe('fprep_llm_call_seconds', finished - started, call=call_name, source=source)
+    if source == 'api':
+        metrics.observe('fprep_llm_first_token_seconds', (first_token_at or finished) - started, call=call_name)
+        if usage:
+            metrics.increment('fprep_llm_prompt_tokens_total', usage.prompt_tokens, call=call_name)
+            metrics.increment('fprep_llm_completion_tokens_total', usage.completion_tokens, call=call_name)
+    return {
+        'call': call_name,
+        'ttft': (first_token_at or finished) - started,
+        'total': finished - started,
+        'chars': len(text),
+        'cached': cached,
+        # The response of an identical request that was already in flight
+        'shared': shared,
+        'prompt_tokens_estimate': prompt_estimate,
+        'prompt_tokens': usage.prompt_tokens if usage else None,
+        'completion_tokens': usage.completion_tokens if usage else None,
+    }
+
+
+@metrics.collector
+def _request_counters():
+    return [
+        *(('fprep_llm_cache_total', llm_cache.stats[name], {'result': name}) for name in ('hits', 'misses', 'bypassed')),
+        ('fprep_llm_requests_total', llm_client.stats['calls'], {}),
+        ('fprep_llm_retries_total', llm_client.stats['retries'], {}),
+        ('fprep_llm_rate_limited_total', llm_client.stats['rate_limited'], {}),
+        ('fprep_llm_hedged_total', llm_client.stats['hedged'], {}),
+        ('fprep_llm_throttled_seconds_total', llm_client.stats['throttled_seconds'], {}),
+        ('fprep_llm_coalesced_total', single_flight.stats['coalesced'], {}),
+    ]
+
+
+def _estimate_prompt(call_name, messages):
+    # Counted before every request that goes out, so oversized prompts show up in the logs
+    estimate = count_tokens(messages, model)
+    logger.info("%s: sending %d messages, about %d prompt tokens", call_name, len(messages), estimate)
+    return estimate
+
+
+def _log_usage(call_name, usage):
+    if usage is None:
+        logger.info("%s: the response reported no token usage", call_name)
+        return
+    logger.info("%s: used %d prompt + %d completion tokens", call_name, usage.prompt_tokens,
+                usage.completion_tokens)
+
+
+def _shared_timing(call_name, started, first_token_at, finished, text, estimate, usage, shared):
+    # The tokens of a shared response were counted for the caller that made the request
+    if shared:
+        return _timing(call_name, started, finished, finished, text, shared=True)
+    return _timing(call_name, started, first_token_at or finished, finished, text, prompt_estimate=estimate,
+                   usage=usage)
+
+
+def _cached_response(key, use_cache):
+    # Bypassing the cache skips the lookup, the fresh response still replaces the cached one
+    if not use_cache:
+        llm_cache.record_bypass()
+        return None
+    return llm_cache.get(key)
+
+
+def _response_format(response_format):
+    # Only sent when set, so plain text requests stay exactly as before
+    return {'response_format': response_format} if response_format else {}
+
+
+def chat_completion(messages, temperature, call_name='chat', use_cache=True, response_format=None):
+    """Run a blocking chat completion and return its text with a timing dict, which also holds
+    the estimated prompt tokens and the prompt and completion tokens the response reported.
+
+    Responses are served from and stored in the persistent response cache unless
+    use_cache is False, and a request identical to one in flight waits for and shares its
+    response. response_format is passed on for structured (JSON schema) output.
+    """
+    started = time.perf_counter()
+    key = llm_cache.cache_key(model, messages, temperature, response_format)
+    text = _cached_response(key, use_cache)
+    if text is not None:
+        finished = time.perf_counter()
+        return text, _timing(call_name, started, finished, finished, text, cached=True)
+
+    def call():
+        estimate = _estimate_prompt(call_name, messages)
+        response = llm_client.create(
+            messages,
+            prompt_tokens=estimate,
+            model=model,
+            temperature=temperature,
+            **_response_format(response_format)
+        )
+        text = response.choices[0].message.content or ''
+        llm_cache.put(key, model, temperature, text)
+        _log_usage(call_name, response.usage)
+        return text, estimate, response.usage
+
+    (text, estimate, usage), shared = single_flight.run(key, call)
+    finished = time.perf_counter()
+    return text, _shared_timing(call_name, started, None, finished, text, estimate, usage, shared)
+
+
+async def async_chat_completion(messages, temperature, call_name='chat', use_cache=True, response_format=None):
+    """Async version of chat_completion, run on the shared async client."""
+    started = time.perf_counter()
+    key = llm_cache.cache_key(model, messages, temperature, response_format)
+    # The cache is a SQLite table, so its reads and writes run off the event loop thread, which
+    # every other async request shares
+    text = await asyncio.to_thread(_cached_response, key, use_cache)
+    if text is not None:
+        finished = time.perf_counter()
+        return text, _timing(call_name, started, finished, finished, text, cached=True)
+
+    async def call():
+        estimate = _estimate_prompt(call_name, messages)
+        response = await llm_client.acreate(
+            messages,
+            prompt_tokens=estimate,
+            model=model,
+            temperature=temperature,
+            **_response_format(response_format)
+        )
+        text = response.choices[0].message.content or ''
+        await asyncio.to_thread(llm_cache.put, key, model, temperature, text)
+        _log_usage(call_name, response.usage)
+        return text, estimate, response.usage
+
+    (text, estimate, usage), shared = await single_flight.run_async(key, call)
+    finished = time.perf_counter()
+    return text, _shared_timing(call_name, started, None, finished, text, estimate, usage, shared)
+
+
+def stream_chat_completion(messages, temperature, on_delta, call_name='chat', prefix='', use_cache=True):
+    """Stream a chat completion, calling on_delta(text_so_far) for every chunk of content.
+
+    The text starts from prefix (the partial answer of an interrupted stream) and grows as
+    tokens arrive. Returns the full text with a timing dict holding time-to-first-token
+    ('ttft') and total time in seconds, and the token usage like chat_completion. A cached
+    response is delivered as a single chunk.
+    """
+    started = time.perf_counter()
+    key = llm_cache.cache_key(model, messages, temperature)
+    cached = _cached_response(key, use_cache)
+    if cached is not None:
+        text = prefix + cached
+        on_delta(text)
+        finished = time.perf_counter()
+        return text, _timing(call_name, started, finished, finished, text, cached=True)
+
+    first_token_at = None
+
+    def call():
+        nonlocal first_token_at
+        text = prefix
+        usage = None
+        estimate = _estimate_prompt(call_name, messages)
+        stream = llm_client.stream(
+            messages,
+            prompt_tokens=estimate,
+            model=model,
+            temperature=temperature,
+            # The last chunk then carries the token usage of the whole response
+            stream_options={'include_usage': True}
+        )
+        for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            text += delta
+            on_delta(text)
+        llm_cache.put(key, model, temperature, text[len(prefix):])
+        _log_usage(call_name, usage)
+        return text[len(prefix):], estimate, usage
+
+    # A caller sharing another's stream gets the whole answer as a single chunk, like a cached one
+    (answer, estimate, usage), shared = single_flight.run(key, call)
+    text = prefix + answer
+    if shared:
+        on_delta(text)
+    finished = time.perf_counter()
+    return text, _shared_timing(call_name, started, first_token_at, finished, text, estimate, usage, shared)
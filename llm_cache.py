@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select
+
+from models import LLMCacheEntry, Session
+
+# Entries unused for longer than the TTL are dropped, and the least recently used entries
+# are evicted once the table holds more than MAX_ENTRIES rows or MAX_BYTES of responses.
+CACHE_TTL = timedelta(days=float(os.environ.get("FPREP_LLM_CACHE_TTL_DAYS", 30)))
+MAX_ENTRIES = int(os.environ.get("FPREP_LLM_CACHE_MAX_ENTRIES", 1000))
+MAX_BYTES = int(os.environ.get("FPREP_LLM_CACHE_MAX_BYTES", 50 * 1024 * 1024))
+
+# Process-wide counters, shown in the sidebar
+stats = {'hits': 0, 'misses': 0, 'bypassed': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        stats[name] += 1
+
+
+def _normalize(text):
+    # Prompts are indented f-strings, so whitespace differences must not change the key
+    return re.sub(r'\s+', ' ', text or '').strip()
+
+
+def cache_key(model, messages, temperature, response_format=None):
+    """Return the content address of a chat completion request."""
+    payload = {
+        'model': model,
+        'messages': [{'role': m['role'], 'content': _normalize(m['content'])} for m in messages],
+        'temperature': float(temperature),
+    }
+    if response_format:
+        payload['response_format'] = response_format
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get(key):
+    """Return the cached response for key, or None on a miss or an expired entry."""
+    with Session() as session:
+        entry = session.get(LLMCacheEntry, key)
+        if entry is None or entry.last_used_at < datetime.utcnow() - CACHE_TTL:
+            if entry is not None:
+                session.delete(entry)
+                session.commit()
+            _count('misses')
+            return None
+        entry.hits = (entry.hits or 0) + 1
+        entry.last_used_at = datetime.utcnow()
+        response = entry.response
+        session.commit()
+    _count('hits')
+    return response
+
+
+def put(key, model, temperature, response):
+    """Store a response and evict expired and least recently used entries over the caps."""
+    with Session() as session:
+        entry = session.get(LLMCacheEntry, key) or LLMCacheEntry(key=key)
+        entry.model = model
+        entry.temperature = float(temperature)
+        entry.response = response
+        entry.size = len(response.encode('utf-8'))
+        entry.last_used_at = datetime.utcnow()
+        session.add(entry)
+        session.flush()
+        _evict(session)
+        session.commit()
+
+
+def _evict(session):
+    session.execute(delete(LLMCacheEntry).where(LLMCacheEntry.last_used_at < datetime.utcnow() - CACHE_TTL))
+    count, total_size = session.execute(select(func.count(), func.coalesce(func.sum(LLMCacheEntry.size), 0))).one()
+    if count <= MAX_ENTRIES and total_size <= MAX_BYTES:
+        return
+    kept, kept_size, evicted = 0, 0, []
+    rows = session.execute(select(LLMCacheEntry.key, LLMCacheEntry.size)
+                           .order_by(LLMCacheEntry.last_used_at.desc()))
+    for key, size in rows:
+        if kept < MAX_ENTRIES and kept_size + (size or 0) <= MAX_BYTES:
+            kept += 1
+            kept_size += size or 0
+        else:
+            evicted.append(key)
+    if evicted:
+        session.execute(delete(LLMCacheEntry).where(LLMCacheEntry.key.in_(evicted)))
+
+
+def record_bypass():
+    _count('bypassed')
+
+
+def entry_count():
+    with Session() as session:
+        return session.scalar(select(func.count()).select_from(LLMCacheEntry))
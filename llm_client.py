@@ -0,0 +1,377 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import httpx
+import openai
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, OpenAI
+
+from prompts import count_tokens
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# All sessions of the server process share these limits. The defaults are below the provider's
+# lowest paid tier; raise them to the organisation's limits.
+REQUESTS_PER_MINUTE = int(os.environ.get("FPREP_LLM_RPM", "500"))
+TOKENS_PER_MINUTE = int(os.environ.get("FPREP_LLM_TPM", "200000"))
+# Tokens held for the answer until the response reports how many it used
+COMPLETION_ALLOWANCE = int(os.environ.get("FPREP_LLM_COMPLETION_ALLOWANCE", "1000"))
+# A call, including its retries and the wait for rate limit capacity, fails after this many seconds
+DEADLINE_SECONDS = float(os.environ.get("FPREP_LLM_DEADLINE_SECONDS", "120"))
+CONNECT_TIMEOUT_SECONDS = 10.0
+MAX_RETRIES = int(os.environ.get("FPREP_LLM_MAX_RETRIES", "4"))
+BACKOFF_BASE_SECONDS, BACKOFF_CAP_SECONDS = 0.5, 30.0
+# A non-streaming call still running after this many seconds is sent a second time, and the first
+# answer wins. 0 turns hedging off.
+HEDGE_AFTER_SECONDS = float(os.environ.get("FPREP_LLM_HEDGE_AFTER_SECONDS", "0"))
+MAX_CONNECTIONS = int(os.environ.get("FPREP_LLM_MAX_CONNECTIONS", "20"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("FPREP_LLM_MAX_KEEPALIVE_CONNECTIONS", "10"))
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class TokenBucket:
+    """A bucket refilled at per_minute tokens a minute, holding at most a minute's worth.
+
+    reserve() takes the tokens right away, going into debt if the bucket is short, and returns
+    how many seconds the caller has to wait before using them. So callers are served in the
+    order they asked, and a burst is spread out instead of rejected. A limit of 0 or less means
+    unlimited.
+    """
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            self._refill()
+            # A request larger than the bucket waits for a full bucket rather than forever
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def give_back(self, amount):
+        """Return unused tokens, or take more with a negative amount."""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+requests_bucket = TokenBucket(REQUESTS_PER_MINUTE)
+tokens_bucket = TokenBucket(TOKENS_PER_MINUTE)
+
+# Process-wide counters, shown in the sidebar
+stats = {'calls': 0, 'retries': 0, 'rate_limited': 0, 'hedged': 0, 'hedge_wins': 0, 'throttled_seconds': 0.0}
+_stats_lock = threading.Lock()
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        stats[name] += amount
+
+
+_limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS)
+_timeout = httpx.Timeout(DEADLINE_SECONDS, connect=CONNECT_TIMEOUT_SECONDS)
+# Retries are done here, against the shared rate limits, so the SDK's own retries are off.
+# OPENAI_BASE_URL points the clients at another OpenAI-compatible server, e.g. a local fake.
+client = OpenAI(
+    api_key=os.environ.get("OPENAI_API_KEY"),
+    base_url=os.environ.get("OPENAI_BASE_URL"),
+    max_retries=0,
+    timeout=_timeout,
+    http_client=openai.DefaultHttpxClient(limits=_limits, timeout=_timeout),
+)
+# Used to fan out independent requests concurrently, e.g. one recipe per meal. Its connection
+# pool is bound to one event loop, so all async calls run on the loop owned by llm.py.
+async_client = AsyncOpenAI(
+    api_key=os.environ.get("OPENAI_API_KEY"),
+    base_url=os.environ.get("OPENAI_BASE_URL"),
+    max_retries=0,
+    timeout=_timeout,
+    http_client=openai.DefaultAsyncHttpxClient(limits=_limits, timeout=_timeout),
+)
+_hedge_executor = ThreadPoolExecutor(max_workers=MAX_CONNECTIONS, thread_name_prefix='llm-hedge')
+
+
+def _remaining(deadline):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("The AI did not answer in time. Please try again.")
+    return remaining
+
+
+def _reserve(tokens, deadline, wait_allowed=True):
+    """Take one request and tokens from the buckets. Returns the seconds to wait, or None if
+    that wait would pass the deadline (or any wait when wait_allowed is False)."""
+    delay = max(requests_bucket.reserve(1), tokens_bucket.reserve(tokens))
+    if delay > 0 and (not wait_allowed or time.monotonic() + delay >= deadline):
+        _release(tokens)
+        return None
+    return delay
+
+
+def _release(tokens):
+    """Give back the request and tokens of a reservation no request was sent for."""
+    requests_bucket.give_back(1)
+    tokens_bucket.give_back(tokens)
+
+
+def _capacity_delay(tokens, deadline):
+    delay = _reserve(tokens, deadline)
+    if delay is None:
+        raise DeadlineExceeded("Too many AI requests are queued right now. Please try again in a minute.")
+    if delay:
+        _count('throttled_seconds', delay)
+    return delay
+
+
+def _tokens(messages, prompt_tokens, kwargs):
+    # Tokens to reserve: the prompt, counted here unless the caller already did, and the answer's allowance
+    if prompt_tokens is None:
+        prompt_tokens = count_tokens(messages, kwargs.get('model', 'gpt-4o-mini'))
+    return prompt_tokens + COMPLETION_ALLOWANCE
+
+
+def _settle(reserved, usage):
+    # Charge what the response actually used instead of the estimate
+    if usage is not None:
+        tokens_bucket.give_back(reserved - usage.prompt_tokens - usage.completion_tokens)
+
+
+def _settle_loser(future, tokens, sent=None):
+    """Settle the second reservation of a hedged pair with the call whose response was not returned,
+    once it finishes: what it used, or its tokens back if it failed or was cancelled. Its request
+    is only given back if it was never sent: sent() is False, or by default, if it was cancelled
+    before it started."""
+    def settle(future):
+        if future.cancelled() or future.exception() is not None:
+            if sent() if sent else not future.cancelled():
+                tokens_bucket.give_back(tokens)
+            else:
+                _release(tokens)
+        else:
+            _settle(tokens, future.result().usage)
+
+    future.add_done_callback(settle)
+
+
+def retry_after(error):
+    """Seconds the server asked to wait before retrying, from its Retry-After headers, or None."""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    if response.headers.get('retry-after-ms'):
+        try:
+            return float(response.headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+
+def backoff(attempt, error):
+    """Delay before retry number attempt + 1: what Retry-After asks for, otherwise exponential with full jitter."""
+    asked = retry_after(error)
+    if asked is not None:
+        # A little jitter on top, so the callers that were told the same time do not return together
+        return asked + random.uniform(0, BACKOFF_BASE_SECONDS)
+    return random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def _retry_delay(attempt, error, deadline):
+    """Delay before the next attempt after a failed one, or None if the error should be raised."""
+    if not isinstance(error, RETRYABLE_ERRORS) or attempt >= MAX_RETRIES:
+        return None
+    if isinstance(error, openai.RateLimitError):
+        _count('rate_limited')
+    delay = backoff(attempt, error)
+    if time.monotonic() + delay >= deadline:
+        return None
+    _count('retries')
+    logger.warning("AI request failed (%s), retrying in %.1f s", error.__class__.__name__, delay)
+    return delay
+
+
+def _hedged(call, tokens, deadline):
+    """Run call(timeout); if it is slow and there is spare capacity, race a second identical call."""
+    if HEDGE_AFTER_SECONDS <= 0:
+        return call(_remaining(deadline))
+    first = _hedge_executor.submit(call, _remaining(deadline))
+    done, _ = wait([first], timeout=min(HEDGE_AFTER_SECONDS, _remaining(deadline)))
+    if done or _reserve(tokens, deadline, wait_allowed=False) is None:
+        return first.result(timeout=_remaining(deadline))
+    _count('hedged')
+    second = _hedge_executor.submit(call, _remaining(deadline))
+    pending, error, winner = {first, second}, None, None
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=_remaining(deadline), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        _count('hedge_wins')
+                    winner = future
+                    # The slower call still finishes in the background
+                    return future.result()
+                error = future.exception()
+            if not done:
+                raise DeadlineExceeded("The AI did not answer in time. Please try again.")
+        raise error
+    finally:
+        # The caller settles one reservation with the returned response (or gives it back on an error)
+        _settle_loser(first if winner is second else second, tokens)
+
+
+def create(messages, deadline_seconds=None, prompt_tokens=None, **kwargs):
+    """chat.completions.create on the shared client, within the process-wide rate limits.
+
+    Waits for capacity in the requests and tokens per minute buckets, retries rate limits,
+    timeouts, connection and server errors with backoff, and raises DeadlineExceeded when the
+    whole call takes longer than deadline_seconds (DEADLINE_SECONDS by default). Slow calls are
+    hedged when HEDGE_AFTER_SECONDS is set. prompt_tokens is the prompt size if already counted.
+    """
+    deadline = time.monotonic() + (deadline_seconds or DEADLINE_SECONDS)
+    tokens = _tokens(messages, prompt_tokens, kwargs)
+    _count('calls')
+    attempt = 0
+    while True:
+        time.sleep(_capacity_delay(tokens, deadline))
+        try:
+            response = _hedged(lambda timeout: client.chat.completions.create(messages=messages, timeout=timeout,
+                                                                              **kwargs), tokens, deadline)
+        except Exception as e:
+            # The request reached the provider, or may have, so it still counts against the requests per minute
+            tokens_bucket.give_back(tokens)
+            delay = _retry_delay(attempt, e, deadline)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+            continue
+        _settle(tokens, response.usage)
+        return response
+
+
+async def _async_hedged(call, tokens, deadline):
+    first = asyncio.ensure_future(call(_remaining(deadline)))
+    if HEDGE_AFTER_SECONDS <= 0:
+        return await first
+    done, _ = await asyncio.wait([first], timeout=min(HEDGE_AFTER_SECONDS, _remaining(deadline)))
+    if done or _reserve(tokens, deadline, wait_allowed=False) is None:
+        return await asyncio.wait_for(first, _remaining(deadline))
+    _count('hedged')
+    started = []
+
+    async def hedge(timeout):
+        started.append(True)
+        return await call(timeout)
+
+    second = asyncio.ensure_future(hedge(_remaining(deadline)))
+    pending, error, winner = {first, second}, None, None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=_remaining(deadline), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        _count('hedge_wins')
+                    winner = task
+                    return task.result()
+                error = task.exception()
+            if not done:
+                raise DeadlineExceeded("The AI did not answer in time. Please try again.")
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+        # The caller settles one reservation with the returned response (or gives it back on an error)
+        loser = first if winner is second else second
+        _settle_loser(loser, tokens, sent=lambda: loser is first or bool(started))
+
+
+async def acreate(messages, deadline_seconds=None, prompt_tokens=None, **kwargs):
+    """Async version of create, on the shared async client; a losing hedged call is cancelled."""
+    deadline = time.monotonic() + (deadline_seconds or DEADLINE_SECONDS)
+    tokens = _tokens(messages, prompt_tokens, kwargs)
+    _count('calls')
+    attempt = 0
+    while True:
+        await asyncio.sleep(_capacity_delay(tokens, deadline))
+        try:
+            response = await _async_hedged(lambda timeout: async_client.chat.completions.create(
+                messages=messages, timeout=timeout, **kwargs), tokens, deadline)
+        except Exception as e:
+            tokens_bucket.give_back(tokens)
+            delay = _retry_delay(attempt, e, deadline)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        _settle(tokens, response.usage)
+        return response
+
+
+def _settled_stream(chunks, tokens):
+    usage = None
+    try:
+        for chunk in chunks:
+            usage = chunk.usage or usage
+            yield chunk
+    finally:
+        _settle(tokens, usage)
+
+
+def stream(messages, deadline_seconds=None, prompt_tokens=None, **kwargs):
+    """Streaming create within the rate limits. The deadline and retries cover the call until the
+    response starts; after that each chunk has to arrive within the read timeout."""
+    deadline = time.monotonic() + (deadline_seconds or DEADLINE_SECONDS)
+    tokens = _tokens(messages, prompt_tokens, kwargs)
+    _count('calls')
+    attempt = 0
+    while True:
+        time.sleep(_capacity_delay(tokens, deadline))
+        try:
+            chunks = client.chat.completions.create(messages=messages, stream=True, timeout=_remaining(deadline),
+                                                    **kwargs)
+        except Exception as e:
+            tokens_bucket.give_back(tokens)
+            delay = _retry_delay(attempt, e, deadline)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+            continue
+        return _settled_stream(chunks, tokens)
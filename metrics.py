@@ -0,0 +1,232 @@
+import functools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Prometheus text is served on this port (e.g. 9464) and/or written to this file every
+# EXPORT_INTERVAL seconds; both are off unless set.
+HTTP_HOST = os.environ.get("FPREP_METRICS_HOST", "127.0.0.1")
+HTTP_PORT = int(os.environ.get("FPREP_METRICS_PORT", "0"))
+EXPORT_FILE = os.environ.get("FPREP_METRICS_FILE")
+EXPORT_INTERVAL = float(os.environ.get("FPREP_METRICS_INTERVAL_SECONDS", "15"))
+# Percentiles are computed over the most recent observations of each series
+WINDOW = int(os.environ.get("FPREP_METRICS_WINDOW", "2048"))
+QUANTILES = (0.5, 0.95, 0.99)
+# Users who see the debug panel, as comma-separated emails
+ADMIN_EMAILS = {email.strip().lower() for email in os.environ.get("FPREP_ADMIN_EMAILS", "").split(',')
+                if email.strip()}
+
+# (name, sorted label items) -> recent values, with count and sum over the process lifetime
+_histograms = {}
+_counters = {}
+# Functions returning (name, value, labels) tuples of counters kept by other modules, and of
+# gauges, values that also go down such as memory in use
+_collectors = []
+_gauge_collectors = []
+_lock = threading.Lock()
+_started = False
+
+HELP = {
+    'fprep_llm_call_seconds': "Duration of AI calls by call type and whether the answer came from the API, the cache or a shared call",
+    'fprep_llm_first_token_seconds': "Time to the first token of AI calls answered by the API",
+    'fprep_db_commit_seconds': "Duration of database commits",
+    'fprep_plan_list_seconds': "Duration of loading a page of saved plans",
+    'fprep_script_run_seconds': "Duration of full Streamlit script runs",
+    'fprep_view_run_seconds': "Duration of view runs, including fragment reruns",
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def observe(name, value, **labels):
+    """Record one observation, e.g. a duration in seconds, of the series name{labels}."""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'values': deque(maxlen=WINDOW), 'count': 0, 'sum': 0.0}
+        histogram['values'].append(value)
+        histogram['count'] += 1
+        histogram['sum'] += value
+
+
+def increment(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe how long the with block took, also when it raised (st.rerun() raises too)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def timed(name, **labels):
+    """Decorator version of timer."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def collector(function):
+    """Register a function returning (name, value, labels) counters to export with the others."""
+    _collectors.append(function)
+    return function
+
+
+def gauge_collector(function):
+    """Register a function returning (name, value, labels) gauges to export with the other metrics."""
+    _gauge_collectors.append(function)
+    return function
+
+
+def instrument_sessions(session_class):
+    """Time every commit of sessions made by session_class."""
+    from sqlalchemy import event
+
+    @event.listens_for(session_class, 'before_commit')
+    def _commit_started(session):
+        session.info['commit_started'] = time.perf_counter()
+
+    @event.listens_for(session_class, 'after_commit')
+    def _committed(session):
+        started = session.info.pop('commit_started', None)
+        if started is not None:
+            observe('fprep_db_commit_seconds', time.perf_counter() - started)
+
+
+def summaries():
+    """Every histogram as a dict with 'name', 'labels', 'count', 'sum' and the p50, p95 and p99 of its window."""
+    with _lock:
+        snapshot = [(key, list(h['values']), h['count'], h['sum']) for key, h in _histograms.items()]
+    rows = []
+    for (name, labels), values, count, total in sorted(snapshot):
+        percentiles = np.percentile(values, [q * 100 for q in QUANTILES]) if values else [float('nan')] * 3
+        rows.append({'name': name, 'labels': dict(labels), 'count': count, 'sum': total,
+                     **{f"p{round(q * 100)}": float(p) for q, p in zip(QUANTILES, percentiles)}})
+    return rows
+
+
+def counters():
+    """Every counter, own and collected, as (name, value, labels) tuples."""
+    with _lock:
+        rows = [(name, value, dict(labels)) for (name, labels), value in sorted(_counters.items())]
+    return rows + _collect(_collectors)
+
+
+def gauges():
+    """Every collected gauge as (name, value, labels) tuples."""
+    return _collect(_gauge_collectors)
+
+
+def _collect(functions):
+    rows = []
+    for function in functions:
+        try:
+            rows.extend(function())
+        except Exception:
+            logger.exception("Metrics collector %s failed", function.__name__)
+    return rows
+
+
+def _labels(labels, **extra):
+    items = {**labels, **extra}
+    if not items:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in items.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(items, escaped)) + '}'
+
+
+def render():
+    """All metrics in the Prometheus text exposition format; histograms are exported as summaries."""
+    lines, typed = [], set()
+    for row in summaries():
+        name = row['name']
+        if name not in typed:
+            typed.add(name)
+            if name in HELP:
+                lines.append(f"# HELP {name} {HELP[name]}")
+            lines.append(f"# TYPE {name} summary")
+        for q in QUANTILES:
+            lines.append(f"{name}{_labels(row['labels'], quantile=q)} {row[f'p{round(q * 100)}']:.6g}")
+        lines.append(f"{name}_sum{_labels(row['labels'])} {row['sum']:.6g}")
+        lines.append(f"{name}_count{_labels(row['labels'])} {row['count']}")
+    for kind, rows in (('counter', counters()), ('gauge', gauges())):
+        for name, value, labels in rows:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name}{_labels(labels)} {value:.6g}")
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def write_file(path):
+    # Written next to the target and renamed, so a scraper never reads half a file
+    temporary = f"{path}.tmp"
+    with open(temporary, 'w', encoding='utf-8') as f:
+        f.write(render())
+    os.replace(temporary, path)
+
+
+def _export_periodically(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_file(path)
+        except OSError:
+            logger.exception("Could not write metrics to %s", path)
+
+
+def start():
+    """Start the /metrics endpoint and the file export that are configured. Run once per process."""
+    global _started
+    with _lock:
+        if _started:
+            return
+        _started = True
+    if HTTP_PORT:
+        server = ThreadingHTTPServer((HTTP_HOST, HTTP_PORT), _Handler)
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        logger.info("Serving metrics on http://%s:%s/metrics", HTTP_HOST, HTTP_PORT)
+    if EXPORT_FILE:
+        threading.Thread(target=_export_periodically, args=(EXPORT_FILE, EXPORT_INTERVAL), name='metrics-file',
+                         daemon=True).start()
+
+
+def is_admin(email):
+    return bool(email) and email.lower() in ADMIN_EMAILS
@@ -0,0 +1,274 @@
+from sqlalchemy import create_engine, event, inspect, text, Index, Column, Integer, String, ForeignKey, Text, DateTime, Float, Boolean, LargeBinary
+from sqlalchemy.orm import declarative_base, deferred, relationship, sessionmaker
+from sqlalchemy.types import TypeDecorator
+from datetime import datetime
+import os
+import zlib
+
+DATABASE_URL = os.environ.get("FPREP_DATABASE_URL", "sqlite:///cooking_app.db")
+# How long a SQLite writer waits for a lock held by another connection, and the connection pool size
+BUSY_TIMEOUT_MS = int(os.environ.get("FPREP_DB_BUSY_TIMEOUT_MS", "5000"))
+POOL_SIZE = int(os.environ.get("FPREP_DB_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.environ.get("FPREP_DB_MAX_OVERFLOW", "10"))
+# CompressedText values shorter than this many bytes are stored uncompressed
+COMPRESS_MIN_BYTES = int(os.environ.get("FPREP_DB_COMPRESS_MIN_BYTES", "256"))
+
+Base = declarative_base()
+
+
+class CompressedText(TypeDecorator):
+    """Text stored as bytes behind a 4-byte header: b"FPZ" and a format version, 0 for UTF-8 and
+    1 for zlib-compressed UTF-8. Values written before the column was compressed (plain text,
+    or UTF-8 bytes without the header) are read as they are; compress_text.py converts them.
+
+    Columns of this type are deferred, so they are only read, and decompressed, when accessed.
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    MAGIC = b'FPZ'
+    PLAIN, ZLIB = 0, 1
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        data = value.encode('utf-8')
+        if len(data) < COMPRESS_MIN_BYTES:
+            return self.MAGIC + bytes([self.PLAIN]) + data
+        return self.MAGIC + bytes([self.ZLIB]) + zlib.compress(data)
+
+    def process_result_value(self, value, dialect):
+        return self.decode(value)
+
+    @classmethod
+    def decode(cls, value):
+        """The text of a value as stored, in any of the formats above."""
+        if value is None or isinstance(value, str):
+            return value
+        value = bytes(value)
+        if not value.startswith(cls.MAGIC):
+            return value.decode('utf-8')
+        version, data = value[len(cls.MAGIC)], value[len(cls.MAGIC) + 1:]
+        if version == cls.ZLIB:
+            data = zlib.decompress(data)
+        elif version != cls.PLAIN:
+            raise ValueError(f"Unknown CompressedText format version {version}")
+        return data.decode('utf-8')
+
+    @classmethod
+    def is_current(cls, value):
+        """Whether a value read without this type, as stored, is already in the headered format."""
+        return isinstance(value, (bytes, memoryview)) and bytes(value[:len(cls.MAGIC)]) == cls.MAGIC
+
+
+class User(Base):
+    __tablename__ = 'users'
+
+    id = Column(Integer, primary_key=True)
+    email = Column(String, unique=True, nullable=False)
+    google_id = Column(String, unique=True)
+    name = Column(String)
+
+    kitchen = relationship("Kitchen", back_populates="user", uselist=False, cascade="all, delete")
+    preference = relationship("Preference", back_populates="user", uselist=False, cascade="all, delete")
+    meal_plans = relationship("MealPlan", back_populates="user", cascade="all, delete")
+
+
+class Kitchen(Base):
+    __tablename__ = 'kitchens'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    stove_burner = Column(Integer)
+    oven_rack = Column(Integer)
+    sous_vide_bag = Column(Integer)
+    large_pan = Column(Integer)
+    medium_pan = Column(Integer)
+    small_pan = Column(Integer)
+    large_pot = Column(Integer)
+    medium_pot = Column(Integer)
+    small_pot = Column(Integer)
+    food_processor = Column(Integer)
+    blender_cup = Column(Integer)
+    crock_pot = Column(Integer)
+    rice_cooker = Column(Integer)
+    thermometer = Column(Integer)
+    user = relationship("User", back_populates="kitchen")
+
+
+class Preference(Base):
+    __tablename__ = 'preferences'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    style = Column(String)
+    calories = Column(Integer)
+    macro_protein = Column(Integer)
+    macro_fat = Column(Integer)
+    macro_carbs = Column(Integer)
+    additional_preference = Column(Text)
+    temp_unit = Column(String)
+    liquid_unit = Column(String)
+    mass_unit = Column(String)
+    user = relationship("User", back_populates="preference")
+
+
+class MealPlan(Base):
+    __tablename__ = 'meal_plans'
+    # Serves the View Plans tab: newest plans of one user first, paged by (created_at, id)
+    __table_args__ = (Index('ix_meal_plans_user_created_id', 'user_id', 'created_at', 'id'),)
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    name = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # The large texts are deferred, so listing plans never reads them
+    cooking_plan = deferred(Column(CompressedText))
+    days = Column(Integer)
+    existing_ingredients = deferred(Column(CompressedText))
+    style = Column(String)  # the cooking style of the preferences it was generated with
+    user = relationship("User", back_populates="meal_plans")
+    recipes = relationship("Recipe", back_populates="meal_plan", cascade="all, delete")
+    cooking_instruction = relationship("CookingInstruction", back_populates="meal_plan", uselist=False, cascade="all, delete")
+
+class Recipe(Base):
+    __tablename__ = 'recipes'
+    id = Column(Integer, primary_key=True)
+    meal_plan_id = Column(Integer, ForeignKey('meal_plans.id'), index=True)
+    name = Column(String)
+    ingredients = Column(Text)
+    instructions = deferred(Column(CompressedText))
+    meal_plan = relationship("MealPlan", back_populates="recipes")
+    ingredient_lines = relationship("RecipeIngredient", back_populates="recipe", cascade="all, delete",
+                                    order_by="RecipeIngredient.id")
+    steps = relationship("RecipeStep", back_populates="recipe", cascade="all, delete",
+                         order_by="RecipeStep.position")
+
+class RecipeIngredient(Base):
+    __tablename__ = 'recipe_ingredients'
+    id = Column(Integer, primary_key=True)
+    recipe_id = Column(Integer, ForeignKey('recipes.id'))
+    meal_plan_id = Column(Integer, ForeignKey('meal_plans.id'), index=True)
+    name = Column(String, index=True)  # lower case, so grocery lists can group on it
+    quantity = Column(Float)
+    unit = Column(String)
+    recipe = relationship("Recipe", back_populates="ingredient_lines")
+    meal_plan = relationship("MealPlan")
+
+class RecipeStep(Base):
+    __tablename__ = 'recipe_steps'
+    id = Column(Integer, primary_key=True)
+    recipe_id = Column(Integer, ForeignKey('recipes.id'))
+    meal_plan_id = Column(Integer, ForeignKey('meal_plans.id'), index=True)
+    position = Column(Integer)
+    description = Column(Text)
+    duration_minutes = Column(Float)
+    equipment = Column(String)  # comma-separated Kitchen columns
+    hands_on = Column(Boolean)
+    recipe = relationship("Recipe", back_populates="steps")
+    meal_plan = relationship("MealPlan")
+
+class CookingInstruction(Base):
+    __tablename__ = 'cooking_instructions'
+    id = Column(Integer, primary_key=True)
+    meal_plan_id = Column(Integer, ForeignKey('meal_plans.id'), index=True)
+    total_time = Column(String)
+    instructions = deferred(Column(CompressedText))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    meal_plan = relationship("MealPlan", back_populates="cooking_instruction")
+
+class LLMCacheEntry(Base):
+    __tablename__ = 'llm_cache'
+    key = Column(String, primary_key=True)  # sha256 of the normalized model, messages and temperature
+    model = Column(String)
+    temperature = Column(Float)
+    response = Column(Text)
+    size = Column(Integer)
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class GenerationJob(Base):
+    __tablename__ = 'generation_jobs'
+    # Serves the claim query of jobs.claim: the oldest due job of a status
+    __table_args__ = (Index('ix_generation_jobs_claim', 'status', 'available_at', 'id'),)
+    id = Column(Integer, primary_key=True)
+    kind = Column(String)  # name of the jobs.HANDLERS entry that runs it
+    status = Column(String, default='queued', index=True)  # queued, running, done or dead
+    user_id = Column(Integer, ForeignKey('users.id'))
+    meal_plan_id = Column(Integer, ForeignKey('meal_plans.id'))
+    payload = Column(Text)  # JSON
+    result = Column(Text)  # JSON
+    error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer)
+    available_at = Column(DateTime, default=datetime.utcnow)  # not retried before this time
+    lease_until = Column(DateTime)  # the claiming worker owns the job until then
+    worker = Column(String)
+
+
+def make_engine(url=DATABASE_URL):
+    """Create the engine once per process; sessions are opened per script run from Session.
+
+    File-backed SQLite runs in WAL mode, so readers never wait for a writer and a writer waits
+    up to BUSY_TIMEOUT_MS for another writer instead of failing with "database is locked".
+    """
+    if not url.startswith("sqlite"):
+        return create_engine(url, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW, pool_pre_ping=True,
+                             pool_recycle=3600)
+    in_memory = url in ("sqlite://", "sqlite:///:memory:")
+    engine = create_engine(
+        url,
+        connect_args={"check_same_thread": False, "timeout": BUSY_TIMEOUT_MS / 1000},
+        **({} if in_memory else {"pool_size": POOL_SIZE, "max_overflow": MAX_OVERFLOW, "pool_timeout": 30})
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not in_memory:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            # Safe with WAL: a power loss can only lose the last commits, never corrupt the file
+            cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        cursor.close()
+
+    return engine
+
+
+def add_missing_columns(bind=None):
+    """Add the model columns an existing table does not have yet, with ALTER TABLE ... ADD COLUMN.
+
+    Columns are added as nullable and without constraints, which every database supports;
+    defaults are filled in by the ORM on insert. Returns the "table.column" names added.
+    """
+    bind = bind or engine
+    inspector = inspect(bind)
+    added = []
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or column.primary_key:
+                continue
+            with bind.begin() as connection:
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} '
+                                        f'{column.type.compile(bind.dialect)}'))
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+
+def init_db(bind=None):
+    """Create missing tables, columns and indexes. Run once per process, before the first session is used."""
+    bind = bind or engine
+    Base.metadata.create_all(bind)
+    add_missing_columns(bind)
+    # create_all only creates missing tables, so add indexes declared on tables that already existed
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind, checkfirst=True)
+
+
+engine = make_engine()
+Session = sessionmaker(bind=engine)
@@ -0,0 +1,192 @@
+import asyncio
+import json
+import queue
+import re
+import time
+
+from grocery import with_grocery_list
+from llm import async_chat_completion, chat_completion, submit_async
+from prompts import adjustment_messages, adjustment_route_messages, new_section_messages, section_messages, \
+    without_grocery_list
+from recipe_fanout import MAX_CONCURRENT_RECIPES, token_totals
+
+ROUTE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'rewrite': {'type': 'array', 'items': {'type': 'integer'}},
+        'remove': {'type': 'array', 'items': {'type': 'integer'}},
+        'add': {'type': 'array', 'items': {'type': 'string'}},
+    },
+    'required': ['rewrite', 'remove', 'add'],
+    'additionalProperties': False,
+}
+ROUTE_RESPONSE_FORMAT = {
+    'type': 'json_schema',
+    'json_schema': {'name': 'plan_adjustment_route', 'strict': True, 'schema': ROUTE_SCHEMA},
+}
+
+# Words that make a request about more than the recipes it names, so the model decides what it touches
+ROUTE_WORDS = {'all', 'every', 'each', 'whole', 'entire', 'everything', 'plan', 'meals', 'recipes', 'add',
+               'remove', 'delete', 'drop', 'another', 'extra'}
+
+
+def parse_plan(plan_text):
+    """Split a plan into addressable sections: its header, one section per ### recipe and the grocery list.
+
+    Returns a dict with 'header' text, 'sections' (dicts with 'label', 'name', 'heading' and 'text')
+    and 'grocery_list' text.
+    """
+    parts = re.split(r'\*\*Grocery list\*\*', plan_text or '', maxsplit=1, flags=re.I)
+    recipes_part, grocery_list = parts[0], parts[1].strip() if len(parts) > 1 else ''
+    header, sections = [], []
+    for line in recipes_part.splitlines():
+        heading = re.match(r'\s*#{2,4}\s*(.+)', line)
+        if heading:
+            label, _, name = heading.group(1).partition(':')
+            sections.append({'label': label.strip(' *'), 'name': name.strip(' *'), 'heading': heading.group(1).strip(),
+                             'lines': [line]})
+        elif sections:
+            sections[-1]['lines'].append(line)
+        else:
+            header.append(line)
+    for section in sections:
+        section['text'] = '\n'.join(section.pop('lines')).strip()
+    return {'header': '\n'.join(header).strip(), 'sections': sections, 'grocery_list': grocery_list}
+
+
+def _words(text):
+    return {word[:-1] if word.endswith('s') and len(word) > 3 else word for word in re.findall(r'\w+', text.lower())}
+
+
+def named_sections(sections, adjustment_request):
+    """Indexes of the sections a request names by meal label or recipe name, or None if it has to be routed.
+
+    "Make breakfast vegetarian" names the breakfast recipe only. A request that names no recipe,
+    or uses words like "all" or "add", is left to the model.
+    """
+    words = _words(adjustment_request)
+    if words & ROUTE_WORDS:
+        return None
+    named = [i for i, section in enumerate(sections)
+             if _words(section['label']) <= words
+             or any(len(word) > 3 for word in _words(section['name']) & words)]
+    return named or None
+
+
+def plan_changes(plan_text, adjustment_request, use_cache=True):
+    """Decide which sections of a plan an adjustment touches.
+
+    Returns None when the plan has no recipe sections or the change applies to all of it, so it
+    is best rewritten in one request. Otherwise a dict with the section indexes to 'rewrite' and
+    'remove', the meals to 'add', and the 'timing' of the routing request (None if the request
+    named its recipes and no request was needed).
+    """
+    sections = parse_plan(plan_text)['sections']
+    if not sections:
+        return None
+    named = named_sections(sections, adjustment_request)
+    if named is not None:
+        return {'rewrite': named, 'remove': [], 'add': [], 'timing': None}
+
+    text, timing = chat_completion(adjustment_route_messages([s['heading'] for s in sections], adjustment_request),
+                                   0, call_name='meal_plan_adjustment_route', use_cache=use_cache,
+                                   response_format=ROUTE_RESPONSE_FORMAT)
+    try:
+        route = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    indexes = range(len(sections))
+    rewrite = sorted({n - 1 for n in route.get('rewrite', []) if n - 1 in indexes})
+    remove = sorted({n - 1 for n in route.get('remove', []) if n - 1 in indexes} - set(rewrite))
+    add = [meal.strip() for meal in route.get('add', []) if meal.strip()]
+    if not (rewrite or remove or add) or len(rewrite) == len(sections):
+        return None
+    return {'rewrite': rewrite, 'remove': remove, 'add': add, 'timing': timing}
+
+
+def _section_text(text, heading):
+    # The model sometimes repeats the plan title or adds a grocery list; keep the recipe only
+    text = without_grocery_list(text)
+    start = re.search(r'^\s*#{2,4}\s', text, re.M)
+    return text[start.start():].strip() if start else f"### {heading}\n{text.strip()}"
+
+
+async def _rewrite_sections(sections, changes, adjustment_request, finished, use_cache):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_RECIPES)
+    headings = [s['heading'] for s in sections]
+
+    async def request(messages, heading):
+        async with semaphore:
+            text, timing = await async_chat_completion(messages, 0.1, call_name='meal_plan_adjustment_section',
+                                                       use_cache=use_cache)
+        finished.put(heading)
+        return _section_text(text, heading), timing
+
+    return await asyncio.gather(
+        *(request(section_messages(sections[i]['text'], headings[:i] + headings[i + 1:], adjustment_request),
+                  headings[i]) for i in changes['rewrite']),
+        *(request(new_section_messages(meal, headings, adjustment_request), meal) for meal in changes['add'])
+    )
+
+
+def adjust_sections(plan_text, changes, adjustment_request, existing_ingredients, preferences, on_progress=None,
+                    use_cache=True):
+    """Regenerate only the sections in changes, splice them into the plan and rebuild its grocery list.
+
+    The rewritten and added recipes are requested concurrently; on_progress(done, total) is called
+    from the calling thread as they finish. Returns the adjusted plan and a timing dict in the format
+    of llm.chat_completion, including the routing request and the number of sections regenerated.
+    """
+    started = time.perf_counter()
+    plan = parse_plan(plan_text)
+    sections = plan['sections']
+    total = len(changes['rewrite']) + len(changes['add'])
+    finished = queue.SimpleQueue()
+    future = submit_async(_rewrite_sections(sections, changes, adjustment_request, finished, use_cache))
+    first_section_at = None
+    done = 0
+    while done < total and not future.done():
+        try:
+            finished.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        done += 1
+        first_section_at = first_section_at or time.perf_counter()
+        if on_progress:
+            on_progress(done, total)
+    results = future.result()
+
+    texts = [section['text'] for section in sections]
+    for i, (text, _) in zip(changes['rewrite'], results):
+        texts[i] = text
+    texts = [text for i, text in enumerate(texts) if i not in changes['remove']]
+    texts += [text for text, _ in results[len(changes['rewrite']):]]
+    adjusted = with_grocery_list('\n'.join(filter(None, [plan['header'], '\n\n'.join(texts)])),
+                                 existing_ingredients, preferences['liquid_unit'], preferences['mass_unit'])
+
+    timings = [timing for _, timing in results] + ([changes['timing']] if changes['timing'] else [])
+    ended = time.perf_counter()
+    return adjusted, {
+        'call': 'meal_plan_adjustment',
+        'ttft': (first_section_at or ended) - started,
+        'total': ended - started + (changes['timing']['total'] if changes['timing'] else 0.0),
+        'chars': len(adjusted),
+        'sections_changed': total + len(changes['remove']),
+        'sections_total': len(sections),
+        **token_totals(timings),
+    }
+
+
+def adjust_plan(plan_text, adjustment_request, existing_ingredients, preferences, use_cache=True):
+    """Adjust a plan as asked, regenerating only the sections the change touches.
+
+    A change that applies to the whole plan is rewritten in one request. Returns the adjusted
+    plan with its grocery list rebuilt locally, and a timing dict.
+    """
+    changes = plan_changes(plan_text, adjustment_request, use_cache=use_cache)
+    if changes is not None:
+        return adjust_sections(plan_text, changes, adjustment_request, existing_ingredients, preferences,
+                               use_cache=use_cache)
+    plan, timing = chat_completion(adjustment_messages(plan_text, adjustment_request), 0.1,
+                                   call_name='meal_plan_adjustment', use_cache=use_cache)
+    return with_grocery_list(plan, existing_ingredients, preferences['liquid_unit'], preferences['mass_unit']), timing
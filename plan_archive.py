@@ -0,0 +1,357 @@
+"""Move old meal plans out of the main database into a compressed archive, and read them back.
+
+Plans created more than FPREP_ARCHIVE_AFTER_DAYS ago are moved, with their recipes and
+cooking instructions, into a separate SQLite file (FPREP_ARCHIVE_PATH, by default
+cooking_app_archive.db next to the main SQLite database): one compressed JSON payload per plan
+plus a full-text search row, so the tables and indexes of the main database only hold the plans
+people still open. Archiving is off until FPREP_ARCHIVE_AFTER_DAYS is set; the app then archives
+every FPREP_ARCHIVE_INTERVAL_SECONDS. It can also be run by hand or from cron:
+
+    python -m plan_archive
+    python -m plan_archive --older-than-days 90
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime, time as day_time, timedelta
+
+from sqlalchemy import Column, DateTime, Index, Integer, String, and_, bindparam, delete, insert, or_, select, text
+from sqlalchemy.orm import declarative_base, deferred, selectinload, sessionmaker, undefer
+
+import metrics
+import plan_search
+from models import (CompressedText, CookingInstruction, MealPlan, Recipe, RecipeIngredient, RecipeStep, Session,
+                    engine as main_engine, init_db, make_engine)
+from plan_history import plans_page as hot_plans_page
+
+logger = logging.getLogger('plan_archive')
+
+# Opt-in, since archiving deletes plans from the main database; 0 turns it off
+ARCHIVE_AFTER_DAYS = float(os.environ.get("FPREP_ARCHIVE_AFTER_DAYS", "0"))
+_MAIN_PATH = main_engine.url.database if main_engine.dialect.name == 'sqlite' else None
+ARCHIVE_PATH = os.path.abspath(os.environ.get("FPREP_ARCHIVE_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(_MAIN_PATH)) if _MAIN_PATH and _MAIN_PATH != ':memory:' else '',
+    "cooking_app_archive.db"))
+INTERVAL_SECONDS = float(os.environ.get("FPREP_ARCHIVE_INTERVAL_SECONDS", "3600"))
+BATCH_SIZE = 200
+# First item of the View Plans cursors that point into the archive; (ARCHIVED,) is its first page
+ARCHIVED = 'archived'
+# Above every SQLite rowid, so a search cursor at a score skips all rows with that score
+_LAST_ROWID = 2 ** 63 - 1
+
+_SCORE = (f"bm25(archived_plan_search, {plan_search.NAME_WEIGHT}, {plan_search.RECIPES_WEIGHT}, "
+          f"{plan_search.GROCERY_WEIGHT}, {plan_search.INSTRUCTIONS_WEIGHT})")
+
+ArchiveBase = declarative_base()
+
+
+class ArchivedPlan(ArchiveBase):
+    __tablename__ = 'archived_plans'
+    # Serves the archive pages of View Plans, like ix_meal_plans_user_created_id does for the main database
+    __table_args__ = (Index('ix_archived_plans_user_created_id', 'user_id', 'created_at', 'id'),)
+    id = Column(Integer, primary_key=True)
+    meal_plan_id = Column(Integer, index=True)  # id of the plan in meal_plans, which a new plan may get again
+    user_id = Column(Integer)
+    name = Column(String)
+    created_at = Column(DateTime)
+    days = Column(Integer)
+    total_time = Column(String)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+    # JSON of the meal_plans row and its recipes (with ingredients and steps) and cooking instructions
+    payload = deferred(Column(CompressedText))
+
+
+engine = make_engine(f"sqlite:///{ARCHIVE_PATH}")
+ArchiveSession = sessionmaker(bind=engine)
+
+stats = {'archived': 0, 'opened': 0}
+_lock = threading.Lock()
+_started = False
+
+
+def init_archive(bind=None):
+    """Create the archive tables and their full-text search table if missing."""
+    bind = bind or engine
+    ArchiveBase.metadata.create_all(bind)
+    with bind.begin() as connection:
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS archived_plan_search USING fts5("
+            "name, recipes, grocery_list, instructions, user_id UNINDEXED, "
+            "tokenize = 'porter unicode61 remove_diacritics 2')"
+        ))
+
+
+def _row(obj):
+    """The column values of a model object, JSON-ready."""
+    values = {}
+    for column in obj.__table__.columns:
+        value = getattr(obj, column.key)
+        values[column.key] = value.isoformat() if isinstance(value, datetime) else value
+    return values
+
+
+def _object(model, values):
+    """A model object, in no session, from the values of _row."""
+    return model(**{key: datetime.fromisoformat(value) if value and isinstance(model.__table__.c[key].type, DateTime)
+                    else value for key, value in values.items()})
+
+
+def _store(connection, entries, archived_at):
+    """Write (plan, cooking instructions) pairs into the archive, replacing earlier copies of them."""
+    search_rows = []
+    for plan, instructions in entries:
+        payload = {
+            'plan': _row(plan),
+            'recipes': [{**_row(recipe), 'ingredient_lines': [_row(line) for line in recipe.ingredient_lines],
+                         'steps': [_row(step) for step in recipe.steps]} for recipe in plan.recipes],
+            'cooking_instructions': [_row(instruction) for instruction in instructions],
+        }
+        # A plan is in both databases if a run failed between writing here and deleting there
+        replaced = connection.execute(select(ArchivedPlan.id).where(
+            ArchivedPlan.meal_plan_id == plan.id, ArchivedPlan.user_id == plan.user_id,
+            ArchivedPlan.created_at == plan.created_at)).scalars().all()
+        if replaced:
+            connection.execute(delete(ArchivedPlan).where(ArchivedPlan.id.in_(replaced)))
+            connection.execute(text("DELETE FROM archived_plan_search WHERE rowid IN :ids").bindparams(
+                bindparam('ids', expanding=True)), {'ids': replaced})
+        archived_id = connection.execute(insert(ArchivedPlan).values(
+            meal_plan_id=plan.id, user_id=plan.user_id, name=plan.name, created_at=plan.created_at, days=plan.days,
+            total_time=instructions[-1].total_time if instructions else None, archived_at=archived_at,
+            payload=json.dumps(payload))).inserted_primary_key[0]
+        recipes, grocery_list = plan_search.split_plan(plan.cooking_plan)
+        search_rows.append({'id': archived_id, 'name': plan.name or '', 'recipes': recipes,
+                            'grocery_list': grocery_list, 'user_id': plan.user_id,
+                            'instructions': '\n'.join(i.instructions or '' for i in instructions)})
+    connection.execute(
+        text("INSERT INTO archived_plan_search (rowid, name, recipes, grocery_list, instructions, user_id) "
+             "VALUES (:id, :name, :recipes, :grocery_list, :instructions, :user_id)"),
+        search_rows
+    )
+
+
+def archive_old_plans(older_than_days=ARCHIVE_AFTER_DAYS, batch_size=BATCH_SIZE, now=None):
+    """Move the plans created more than older_than_days ago into the archive. Returns how many moved."""
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=older_than_days)
+    moved = 0
+    while True:
+        with Session() as session:
+            plans = session.scalars(
+                select(MealPlan).where(MealPlan.created_at < cutoff).order_by(MealPlan.id).limit(batch_size)
+                .options(undefer(MealPlan.cooking_plan), undefer(MealPlan.existing_ingredients),
+                         selectinload(MealPlan.recipes).options(undefer(Recipe.instructions),
+                                                                selectinload(Recipe.ingredient_lines),
+                                                                selectinload(Recipe.steps)))
+            ).all()
+            if not plans:
+                return moved
+            # All of a plan's cooking instructions, not only the one of MealPlan.cooking_instruction
+            instructions = {}
+            for instruction in session.scalars(
+                    select(CookingInstruction).options(undefer(CookingInstruction.instructions))
+                    .where(CookingInstruction.meal_plan_id.in_([plan.id for plan in plans]))
+                    .order_by(CookingInstruction.id)):
+                instructions.setdefault(instruction.meal_plan_id, []).append(instruction)
+            # Written to the archive before deleting, so a failed run leaves plans in both places, never in neither
+            with engine.begin() as connection:
+                _store(connection, [(plan, instructions.get(plan.id, [])) for plan in plans], now)
+            for plan in plans:
+                for instruction in instructions.get(plan.id, []):
+                    session.delete(instruction)
+                session.delete(plan)
+            session.commit()
+        moved += len(plans)
+        with _lock:
+            stats['archived'] += len(plans)
+        logger.info("Archived %d plans created before %s", moved, cutoff.date())
+
+
+def open_plan(archived_id):
+    """An archived plan as a MealPlan with its recipes and cooking instruction, in no session, so it
+    renders like a plan of the main database. Returns None if there is no such archived plan."""
+    with ArchiveSession() as session:
+        payload = session.scalar(select(ArchivedPlan.payload).where(ArchivedPlan.id == archived_id))
+    if payload is None:
+        return None
+    data = json.loads(payload)
+    plan = _object(MealPlan, data['plan'])
+    for values in data['recipes']:
+        recipe = _object(Recipe, {k: v for k, v in values.items() if k not in ('ingredient_lines', 'steps')})
+        recipe.ingredient_lines = [_object(RecipeIngredient, line) for line in values['ingredient_lines']]
+        recipe.steps = [_object(RecipeStep, step) for step in values['steps']]
+        plan.recipes.append(recipe)
+    if data['cooking_instructions']:
+        plan.cooking_instruction = _object(CookingInstruction, data['cooking_instructions'][-1])
+    with _lock:
+        stats['opened'] += 1
+    return plan
+
+
+def grocery_totals(plan):
+    """The stored_grocery_totals rows of an opened archived plan: [(recipe id, name, total quantity, unit), ...]."""
+    totals = {}
+    for recipe in plan.recipes:
+        for line in recipe.ingredient_lines:
+            key = (recipe.id, line.name, line.unit)
+            if line.quantity is not None:
+                totals[key] = (totals.get(key) or 0) + line.quantity
+            else:
+                totals.setdefault(key, None)
+    return [(recipe_id, name, quantity, unit) for (recipe_id, name, unit), quantity
+            in sorted(totals.items(), key=lambda item: (item[0][1] or '', item[0][0]))]
+
+
+def _date_range(start_date, end_date):
+    return (datetime.combine(start_date, day_time.min) if start_date else None,
+            datetime.combine(end_date + timedelta(days=1), day_time.min) if end_date else None)
+
+
+def _archived_page(user_id, limit, after=None, start_date=None, end_date=None, name=None):
+    """Up to limit archived plans of a user, newest first, after the (created_at, id) cursor.
+    Returns (plans, whether there are more)."""
+    query = (select(ArchivedPlan).where(ArchivedPlan.user_id == user_id)
+             .order_by(ArchivedPlan.created_at.desc(), ArchivedPlan.id.desc()).limit(limit + 1))
+    if after is not None:
+        created_at, archived_id = after
+        query = query.where(or_(ArchivedPlan.created_at < created_at,
+                                and_(ArchivedPlan.created_at == created_at, ArchivedPlan.id < archived_id)))
+    start, end = _date_range(start_date, end_date)
+    if start:
+        query = query.where(ArchivedPlan.created_at >= start)
+    if end:
+        query = query.where(ArchivedPlan.created_at < end)
+    if name:
+        query = query.where(ArchivedPlan.name.ilike(f"%{name}%"))
+    with ArchiveSession() as session:
+        plans = session.scalars(query).all()
+    return plans[:limit], len(plans) > limit
+
+
+def plans_page(session, user_id, page_size, after=None, start_date=None, end_date=None, name=None):
+    """plan_history.plans_page over the plans of the main database, followed by the archived plans,
+    which are older. Returns (plans, cursor of the next page or None); archived plans are ArchivedPlan
+    rows, to open with open_plan."""
+    plans = []
+    if not after or after[0] != ARCHIVED:
+        plans, next_cursor = hot_plans_page(session, user_id, page_size, after=after, start_date=start_date,
+                                            end_date=end_date, name=name)
+        if next_cursor is not None:
+            return plans, next_cursor
+        after = (ARCHIVED,)
+    archived, more = _archived_page(user_id, page_size - len(plans), after[1:] or None, start_date, end_date, name)
+    if not more:
+        return plans + archived, None
+    return plans + archived, (ARCHIVED, archived[-1].created_at, archived[-1].id) if archived else (ARCHIVED,)
+
+
+def _search_archive(user_id, search_term, limit, after=None, start_date=None, end_date=None):
+    """plan_search.search_matches over the archive: ([(archived id, score, highlighted name, snippet), ...],
+    whether there are more)."""
+    query = plan_search.match_query(search_term)
+    if query is None:
+        return [], False
+    conditions = ["archived_plan_search MATCH :query", "archived_plan_search.user_id = :user_id"]
+    params = {'query': query, 'user_id': user_id, 'limit': limit + 1}
+    if after is not None:
+        conditions.append(f"({_SCORE} > :score OR ({_SCORE} = :score AND archived_plan_search.rowid > :after_id))")
+        params['score'], params['after_id'] = after
+    start, end = _date_range(start_date, end_date)
+    if start:
+        conditions.append("p.created_at >= :start")
+        params['start'] = start.isoformat(' ')
+    if end:
+        conditions.append("p.created_at < :end")
+        params['end'] = end.isoformat(' ')
+    with ArchiveSession() as session:
+        rows = session.execute(text(
+            f"SELECT archived_plan_search.rowid, {_SCORE} AS score, "
+            f"highlight(archived_plan_search, 0, :start_mark, :end_mark), "
+            f"snippet(archived_plan_search, -1, :start_mark, :end_mark, '…', 16) "
+            f"FROM archived_plan_search JOIN archived_plans p ON p.id = archived_plan_search.rowid "
+            f"WHERE {' AND '.join(conditions)} ORDER BY score, archived_plan_search.rowid LIMIT :limit"
+        ), {**params, 'start_mark': plan_search.HIGHLIGHT_START, 'end_mark': plan_search.HIGHLIGHT_END}).all()
+    return [(archived_id, score, name, ' '.join(re.sub(r'[#*]+', ' ', snippet).split()))
+            for archived_id, score, name, snippet in rows[:limit]], len(rows) > limit
+
+
+def search_page(session, user_id, search_term, page_size, after=None, start_date=None, end_date=None):
+    """plan_search.search_page over the plans of the main database and the archived plans, merged by
+    bm25 score. Pages are keyed on (score, whether archived, id), so at equal scores plans of the main
+    database come first. Returns ([(plan, highlighted name, snippet), ...], cursor of the next page or None)."""
+    hot_after = archive_after = None
+    if after is not None:
+        score, archived, last_id = after
+        # Past the cursor are the hot plans with a higher score and the archived ones with at least its
+        # score, or, after an archived plan, the archived ones with a higher id at its score
+        hot_after = (score, _LAST_ROWID if archived else last_id)
+        archive_after = (score, last_id if archived else 0)
+    hot, hot_more = plan_search.search_matches(session, user_id, search_term, page_size, hot_after, start_date,
+                                               end_date)
+    archived, archived_more = _search_archive(user_id, search_term, page_size, archive_after, start_date, end_date)
+    # Each part holds its best page_size after the cursor, so the best page_size of both are among them
+    matches = sorted([(score, False, plan_id, name, snippet) for plan_id, score, name, snippet in hot]
+                     + [(score, True, archived_id, name, snippet) for archived_id, score, name, snippet in archived])
+    more = len(matches) > page_size or hot_more or archived_more
+    matches = matches[:page_size]
+    next_cursor = matches[-1][:3] if more else None
+
+    plans = plan_search.load_plans(session, [plan_id for _, archived, plan_id, _, _ in matches if not archived])
+    archived_ids = [archived_id for _, archived, archived_id, _, _ in matches if archived]
+    with ArchiveSession() as archive_session:
+        archived_plans = {plan.id: plan for plan in archive_session.scalars(
+            select(ArchivedPlan).where(ArchivedPlan.id.in_(archived_ids)))} if archived_ids else {}
+    return [((archived_plans if archived else plans)[plan_id], name, snippet)
+            for _, archived, plan_id, name, snippet in matches
+            if plan_id in (archived_plans if archived else plans)], next_cursor
+
+
+@metrics.collector
+def _archive_counters():
+    return [('fprep_archived_plans_total', stats['archived'], {}),
+            ('fprep_archived_plans_opened_total', stats['opened'], {})]
+
+
+def _archive_periodically(interval):
+    while True:
+        try:
+            archive_old_plans()
+        except Exception:
+            logger.exception("Archiving old plans failed")
+        time.sleep(interval)
+
+
+def start():
+    """Create the archive and, unless archiving is off, move old plans into it every INTERVAL_SECONDS.
+    Run once per process."""
+    global _started
+    with _lock:
+        if _started:
+            return
+        _started = True
+    init_archive()
+    if ARCHIVE_AFTER_DAYS > 0:
+        threading.Thread(target=_archive_periodically, args=(INTERVAL_SECONDS,), name='plan-archive',
+                         daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--older-than-days', type=float, default=ARCHIVE_AFTER_DAYS,
+                        help="archive plans created more than this many days ago")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="plans moved per transaction")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    init_db()
+    plan_search.init_search()
+    init_archive()
+    moved = archive_old_plans(args.older_than_days, args.batch_size)
+    logger.info("Finished: %d plans archived to %s", moved, ARCHIVE_PATH)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import os
+import threading
+from collections import namedtuple
+
+from cachetools import LRUCache, TTLCache
+from sqlalchemy import event, select
+
+import metrics
+import plan_archive
+from models import CookingInstruction, MealPlan, Session
+
+# The View Plans pages of recently active users, as plan summaries, so browsing saved plans
+# needs no database query until the user's plans change. The session listeners below drop a
+# user's pages when a transaction that wrote one of their plans or cooking instructions commits
+# in this process; writes by other processes (e.g. queue workers) show after TTL_SECONDS.
+MAX_USERS = int(os.environ.get("FPREP_PLAN_CACHE_USERS", "1000"))
+TTL_SECONDS = float(os.environ.get("FPREP_PLAN_CACHE_TTL_SECONDS", "300"))
+# Pages of one user kept, across filters and page sizes
+MAX_PAGES_PER_USER = 32
+
+PlanSummary = namedtuple('PlanSummary', ['id', 'name', 'created_at', 'total_time', 'archived'])
+
+_pages = TTLCache(maxsize=MAX_USERS, ttl=TTL_SECONDS)  # user id -> LRUCache of page key -> (summaries, cursor)
+_lock = threading.Lock()
+
+stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def summary(plan):
+    """The PlanSummary of a MealPlan, with its cooking instruction loaded, or of an ArchivedPlan."""
+    if isinstance(plan, plan_archive.ArchivedPlan):
+        return PlanSummary(plan.id, plan.name, plan.created_at, plan.total_time, True)
+    total_time = plan.cooking_instruction.total_time if plan.cooking_instruction else None
+    return PlanSummary(plan.id, plan.name, plan.created_at, total_time, False)
+
+
+def plans_page(session, user_id, page_size, after=None, start_date=None, end_date=None, name=None):
+    """plan_archive.plans_page as PlanSummary tuples, from the cache if the user's plans did not
+    change since it was read. Returns (summaries, cursor of the next page or None)."""
+    key = (page_size, after, start_date, end_date, name)
+    with _lock:
+        pages = _pages.get(user_id)
+        if pages is None:
+            # Made before the query: invalidate drops it, so a page read while a write commits is not cached
+            pages = _pages[user_id] = LRUCache(maxsize=MAX_PAGES_PER_USER)
+        page = pages.get(key)
+        stats['hits' if page is not None else 'misses'] += 1
+    if page is not None:
+        return page
+    plans, next_cursor = plan_archive.plans_page(session, user_id, page_size, after=after, start_date=start_date,
+                                                 end_date=end_date, name=name)
+    page = ([summary(plan) for plan in plans], next_cursor)
+    with _lock:
+        if _pages.get(user_id) is pages:
+            pages[key] = page
+    return page
+
+
+def invalidate(user_id):
+    """Drop the cached pages of a user."""
+    with _lock:
+        _pages.pop(user_id, None)
+        stats['invalidations'] += 1
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_changes(session, flush_context):
+    """Note the users whose plans or cooking instructions were flushed, to invalidate once the transaction commits."""
+    users = session.info.setdefault('plan_cache_users', set())
+    meal_plan_ids = set()
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, MealPlan) and obj.user_id is not None:
+            users.add(obj.user_id)
+        elif isinstance(obj, CookingInstruction) and obj.meal_plan_id is not None:
+            meal_plan_ids.add(obj.meal_plan_id)
+    if meal_plan_ids:
+        users.update(session.connection().execute(
+            select(MealPlan.user_id).where(MealPlan.id.in_(meal_plan_ids))).scalars())
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_changed(session):
+    for user_id in session.info.pop('plan_cache_users', ()):
+        invalidate(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('plan_cache_users', None)
+
+
+@metrics.collector
+def _cache_counters():
+    return [*(('fprep_plan_cache_total', stats[name], {'result': name}) for name in ('hits', 'misses')),
+            ('fprep_plan_cache_invalidations_total', stats['invalidations'], {})]
+
+
+@metrics.gauge_collector
+def _cache_gauges():
+    with _lock:
+        return [('fprep_plan_cache_users', len(_pages), {})]
@@ -0,0 +1,38 @@
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.orm import joinedload
+
+from models import MealPlan
+
+
+def plans_page(session, user_id, page_size, after=None, start_date=None, end_date=None, name=None):
+    """One page of a user's meal plans, newest first, with their cooking instructions loaded.
+
+    Pages are keyed on (created_at, id) instead of an offset, so each page is one range scan of
+    the (user_id, created_at, id) index no matter how far back it is. after is the cursor of
+    the last plan of the previous page. Returns (plans, cursor of the next page or None).
+    """
+    query = (
+        select(MealPlan)
+        .options(joinedload(MealPlan.cooking_instruction))
+        .where(MealPlan.user_id == user_id)
+        .order_by(MealPlan.created_at.desc(), MealPlan.id.desc())
+        .limit(page_size + 1)
+    )
+    if after is not None:
+        created_at, plan_id = after
+        query = query.where(or_(MealPlan.created_at < created_at,
+                                and_(MealPlan.created_at == created_at, MealPlan.id < plan_id)))
+    if start_date:
+        query = query.where(MealPlan.created_at >= datetime.combine(start_date, time.min))
+    if end_date:
+        query = query.where(MealPlan.created_at < datetime.combine(end_date + timedelta(days=1), time.min))
+    if name:
+        query = query.where(MealPlan.name.ilike(f"%{name}%"))
+
+    plans = session.scalars(query).unique().all()
+    if len(plans) <= page_size:
+        return plans, None
+    plans = plans[:page_size]
+    return plans, (plans[-1].created_at, plans[-1].id)
@@ -0,0 +1,144 @@
+import re
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import bindparam, event, select, text
+from sqlalchemy.orm import joinedload
+
+from models import CookingInstruction, MealPlan, Session, engine
+
+# Column weights for bm25: a match in the plan name counts most, one in the instructions least
+NAME_WEIGHT, RECIPES_WEIGHT, GROCERY_WEIGHT, INSTRUCTIONS_WEIGHT = 10.0, 4.0, 2.0, 1.0
+BATCH_SIZE = 500
+
+# The highlight markers are Streamlit markdown, so matches show with a coloured background
+HIGHLIGHT_START, HIGHLIGHT_END = ':orange-background[', ']'
+
+_SCORE = (f"bm25(meal_plan_search, {NAME_WEIGHT}, {RECIPES_WEIGHT}, {GROCERY_WEIGHT}, "
+          f"{INSTRUCTIONS_WEIGHT})")
+
+
+def available(bind=None):
+    """FTS5 full-text search is only set up on SQLite; other databases fall back to a name filter."""
+    return (bind or engine).dialect.name == 'sqlite'
+
+
+def init_search(bind=None):
+    """Create the meal_plan_search FTS5 table and index every plan that is not in it yet."""
+    bind = bind or engine
+    if not available(bind):
+        return
+    with bind.begin() as connection:
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS meal_plan_search USING fts5("
+            "name, recipes, grocery_list, instructions, user_id UNINDEXED, "
+            "tokenize = 'porter unicode61 remove_diacritics 2')"
+        ))
+        missing = connection.execute(text(
+            "SELECT id FROM meal_plans WHERE id NOT IN (SELECT rowid FROM meal_plan_search)"
+        )).scalars().all()
+        for i in range(0, len(missing), BATCH_SIZE):
+            index_plans(connection, missing[i:i + BATCH_SIZE])
+
+
+def split_plan(cooking_plan):
+    """(recipes, grocery list) parts of a plan's markdown text."""
+    parts = re.split(r'\*\*Grocery list\*\*', cooking_plan or '', maxsplit=1, flags=re.I)
+    return parts[0], parts[1] if len(parts) > 1 else ''
+
+
+def index_plans(connection, meal_plan_ids):
+    """Replace the search rows of the given meal plans with their current text."""
+    if not meal_plan_ids:
+        return
+    meal_plan_ids = list(meal_plan_ids)
+    connection.execute(text("DELETE FROM meal_plan_search WHERE rowid IN :ids").bindparams(
+        bindparam('ids', expanding=True)), {'ids': meal_plan_ids})
+    # Read through the mapped columns, so the compressed texts come back decompressed
+    rows = connection.execute(select(MealPlan.id, MealPlan.name, MealPlan.cooking_plan, MealPlan.user_id)
+                              .where(MealPlan.id.in_(meal_plan_ids))).all()
+    instructions = {}
+    for plan_id, instruction in connection.execute(
+            select(CookingInstruction.meal_plan_id, CookingInstruction.instructions)
+            .where(CookingInstruction.meal_plan_id.in_(meal_plan_ids)).order_by(CookingInstruction.id)):
+        instructions.setdefault(plan_id, []).append(instruction or '')
+    values = []
+    for plan_id, name, cooking_plan, user_id in rows:
+        recipes, grocery_list = split_plan(cooking_plan)
+        values.append({'id': plan_id, 'name': name or '', 'recipes': recipes, 'grocery_list': grocery_list,
+                       'instructions': '\n'.join(instructions.get(plan_id, [])), 'user_id': user_id})
+    if values:
+        connection.execute(
+            text("INSERT INTO meal_plan_search (rowid, name, recipes, grocery_list, instructions, user_id) "
+                 "VALUES (:id, :name, :recipes, :grocery_list, :instructions, :user_id)"),
+            values
+        )
+
+
+@event.listens_for(Session, 'after_flush')
+def _sync_search(session, flush_context):
+    """Keep meal_plan_search in step with every flushed meal plan and cooking instruction."""
+    if not available(session.get_bind()):
+        return
+    changed = set()
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, MealPlan) and obj.id is not None:
+            changed.add(obj.id)
+        elif isinstance(obj, CookingInstruction) and obj.meal_plan_id is not None:
+            changed.add(obj.meal_plan_id)
+    # Deleted plans are gone from meal_plans by now, so index_plans only deletes their rows
+    index_plans(session.connection(), sorted(changed))
+
+
+def match_query(search_term):
+    """FTS5 query for a search box entry: every word must match, the last one as a prefix."""
+    words = re.findall(r'\w+', search_term or '')
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words[:-1]) + (' ' if len(words) > 1 else '') + f'"{words[-1]}"*'
+
+
+def search_matches(session, user_id, search_term, limit, after=None, start_date=None, end_date=None):
+    """Up to limit matches of search_term among a user's plans, best match first, after the (bm25 score, id)
+    cursor: ([(plan id, score, highlighted name, snippet), ...], whether there are more)."""
+    query = match_query(search_term)
+    if query is None:
+        return [], False
+    conditions = ["meal_plan_search MATCH :query", "meal_plan_search.user_id = :user_id"]
+    params = {'query': query, 'user_id': user_id, 'limit': limit + 1}
+    if after is not None:
+        conditions.append(f"({_SCORE} > :score OR ({_SCORE} = :score AND meal_plan_search.rowid > :after_id))")
+        params['score'], params['after_id'] = after
+    if start_date:
+        conditions.append("p.created_at >= :start")
+        params['start'] = datetime.combine(start_date, time.min).isoformat(' ')
+    if end_date:
+        conditions.append("p.created_at < :end")
+        params['end'] = datetime.combine(end_date + timedelta(days=1), time.min).isoformat(' ')
+    rows = session.execute(text(
+        f"SELECT meal_plan_search.rowid, {_SCORE} AS score, "
+        f"highlight(meal_plan_search, 0, :start_mark, :end_mark), "
+        f"snippet(meal_plan_search, -1, :start_mark, :end_mark, '…', 16) "
+        f"FROM meal_plan_search JOIN meal_plans p ON p.id = meal_plan_search.rowid "
+        f"WHERE {' AND '.join(conditions)} ORDER BY score, meal_plan_search.rowid LIMIT :limit"
+    ), {**params, 'start_mark': HIGHLIGHT_START, 'end_mark': HIGHLIGHT_END}).all()
+    # Snippets are shown on one line, so drop the markdown headings, bold markers and line breaks
+    return [(plan_id, score, name, ' '.join(re.sub(r'[#*]+', ' ', snippet).split()))
+            for plan_id, score, name, snippet in rows[:limit]], len(rows) > limit
+
+
+def load_plans(session, plan_ids):
+    """The MealPlans of search matches, with their cooking instruction, by id."""
+    return {plan.id: plan for plan in session.query(MealPlan).options(joinedload(MealPlan.cooking_instruction))
+            .filter(MealPlan.id.in_(plan_ids))}
+
+
+def search_page(session, user_id, search_term, page_size, after=None, start_date=None, end_date=None):
+    """One page of a user's plans matching search_term, best match first, with highlighted matches.
+
+    Pages are keyed on (bm25 score, id) like plan_history.plans_page is on (created_at, id).
+    Returns ([(plan, highlighted name, snippet), ...], cursor of the next page or None).
+    """
+    rows, more = search_matches(session, user_id, search_term, page_size, after, start_date, end_date)
+    next_cursor = (rows[-1][1], rows[-1][0]) if more else None
+    plans = load_plans(session, [row[0] for row in rows])
+    return [(plans[plan_id], name, snippet) for plan_id, _, name, snippet in rows if plan_id in plans], next_cursor
@@ -0,0 +1,221 @@
+import math
+import re
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # optional; without it prompt sizes are estimated from their length
+    tiktoken = None
+
+MEAL_PLAN_SYSTEM_PROMPT = "You are an experienced chef. You have many experiences in cooking healthy dishes. Create a detailed meal plan with recipes and cooking instructions."
+RECIPE_SYSTEM_PROMPT = "You are an experienced chef. You have many experiences in cooking healthy dishes. Write one detailed recipe that is part of a meal plan."
+COOKING_INSTRUCTIONS_SYSTEM_PROMPT = "You are a professional chef who is experienced in cooking multiple dishes simultaneously in a very efficient way. Create detailed step-by-step cooking instructions that utilize equipment efficiently and minimize waiting time."
+ADJUSTMENT_SYSTEM_PROMPT = "You are a professional chef assistant. Modify the meal plan according to the user's request."
+
+ADJUSTMENT_ROUTER_SYSTEM_PROMPT = "You decide which recipes of a meal plan a requested change affects."
+
+BASIC_EQUIPMENT = "knives, spatulas, spoons, forks, mixing bowls, measuring cups, etc."
+
+# Markdown format of one recipe of a plan; grocery.py and scheduler.py parse plans written in it
+RECIPE_FORMAT = """### (meal): (meal name)
+**Cooking method**: (cooking method)
+**Calories**: (calories) per day
+**Ingredients**
+- (ingredient): (quantity) (unit)
+**Equipment**
+- (equipment)
+**Instructions**
+1. (step)"""
+
+# Chat format overhead of gpt-4o models: tokens around every message, and priming the reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+CHARS_PER_TOKEN = 4  # rough average for English text, used without tiktoken
+
+
+def _compact(text):
+    """Strip the indentation and trailing spaces of a prompt written as an indented string."""
+    return '\n'.join(line.strip() for line in text.strip().splitlines())
+
+
+def _messages(system_prompt, user_prompt):
+    return [{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': _compact(user_prompt)}]
+
+
+def equipment_text(kitchen):
+    """The equipment a user has as "stove burner: 2, oven rack: 1"; items they have none of are left out."""
+    items = [f"{name.replace('_', ' ')}: {count}" for name, count in (kitchen or {}).items() if count]
+    return ', '.join(items) or 'none'
+
+
+def _preference_lines(preferences):
+    lines = [
+        f"- My cooking style is {preferences['style']}",
+        f"- My daily calories need is {preferences['calories']} calories",
+        f"- My protein, fat, carbs percentage distribution of the daily calories are respectively: "
+        f"{preferences['macro_protein']}%, {preferences['macro_fat']}%, {preferences['macro_carbs']}%",
+        f"- My units for temperature unit, liquid unit, and mass unit are: {preferences['temp_unit']}, "
+        f"{preferences['liquid_unit']}, {preferences['mass_unit']}",
+    ]
+    if (preferences.get('additional_preference') or '').strip():
+        lines.append(f"- My additional preference is {preferences['additional_preference']}")
+    return '\n'.join(lines)
+
+
+def _existing_line(existing_ingredients, recipes='recipes'):
+    if not (existing_ingredients or '').strip():
+        return ''
+    return f"\n- The existing ingredients that I want to incorporate into the {recipes}, if possible, are {existing_ingredients}."
+
+
+def without_grocery_list(plan_text):
+    """A plan's text up to its **Grocery list** section, which is built locally and never sent."""
+    return re.split(r'\*\*Grocery list\*\*', plan_text or '', maxsplit=1, flags=re.I)[0].strip()
+
+
+def recipes_section(plan_text):
+    """Only the recipes of a plan: no title, grocery list or per-recipe calories."""
+    lines = [line for line in without_grocery_list(plan_text).splitlines()
+             if not re.match(r'\s*(recipes for\b|\**recipes\**\s*$|\**calories\**\s*:)', line, re.I)]
+    return '\n'.join(lines).strip()
+
+
+def meal_plan_messages(plan_name, meals, preferences, days, existing_ingredients, kitchen):
+    """Messages of the single request that writes all recipes of a meal plan."""
+    return _messages(MEAL_PLAN_SYSTEM_PROMPT, f'''
+        Please help write a meal plan tailored to my needs.
+
+        Step 1: Understand all the information that you need to write a cooking plan for my needs.
+        {_preference_lines(preferences)}
+        - I want to cook for {days} days.
+        - The dishes I want to cook are {meals}{_existing_line(existing_ingredients)}
+        - Besides the basic equipment like {BASIC_EQUIPMENT}, my cooking equipment is: {equipment_text(kitchen)}
+
+        Step 2: Generate the recipes for each meal given in Step 1. For each meal:
+        - Give the meal a name
+        - State the cooking method
+        - Estimate the calories for this meal for one day
+        - Write the recipe. Ensure that the recipe meets the needs in Step 1 and use the cooking equipment only listed in Step 1.
+        -- Ingredients: List the ingredients. All ingredients must have the amount needed for the recipe, one per line as "- (ingredient): (quantity) (unit)".
+        -- Equipment: List the equipment needed for the recipe
+        -- Instructions: List the steps to cook the recipe
+
+        Step 3: Export the output in the format below. Ensure that the output does not include any XML tags. Do not write a grocery list, it is built from the ingredient lists.
+        Recipes for {plan_name}
+        **Recipes**
+        {RECIPE_FORMAT}''')
+
+
+def recipe_messages(meal, all_meals, preferences, days, existing_ingredients, kitchen):
+    """Messages of the structured output request for one meal of a plan."""
+    other_meals = ', '.join(m for m in all_meals if m != meal) or 'none'
+    return _messages(RECIPE_SYSTEM_PROMPT, f'''
+        Please help write the recipe for one meal of my meal plan, tailored to my needs.
+
+        Step 1: Understand all the information that you need to write the recipe for my needs.
+        {_preference_lines(preferences)}
+        - I want to cook this meal for {days} days.
+        - The meal to write the recipe for is {meal}
+        - My other meals of the day are {other_meals}. The daily calories and macros are shared by all meals.{_existing_line(existing_ingredients, 'recipe')}
+        - Besides the basic equipment like {BASIC_EQUIPMENT}, my cooking equipment is: {equipment_text(kitchen)}
+
+        Step 2: Write the recipe. Ensure that the recipe meets the needs in Step 1 and use the cooking equipment only listed in Step 1.
+        - Give the meal a name
+        - State the cooking method
+        - Estimate the calories for this meal for one day
+        - Ingredients: List the ingredients. All ingredients must have the quantity and unit needed for all {days} days, in my units where they apply.
+        - Steps: List the steps to cook the recipe. For each step, estimate its duration in minutes, list the equipment it uses from my equipment list, and state whether it needs hands-on work or can be left unattended.
+
+        Step 3: Return the recipe as JSON that matches the given schema.''')
+
+
+def cooking_instructions_messages(plan_name, days, plan_text, kitchen):
+    """Messages of the request that writes the cooking instructions of a plan, sent its recipes only."""
+    return _messages(COOKING_INSTRUCTIONS_SYSTEM_PROMPT, f'''
+        Please help write a cooking plan, step by step, that is tailored to my needs below.
+        Step 1: Understand all the information that you need to write a cooking plan for my needs.
+        - I have very limited time, so I want to cook all meals for all {days} days at once, then store the meals for the week.
+        - Besides the basic equipment like {BASIC_EQUIPMENT}, my cooking equipment is: {equipment_text(kitchen)}
+        - The recipes I want to cook are:
+        {recipes_section(plan_text)}
+
+        Step 2: Generate the cooking plan, step by step. The goal of the cooking plan is to make the cooking as efficient as possible with little waiting time.
+        The plan should meet the following criteria:
+        - Have very minimal in-cooking equipment washing time
+        - Utilize all the equipment as much as possible to prepare or cook multiple ingredients simultaneously.
+        - Include the steps and time for washing produce and washing equipment, if any.
+        - Estimate the time taken for each step.
+        - Sum up the time from all the steps to get the estimated total time.
+        - Because the food is cooked and stored for the week ahead, include the storing and packing step.
+        The cooking plan should start from the minute 0 as the starting point of the cooking timeline, then add each step with the step's duration.
+
+        Step 3: Export the output in the format below. Ensure that the output does not include any XML tags.
+        Cooking plan for {plan_name}
+        **Total time**: (estimated total time)
+        **Steps**
+        - (cooking step)''')
+
+
+def adjustment_messages(plan_text, adjustment_request):
+    """Messages of the request that rewrites a plan; the plan is sent once, without its grocery list."""
+    return _messages(ADJUSTMENT_SYSTEM_PROMPT, f'''
+        Here is my current meal plan:
+
+        {without_grocery_list(plan_text)}
+
+        Please adjust it as follows: {adjustment_request}.
+        Output format: Return the whole adjusted plan in the same format as the current plan above. Do not write a grocery list, it is built from the ingredient lists.''')
+
+
+def adjustment_route_messages(headings, adjustment_request):
+    """Messages of the small request that picks the recipes an adjustment touches, given only their headings."""
+    numbered = '\n'.join(f"{n}. {heading}" for n, heading in enumerate(headings, start=1))
+    return _messages(ADJUSTMENT_ROUTER_SYSTEM_PROMPT, f'''
+        My meal plan has these recipes:
+        {numbered}
+
+        The change I want: {adjustment_request}
+
+        Return the numbers of the recipes that must be rewritten for this change, the numbers of the recipes to remove, and the meals to add as new recipes, written like "Snack: hummus".
+        Leave a list empty when nothing applies. Only list every recipe when the change applies to the whole plan.''')
+
+
+def section_messages(section_text, other_headings, adjustment_request):
+    """Messages of the request that rewrites one recipe of a plan for an adjustment."""
+    return _messages(ADJUSTMENT_SYSTEM_PROMPT, f'''
+        Here is one recipe of my meal plan:
+
+        {section_text}
+
+        The other recipes of the plan are: {', '.join(other_headings) or 'none'}.
+        Please adjust this recipe as follows: {adjustment_request}.
+        Output format: Return only this recipe, in the same format, starting with its ### heading. Do not write a grocery list.''')
+
+
+def new_section_messages(meal, headings, adjustment_request):
+    """Messages of the request that writes a recipe added to a plan by an adjustment."""
+    return _messages(ADJUSTMENT_SYSTEM_PROMPT, f'''
+        My meal plan has these recipes: {', '.join(headings) or 'none'}.
+        As part of this change: {adjustment_request}, please write a new recipe for {meal}.
+        All ingredients must have the amount needed for the recipe, one per line as "- (ingredient): (quantity) (unit)".
+        Output format: Return only the new recipe in the format below. Do not write a grocery list.
+        {RECIPE_FORMAT}''')
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('o200k_base')
+
+
+def count_text_tokens(text, model='gpt-4o-mini'):
+    if tiktoken is None:
+        return math.ceil(len(text or '') / CHARS_PER_TOKEN)
+    return len(_encoding(model).encode(text or ''))
+
+
+def count_tokens(messages, model='gpt-4o-mini'):
+    """Prompt tokens of a chat request: exact with tiktoken installed, estimated otherwise."""
+    return TOKENS_PER_REPLY + sum(TOKENS_PER_MESSAGE + count_text_tokens(m['content'], model) for m in messages)
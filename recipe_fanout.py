@@ -0,0 +1,116 @@
+import asyncio
+import os
+import queue
+import time
+
+from llm import async_chat_completion, submit_async
+from grocery import grocery_list
+from prompts import recipe_messages
+from structured_recipes import RECIPE_RESPONSE_FORMAT, parse_recipe
+
+# Upper bound on recipe requests in flight at once for one meal plan
+MAX_CONCURRENT_RECIPES = int(os.environ.get("FPREP_MAX_CONCURRENT_RECIPES", 4))
+
+
+def split_meals(meals):
+    """Split the meals text area into one entry per non-empty line, without list markers."""
+    return [line.strip().lstrip('-*•').strip() for line in meals.splitlines() if line.strip().lstrip('-*•').strip()]
+
+
+def meal_label(meal):
+    """Short label used in the grocery list, e.g. "Breakfast" for "Breakfast: shrimp salad"."""
+    return meal.split(':', 1)[0].strip() if ':' in meal else meal
+
+
+def merge_plan(plan_name, recipes, existing_ingredients, preferences):
+    """Merge per-meal recipes into the "**Recipes** / **Grocery list**" plan format.
+
+    The grocery list is summed locally from the structured ingredient quantities, in the
+    preferred liquid and mass units.
+    """
+    items = [(recipe['label'], i['name'], i['quantity'], i['unit'])
+             for recipe in recipes for i in recipe['ingredients']]
+    return '\n'.join([
+        f"Recipes for {plan_name}",
+        "**Recipes**",
+        '\n\n'.join(recipe['text'].strip() for recipe in recipes),
+        "",
+        "**Grocery list**",
+        grocery_list(items, existing_ingredients, preferences['liquid_unit'], preferences['mass_unit']),
+    ])
+
+
+async def _generate_recipes(meals, all_meals, preferences, days, existing_ingredients, kitchen_data, finished,
+                            use_cache):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_RECIPES)
+
+    async def generate_recipe(meal):
+        async with semaphore:
+            text, timing = await async_chat_completion(
+                recipe_messages(meal, all_meals, preferences, days, existing_ingredients, kitchen_data),
+                0.1, call_name='recipe', use_cache=use_cache, response_format=RECIPE_RESPONSE_FORMAT
+            )
+        finished.put(meal)
+        return parse_recipe(text, meal, meal_label(meal)), timing
+
+    return await asyncio.gather(*(generate_recipe(meal) for meal in meals))
+
+
+def token_totals(timings):
+    """Token counts of the recipe requests summed for the whole plan; None if any is unknown."""
+    totals = {}
+    for name in ('prompt_tokens_estimate', 'prompt_tokens', 'completion_tokens'):
+        counts = [timing.get(name) for timing in timings]
+        totals[name] = None if None in counts else sum(counts)
+    return totals
+
+
+def generate_meal_plan(plan_name, meals, preferences, days, existing_ingredients, kitchen_data, on_progress=None,
+                       use_cache=True, reused=None):
+    """Generate a meal plan with one concurrent recipe request per meal line.
+
+    Each recipe is requested as structured output (see structured_recipes.RECIPE_SCHEMA) and
+    rendered to markdown locally. Meal lines in reused ({position of the line: recipe dict}, see
+    recipe_index.reusable_recipe) take that recipe instead of a request. on_progress(done, total)
+    is called from the calling thread as recipes finish. Returns the merged plan text, the
+    structured recipes and a timing dict in the format of llm.chat_completion, where the time to
+    first token is the time until the first recipe was ready. Raises structured_recipes.InvalidRecipe
+    if a recipe response does not match the schema.
+    """
+    meal_list = split_meals(meals)
+    if not meal_list:
+        raise ValueError("Please list at least one meal.")
+    # Positions are strings once the payload went through the job queue's JSON
+    reused = {int(i): recipe for i, recipe in (reused or {}).items()}
+    to_generate = [i for i in range(len(meal_list)) if i not in reused]
+
+    started = time.perf_counter()
+    first_recipe_at = started if reused else None
+    finished = queue.SimpleQueue()
+    future = submit_async(_generate_recipes([meal_list[i] for i in to_generate], meal_list, preferences, days,
+                                            existing_ingredients, kitchen_data, finished, use_cache))
+    done = len(reused)
+    if done and on_progress:
+        on_progress(done, len(meal_list))
+    while done < len(meal_list) and not future.done():
+        try:
+            finished.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        done += 1
+        first_recipe_at = first_recipe_at or time.perf_counter()
+        if on_progress:
+            on_progress(done, len(meal_list))
+
+    generated = dict(zip(to_generate, future.result()))
+    recipes = [reused[i] if i in reused else generated[i][0] for i in range(len(meal_list))]
+    plan = merge_plan(plan_name, recipes, existing_ingredients, preferences)
+    ended = time.perf_counter()
+    return plan, recipes, {
+        'call': 'meal_plan',
+        'ttft': (first_recipe_at or ended) - started,
+        'total': ended - started,
+        'chars': len(plan),
+        'reused': len(reused),
+        **token_totals([timing for _, timing in generated.values()]),
+    }
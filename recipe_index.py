@@ -0,0 +1,325 @@
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import selectinload
+
+from grocery import items_from_plan
+from models import MealPlan, Recipe, RecipeIngredient, RecipeStep, Session, engine
+from plan_adjustment import parse_plan
+from recipe_fanout import meal_label
+from scheduler import PASSIVE_KEYWORDS, recipes_from_plan, step_duration, step_equipment
+from structured_recipes import render_recipe
+
+# An in-memory TF-IDF index over the dish and ingredient names of every saved recipe, so a
+# requested meal can reuse a similar recipe instead of generating one. Recipes are the Recipe
+# rows saved with a plan, or, for plans generated in one request, which have none, the ###
+# sections of the plan text. It is built from the database on first use and kept up to date
+# by the session listeners below.
+TOP_K = 3
+# Matches with a lower cosine similarity are not offered
+MIN_SCORE = float(os.environ.get("FPREP_REUSE_MIN_SCORE", "0.35"))
+# A word of the dish name counts as much as this many ingredient words
+NAME_WEIGHT = 3
+STOP_WORDS = {'and', 'with', 'the', 'for', 'of', 'in', 'on', 'a', 'an', 'or', 'to', 'style', 'fresh', 'day'}
+
+# document id -> {'id', 'recipe_id', 'meal_plan_id', 'user_id', 'plan_name', 'style', 'heading', 'name',
+# 'equipment', 'terms'}; the id is the recipe id, or ('plan', meal plan id, heading) for a plan text section
+_documents = {}
+_plan_sections = {}  # meal plan id -> ids of the documents of its plan text sections
+_postings = {}  # term -> ids of the recipes that have it
+_document_frequency = Counter()
+_lock = threading.Lock()
+_built = False
+
+stats = {'queries': 0, 'reused': 0}
+
+
+def terms(text):
+    """Lower-case words of a dish or ingredient name, without stop words and plural s."""
+    words = []
+    for word in re.findall(r'[a-z]+', (text or '').lower()):
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        if len(word) > 1 and word not in STOP_WORDS:
+            words.append(word)
+    return words
+
+
+def _dish(meal):
+    """The dish of a meal line or recipe name, e.g. "shrimp salad" for "Lunch: shrimp salad"."""
+    return meal.split(':', 1)[1].strip() if ':' in meal else meal.strip()
+
+
+def _add(document):
+    _remove(document['id'])
+    _documents[document['id']] = document
+    if document['recipe_id'] is None:
+        _plan_sections.setdefault(document['meal_plan_id'], set()).add(document['id'])
+    for term in document['terms']:
+        _postings.setdefault(term, set()).add(document['id'])
+        _document_frequency[term] += 1
+
+
+def _remove(document_id):
+    document = _documents.pop(document_id, None)
+    if document is None:
+        return
+    if document['recipe_id'] is None:
+        _plan_sections.get(document['meal_plan_id'], set()).discard(document_id)
+    for term in document['terms']:
+        _postings[term].discard(document_id)
+        _document_frequency[term] -= 1
+
+
+def _document(document_id, recipe_id, meal_plan_id, user_id, plan_name, style, heading):
+    counts = Counter()
+    for term in terms(_dish(heading or '')):
+        counts[term] += NAME_WEIGHT
+    return {'id': document_id, 'recipe_id': recipe_id, 'meal_plan_id': meal_plan_id, 'user_id': user_id,
+            'plan_name': plan_name, 'style': style, 'heading': heading, 'name': _dish(heading or ''),
+            'equipment': set(), 'terms': counts}
+
+
+def _load(connection, recipe_ids=None):
+    """Index documents of the given recipes, or of all recipes, read with three column queries."""
+    recipes = select(Recipe.id, Recipe.meal_plan_id, MealPlan.user_id, MealPlan.name, MealPlan.style,
+                     Recipe.name).join(MealPlan, MealPlan.id == Recipe.meal_plan_id)
+    ingredients = select(RecipeIngredient.recipe_id, RecipeIngredient.name)
+    steps = select(RecipeStep.recipe_id, RecipeStep.equipment)
+    if recipe_ids is not None:
+        recipes = recipes.where(Recipe.id.in_(recipe_ids))
+        ingredients = ingredients.where(RecipeIngredient.recipe_id.in_(recipe_ids))
+        steps = steps.where(RecipeStep.recipe_id.in_(recipe_ids))
+    documents = {}
+    for recipe_id, *values in connection.execute(recipes):
+        documents[recipe_id] = _document(recipe_id, recipe_id, *values)
+    for recipe_id, name in connection.execute(ingredients):
+        if recipe_id in documents:
+            documents[recipe_id]['terms'].update(terms(name))
+    for recipe_id, equipment in connection.execute(steps):
+        if recipe_id in documents and equipment:
+            documents[recipe_id]['equipment'].update(equipment.split(','))
+    return documents.values()
+
+
+def _sections(plan_text):
+    """(section of plan_adjustment.parse_plan, [(name, quantity, unit), ...], [step text, ...]) of each
+    recipe in a plan text."""
+    for section in parse_plan(plan_text)['sections']:
+        ingredients = [(name, quantity, unit) for _, name, quantity, unit in items_from_plan(section['text'])]
+        steps = next((steps for _, steps in recipes_from_plan(section['text'])), [])
+        if ingredients or steps:
+            yield section, ingredients, steps
+
+
+def _load_plan_texts(connection, meal_plan_ids=None):
+    """Index documents of the recipe sections in the texts of the given plans, or of all plans, that
+    have no Recipe rows."""
+    plans = select(MealPlan.id, MealPlan.user_id, MealPlan.name, MealPlan.style, MealPlan.cooking_plan).where(
+        ~select(Recipe.id).where(Recipe.meal_plan_id == MealPlan.id).exists())
+    if meal_plan_ids is not None:
+        plans = plans.where(MealPlan.id.in_(meal_plan_ids))
+    documents = []
+    for meal_plan_id, user_id, plan_name, style, plan_text in connection.execute(plans):
+        for section, ingredients, steps in _sections(plan_text):
+            document = _document(('plan', meal_plan_id, section['heading']), None, meal_plan_id, user_id, plan_name,
+                                 style, section['heading'])
+            for name, _, _ in ingredients:
+                document['terms'].update(terms(name))
+            for step in steps:
+                document['equipment'].update(step_equipment(step))
+            documents.append(document)
+    return documents
+
+
+def build(bind=None):
+    """(Re)build the index from every saved recipe."""
+    global _built
+    with (bind or engine).connect() as connection:
+        documents = [*_load(connection), *_load_plan_texts(connection)]
+    with _lock:
+        _documents.clear()
+        _plan_sections.clear()
+        _postings.clear()
+        _document_frequency.clear()
+        for document in documents:
+            _add(document)
+        _built = True
+
+
+def _ensure_built():
+    if not _built:
+        build()
+
+
+def similar(meal, user_id=None, k=TOP_K, style=None, kitchen=None, min_score=MIN_SCORE):
+    """Saved recipes most similar to a requested meal, best first, as dicts with 'recipe_id' (None
+    for a plan text section), 'meal_plan_id', 'heading', 'name', 'plan_name' and 'score' (cosine
+    similarity of TF-IDF vectors).
+
+    Only recipes of plans generated with the given cooking style (or saved before plans kept their
+    style), and that need no equipment the kitchen has none of, are returned; recipes with the same
+    dish name are returned once. Recipes of other users than user_id are anonymous: their
+    'plan_name' is None.
+    """
+    _ensure_built()
+    query = Counter(terms(_dish(meal)))
+    if not query:
+        return []
+    available = {name for name, count in (kitchen or {}).items() if count}
+    with _lock:
+        stats['queries'] += 1
+        count = len(_documents)
+
+        def idf(term):
+            return math.log((1 + count) / (1 + _document_frequency[term])) + 1
+
+        query_weights = {term: n * idf(term) for term, n in query.items()}
+        query_norm = math.sqrt(sum(w * w for w in query_weights.values()))
+        candidates = set().union(*(_postings.get(term, ()) for term in query))
+        scored = []
+        for document_id in candidates:
+            document = _documents[document_id]
+            if style and document['style'] not in (None, style):
+                continue
+            if kitchen is not None and not document['equipment'] <= available:
+                continue
+            weights = {term: n * idf(term) for term, n in document['terms'].items()}
+            dot = sum(w * weights.get(term, 0.0) for term, w in query_weights.items())
+            score = dot / (query_norm * math.sqrt(sum(w * w for w in weights.values())))
+            if score >= min_score:
+                scored.append((score, document['meal_plan_id'], document))
+    matches, seen = [], set()
+    # Best score first, then the newest plan
+    for score, _, document in sorted(scored, key=lambda item: item[:2], reverse=True):
+        if document['name'].lower() in seen:
+            continue
+        seen.add(document['name'].lower())
+        own = user_id is not None and document['user_id'] == user_id
+        matches.append({'recipe_id': document['recipe_id'], 'meal_plan_id': document['meal_plan_id'],
+                        'heading': document['heading'], 'name': document['name'],
+                        'plan_name': document['plan_name'] if own else None, 'score': score})
+        if len(matches) == k:
+            break
+    return matches
+
+
+def _section_details(plan, heading):
+    """The cooking method and calories of a recipe, which are only in the plan text, under its heading."""
+    section = next((section['text'] for section in parse_plan(plan.cooking_plan)['sections']
+                    if section['heading'] == heading), '')
+    method = re.search(r'\*\*Cooking method\*\*:\s*(.+)', section)
+    calories = re.search(r'\*\*Calories\*\*:\s*(\d+)', section)
+    return method.group(1).strip() if method else '', int(calories.group(1)) if calories else 0
+
+
+def _scaled(quantity, scale):
+    return round(quantity * scale, 2) if quantity is not None else None
+
+
+def reusable_recipe(session, match, meal, days):
+    """A match of similar() as the structured recipe dict of a new plan for meal, with its quantities
+    scaled from the days of its plan to days. Returns None if the recipe no longer exists."""
+    if match['recipe_id'] is None:
+        reused = _reusable_section(session, match, meal, days)
+    else:
+        reused = _reusable_rows(session, match['recipe_id'], meal, days)
+    if reused is None:
+        return None
+    reused['text'] = render_recipe(reused)
+    with _lock:
+        stats['reused'] += 1
+    return reused
+
+
+def _reusable_rows(session, recipe_id, meal, days):
+    """reusable_recipe of a recipe saved as Recipe rows."""
+    recipe = session.scalars(select(Recipe).where(Recipe.id == recipe_id).options(
+        selectinload(Recipe.ingredient_lines), selectinload(Recipe.steps),
+        selectinload(Recipe.meal_plan))).first()
+    if recipe is None:
+        return None
+    plan = recipe.meal_plan
+    scale = days / plan.days if plan.days else 1
+    cooking_method, calories = _section_details(plan, recipe.name)
+    return {
+        'meal': meal, 'label': meal_label(meal), 'name': _dish(recipe.name),
+        'cooking_method': cooking_method, 'calories_per_day': calories,
+        'ingredients': [{'name': line.name, 'unit': line.unit, 'quantity': _scaled(line.quantity, scale)}
+                        for line in recipe.ingredient_lines],
+        'steps': [{'description': step.description, 'duration_minutes': step.duration_minutes,
+                   'equipment': [e for e in (step.equipment or '').split(',') if e], 'hands_on': step.hands_on}
+                  for step in recipe.steps],
+        'reused_from': recipe_id,
+    }
+
+
+def _reusable_section(session, match, meal, days):
+    """reusable_recipe of a recipe section of a plan text, with the step durations, equipment and
+    hands-on time guessed from the step texts as the scheduler does."""
+    plan = session.get(MealPlan, match['meal_plan_id'])
+    if plan is None:
+        return None
+    found = next(((ingredients, steps) for section, ingredients, steps in _sections(plan.cooking_plan)
+                  if section['heading'] == match['heading']), None)
+    if found is None:
+        return None
+    ingredients, steps = found
+    scale = days / plan.days if plan.days else 1
+    cooking_method, calories = _section_details(plan, match['heading'])
+    return {
+        'meal': meal, 'label': meal_label(meal), 'name': _dish(match['heading']),
+        'cooking_method': cooking_method, 'calories_per_day': calories,
+        'ingredients': [{'name': name, 'unit': unit, 'quantity': _scaled(quantity, scale)}
+                        for name, quantity, unit in ingredients],
+        'steps': [{'description': step, 'duration_minutes': step_duration(step),
+                   'equipment': sorted(step_equipment(step)),
+                   'hands_on': not any(keyword in step.lower() for keyword in PASSIVE_KEYWORDS)} for step in steps],
+        'reused_from': None,
+    }
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_changes(session, flush_context):
+    """Note flushed recipes and plans, to apply to the index once the transaction commits."""
+    changes = session.info.setdefault('recipe_index_changes', {'recipes': set(), 'deleted': set(), 'plans': set()})
+    for obj in (*session.new, *session.dirty):
+        if isinstance(obj, Recipe) and obj.id is not None:
+            changes['recipes'].add(obj.id)
+        elif isinstance(obj, MealPlan) and obj.id is not None:
+            changes['plans'].add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Recipe):
+            changes['deleted'].add(obj.id)
+        elif isinstance(obj, MealPlan):
+            changes['plans'].add(obj.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    changes = session.info.pop('recipe_index_changes', None)
+    if not changes or not _built:
+        return
+    documents = []
+    if changes['recipes'] or changes['plans']:
+        with session.get_bind().connect() as connection:
+            documents = list(_load(connection, sorted(changes['recipes']))) if changes['recipes'] else []
+            # Deleted plans and plans with Recipe rows get no plan text documents
+            documents += _load_plan_texts(connection, sorted(changes['plans']))
+    with _lock:
+        for recipe_id in changes['deleted']:
+            _remove(recipe_id)
+        for meal_plan_id in changes['plans']:
+            for document_id in list(_plan_sections.pop(meal_plan_id, ())):
+                _remove(document_id)
+        for document in documents:
+            _add(document)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('recipe_index_changes', None)
@@ -0,0 +1,366 @@
+import random
+import re
+
+# Resource that stands for the person cooking: hands-on steps need one, passive steps
+# (baking, simmering, the rice cooker running) do not.
+COOK = 'cook'
+
+# Phrases that tie a step to a Kitchen column. Sized phrases come first so "large pan"
+# does not also count as a generic pan.
+EQUIPMENT_KEYWORDS = [
+    ('large_pan', ['large pan', 'large skillet', 'large frying pan']),
+    ('small_pan', ['small pan', 'small skillet', 'small frying pan']),
+    ('medium_pan', ['medium pan', 'pan', 'skillet', 'wok']),
+    ('large_pot', ['large pot', 'stockpot', 'dutch oven']),
+    ('small_pot', ['small pot', 'small saucepan']),
+    ('medium_pot', ['medium pot', 'pot', 'saucepan']),
+    ('oven_rack', ['oven', 'bake', 'roast', 'broil']),
+    ('sous_vide_bag', ['sous vide', 'sous-vide']),
+    ('food_processor', ['food processor']),
+    ('blender_cup', ['blender', 'blend']),
+    ('crock_pot', ['crock pot', 'crockpot', 'slow cooker', 'slow cook']),
+    ('rice_cooker', ['rice cooker']),
+    ('thermometer', ['thermometer']),
+]
+STOVE_EQUIPMENT = {'large_pan', 'medium_pan', 'small_pan', 'large_pot', 'medium_pot', 'small_pot'}
+PASSIVE_KEYWORDS = ['bake', 'roast', 'simmer', 'rest', 'marinate', 'slow cook', 'rice cooker', 'crock pot',
+                    'sous vide', 'chill', 'refrigerate', 'soak', 'boil', 'cool']
+DEFAULT_STEP_MINUTES = 5
+
+# Besides the fixed priority rules, list scheduling tries this many randomly biased orders
+# (seeded, so timelines are reproducible).
+RANDOM_LIST_PASSES = 30
+
+# Branch and bound explores activity orders exhaustively up to this many search nodes, then
+# keeps the best schedule found so far.
+MAX_SEARCH_NODES = 5000
+
+
+def task(task_id, name, duration, equipment=None, after=(), hands_on=True, recipe=None):
+    """Build a task: duration in minutes, equipment as {kitchen column: count}, after as task ids."""
+    requirements = dict(equipment or {})
+    if hands_on:
+        requirements[COOK] = requirements.get(COOK, 0) + 1
+    return {'id': task_id, 'name': name, 'duration': max(0, int(round(duration))),
+            'equipment': requirements, 'after': list(after), 'hands_on': hands_on, 'recipe': recipe}
+
+
+def step_duration(text):
+    """Minutes mentioned in a step, e.g. 25 for "Bake for 20-25 minutes", else the default."""
+    match = re.search(r'(\d+(?:\.\d+)?)(?:\s*(?:-|–|to)\s*(\d+(?:\.\d+)?))?\s*(hours?|hrs?|h\b|minutes?|mins?|m\b)',
+                      text, re.I)
+    if not match:
+        return DEFAULT_STEP_MINUTES
+    value = float(match.group(2) or match.group(1))
+    return value * 60 if match.group(3).lower().startswith('h') else value
+
+
+def step_equipment(text):
+    """Kitchen columns a step needs, guessed from the equipment it mentions."""
+    lowered = text.lower()
+    equipment = {}
+    for column, phrases in EQUIPMENT_KEYWORDS:
+        for phrase in phrases:
+            if re.search(r'\b' + re.escape(phrase) + r'\b', lowered):
+                equipment[column] = 1
+                lowered = re.sub(r'\b' + re.escape(phrase) + r'\b', ' ', lowered)
+                break
+    if STOVE_EQUIPMENT & equipment.keys() and 'oven_rack' not in equipment:
+        equipment['stove_burner'] = len(STOVE_EQUIPMENT & equipment.keys())
+    elif re.search(r'\b(stove|burner|stovetop)\b', lowered):
+        equipment['stove_burner'] = 1
+    return equipment
+
+
+def tasks_from_recipes(recipes):
+    """Turn [(recipe name, [step, ...]), ...] into tasks chained in order within each recipe.
+
+    A step is either free text, whose duration and equipment are guessed, or a structured step
+    dict with 'description', 'duration_minutes', 'equipment' (Kitchen columns) and 'hands_on'.
+    """
+    tasks = []
+    for recipe_name, steps in recipes:
+        previous = None
+        for number, step in enumerate(steps, start=1):
+            task_id = f"{recipe_name} #{number}"
+            after = [previous] if previous else []
+            if isinstance(step, dict):
+                equipment = {column: 1 for column in step['equipment']}
+                if STOVE_EQUIPMENT & equipment.keys() and not equipment.keys() & {'stove_burner', 'oven_rack'}:
+                    equipment['stove_burner'] = len(STOVE_EQUIPMENT & equipment.keys())
+                tasks.append(task(task_id, step['description'], step['duration_minutes'] or 0, equipment,
+                                  after=after, hands_on=bool(step['hands_on']), recipe=recipe_name))
+            else:
+                lowered = step.lower()
+                tasks.append(task(task_id, step, step_duration(step), step_equipment(step), after=after,
+                                  hands_on=not any(keyword in lowered for keyword in PASSIVE_KEYWORDS),
+                                  recipe=recipe_name))
+            previous = task_id
+    return tasks
+
+
+def recipes_from_plan(plan_text):
+    """Find recipes and their numbered instruction steps in the **Recipes** section of a plan."""
+    recipes_section = re.split(r'\*\*Grocery list\*\*', plan_text or '', flags=re.I)[0]
+    recipes = []
+    current_name, steps, in_instructions = None, [], False
+    for line in recipes_section.splitlines():
+        stripped = line.strip()
+        heading = re.match(r'#{2,4}\s*(.+)', stripped)
+        if heading:
+            if current_name and steps:
+                recipes.append((current_name, steps))
+            current_name, steps, in_instructions = heading.group(1).strip(' *'), [], False
+        elif re.match(r'[-*]?\s*\**\s*instructions\b', stripped, re.I):
+            in_instructions = True
+        elif re.match(r'[-*]?\s*\**\s*(ingredients|equipment)\b', stripped, re.I):
+            in_instructions = False
+        elif in_instructions and current_name:
+            step = re.match(r'(?:\d+[.)]|[-*])\s+(.+)', stripped)
+            if step:
+                steps.append(step.group(1).strip())
+    if current_name and steps:
+        recipes.append((current_name, steps))
+    return recipes
+
+
+def _check(tasks):
+    ids = {t['id'] for t in tasks}
+    for t in tasks:
+        missing = [dep for dep in t['after'] if dep not in ids]
+        if missing:
+            raise ValueError(f"Task {t['id']!r} depends on unknown tasks {missing}")
+    order, seen, visiting = [], set(), set()
+    by_id = {t['id']: t for t in tasks}
+
+    def visit(task_id):
+        if task_id in seen:
+            return
+        if task_id in visiting:
+            raise ValueError(f"Tasks have a precedence cycle through {task_id!r}")
+        visiting.add(task_id)
+        for dep in by_id[task_id]['after']:
+            visit(dep)
+        visiting.discard(task_id)
+        seen.add(task_id)
+        order.append(task_id)
+
+    for t in tasks:
+        visit(t['id'])
+    return order
+
+
+def _tails(tasks, order):
+    """Longest duration from the start of each task to the end of the precedence graph."""
+    successors = {t['id']: [] for t in tasks}
+    for t in tasks:
+        for dep in t['after']:
+            successors[dep].append(t['id'])
+    by_id = {t['id']: t for t in tasks}
+    tails = {}
+    for task_id in reversed(order):
+        tails[task_id] = by_id[task_id]['duration'] + max((tails[s] for s in successors[task_id]), default=0)
+    return tails
+
+
+def _resource_bound(tasks, capacities):
+    """No schedule is shorter than the busiest resource's total work divided by its count."""
+    load = {}
+    for t in tasks:
+        for column, count in t['equipment'].items():
+            load[column] = load.get(column, 0) + t['duration'] * count
+    return max((-(-minutes // capacities[column]) for column, minutes in load.items()), default=0)
+
+
+def _capacities(tasks, kitchen, cooks):
+    capacities = {column: int(count or 0) for column, count in (kitchen or {}).items()}
+    capacities[COOK] = max(1, int(cooks))
+    missing = sorted({column for t in tasks for column, count in t['equipment'].items()
+                      if count > capacities.get(column, 0)})
+    # Steps that need equipment the kitchen does not have are scheduled as if there were just
+    # enough of it, and the equipment is reported so the timeline is not silently wrong.
+    for t in tasks:
+        for column, count in t['equipment'].items():
+            if count > capacities.get(column, 0):
+                capacities[column] = count
+    return capacities, missing
+
+
+def _earliest_start(t, ready_at, placed, capacities):
+    """Earliest start >= ready_at at which t fits next to the placed (task, start, end) entries."""
+    candidates = sorted({ready_at} | {end for _, _, end in placed if end > ready_at})
+    for start in candidates:
+        end = start + t['duration']
+        points = sorted({start} | {s for _, s, _ in placed if start < s < end})
+        if all(_fits(t, point, placed, capacities) for point in points):
+            return start
+    return candidates[-1]
+
+
+def _fits(t, time, placed, capacities):
+    for column, count in t['equipment'].items():
+        in_use = sum(other['equipment'].get(column, 0) for other, start, end in placed
+                     if start <= time < end and end > start)
+        if in_use + count > capacities.get(column, 0):
+            return False
+    return True
+
+
+def _serial_schedule(order, by_id, capacities):
+    placed, ends = [], {}
+    for task_id in order:
+        t = by_id[task_id]
+        ready_at = max((ends[dep] for dep in t['after']), default=0)
+        start = _earliest_start(t, ready_at, placed, capacities)
+        placed.append((t, start, start + t['duration']))
+        ends[task_id] = start + t['duration']
+    return placed
+
+
+def _list_order(tasks, priority, rng=None):
+    """Precedence-feasible order that always takes the eligible task with the lowest priority key.
+
+    With rng, the choice is randomly biased towards low keys instead of always taking the lowest.
+    """
+    done, order = set(), []
+    while len(order) < len(tasks):
+        eligible = sorted((t['id'] for t in tasks if t['id'] not in done and all(d in done for d in t['after'])),
+                          key=priority)
+        chosen = eligible[min(int(rng.expovariate(1.0)), len(eligible) - 1)] if rng else eligible[0]
+        order.append(chosen)
+        done.add(chosen)
+    return order
+
+
+def _list_schedule(tasks, tails, capacities):
+    """Best serial schedule over several priority rules and seeded random passes."""
+    by_id = {t['id']: t for t in tasks}
+    position = {t['id']: i for i, t in enumerate(tasks)}
+    rules = [
+        # Longest remaining path first
+        lambda i: (-tails[i], position[i]),
+        # Recipe by recipe, in the order the steps were written
+        lambda i: position[i],
+        # Passive steps (oven, rice cooker) as early as possible so they run while the cook works
+        lambda i: (by_id[i]['hands_on'], -tails[i], position[i]),
+    ]
+    orders = [_list_order(tasks, rule) for rule in rules]
+    rng = random.Random(0)
+    orders += [_list_order(tasks, rules[0], rng) for _ in range(RANDOM_LIST_PASSES if len(tasks) > 1 else 0)]
+    schedules = [_serial_schedule(order, by_id, capacities) for order in orders]
+    return min(schedules, key=lambda placed: max((end for _, _, end in placed), default=0))
+
+
+def _branch_and_bound(tasks, order, tails, capacities, initial, lower_bound):
+    """Search activity orders for a shorter schedule than initial, within MAX_SEARCH_NODES."""
+    by_id = {t['id']: t for t in tasks}
+    topological = order
+    best = {'placed': initial, 'makespan': max((end for _, _, end in initial), default=0)}
+    nodes = 0
+
+    def search(placed, ends, remaining):
+        nonlocal nodes
+        nodes += 1
+        if not remaining:
+            makespan = max((end for _, _, end in placed), default=0)
+            if makespan < best['makespan']:
+                best['placed'], best['makespan'] = list(placed), makespan
+            return
+        # Lower bound: every remaining task still has its tail to run after its predecessors,
+        # which themselves cannot end before their own predecessors allow
+        earliest = {}
+        for task_id in topological:
+            if task_id in remaining:
+                earliest[task_id] = max((ends[d] if d in ends else earliest[d] + by_id[d]['duration']
+                                         for d in by_id[task_id]['after']), default=0)
+        bound = max(max((end for _, _, end in placed), default=0),
+                    max(earliest[r] + tails[r] for r in remaining))
+        if bound >= best['makespan'] or best['makespan'] <= lower_bound or nodes > MAX_SEARCH_NODES:
+            return
+        eligible = [r for r in remaining if all(d in ends for d in by_id[r]['after'])]
+        for task_id in sorted(eligible, key=lambda i: -tails[i]):
+            t = by_id[task_id]
+            ready_at = max((ends[d] for d in t['after']), default=0)
+            start = _earliest_start(t, ready_at, placed, capacities)
+            placed.append((t, start, start + t['duration']))
+            ends[task_id] = start + t['duration']
+            search(placed, ends, remaining - {task_id})
+            placed.pop()
+            del ends[task_id]
+
+    search([], {}, frozenset(by_id))
+    return best['placed'], nodes <= MAX_SEARCH_NODES
+
+
+def _critical_path(placed):
+    """Chain of tasks that ends at the makespan with no slack between consecutive tasks.
+
+    Each task on the chain starts when the previous one ends, either because it has to come
+    after it or because it waits for the equipment or the cook it was using.
+    """
+    if not placed:
+        return []
+    current = max(placed, key=lambda entry: entry[2])
+    path = [current]
+    while current[1] > 0:
+        t, start, _ = current
+        blockers = [entry for entry in placed if entry[2] == start and entry[0] is not t]
+        preferred = [entry for entry in blockers if entry[0]['id'] in t['after']] or \
+                    [entry for entry in blockers if entry[0]['equipment'].keys() & t['equipment'].keys()]
+        if not preferred:
+            break
+        current = preferred[0]
+        path.append(current)
+    return [entry[0]['id'] for entry in reversed(path)]
+
+
+def schedule(tasks, kitchen, cooks=1, method='auto'):
+    """Compute an equipment-constrained cooking timeline.
+
+    tasks come from task() or tasks_from_recipes(); kitchen maps Kitchen columns to the number
+    available. method is 'list' (priority list scheduling), 'branch_and_bound' or 'auto', which
+    runs branch and bound on top of list scheduling for small task sets. Results are
+    deterministic for the same input. Returns a dict with
+    the scheduled 'entries' (sorted by start), 'makespan' in minutes, the 'critical_path' task
+    ids, a 'lower_bound' from precedence and equipment load, 'missing_equipment' and whether
+    the result is known to be 'optimal'.
+    """
+    order = _check(tasks)
+    tails = _tails(tasks, order)
+    capacities, missing = _capacities(tasks, kitchen, cooks)
+    placed = _list_schedule(tasks, tails, capacities)
+    lower_bound = max(max(tails.values(), default=0), _resource_bound(tasks, capacities))
+    makespan = max((end for _, _, end in placed), default=0)
+    optimal = makespan == lower_bound
+
+    if not optimal and (method == 'branch_and_bound' or (method == 'auto' and len(tasks) <= 12)):
+        placed, complete = _branch_and_bound(tasks, order, tails, capacities, placed, lower_bound)
+        makespan = max((end for _, _, end in placed), default=0)
+        optimal = complete or makespan == lower_bound
+
+    entries = [{'id': t['id'], 'name': t['name'], 'recipe': t['recipe'], 'start': start, 'end': end,
+                'equipment': {c: n for c, n in t['equipment'].items() if c != COOK}, 'hands_on': t['hands_on']}
+               for t, start, end in sorted(placed, key=lambda entry: (entry[1], entry[2]))]
+    return {
+        'entries': entries,
+        'makespan': makespan,
+        'critical_path': _critical_path(placed),
+        'lower_bound': lower_bound,
+        'missing_equipment': missing,
+        'optimal': optimal,
+    }
+
+
+def format_minutes(minutes):
+    """Format a number of minutes as e.g. "1 h 35 min"."""
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours} h {minutes} min" if hours else f"{minutes} min"
+
+
+def total_time(recipes, kitchen, instructions=''):
+    """Total cooking time: the makespan of the local schedule of the recipes, or what the
+    cooking instructions state if no recipe steps were found."""
+    if recipes:
+        return format_minutes(schedule(tasks_from_recipes(recipes), kitchen)['makespan'])
+    match = re.search(r'\*\*Total time\*\*: (.*?)(?:\r|\n|$)', instructions or '')
+    return match.group(1).strip() if match else "Unknown"
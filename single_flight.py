@@ -0,0 +1,82 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+# Identical requests in flight at the same time, by key, e.g. llm_cache.cache_key of a chat
+# completion. The first caller makes the call; the others wait for its future and share the result.
+_in_flight = {}
+_lock = threading.Lock()
+
+# Process-wide counters, shown in the sidebar: calls made, and calls saved by joining one in flight
+stats = {'calls': 0, 'coalesced': 0}
+
+
+class LeaderInterrupted(Exception):
+    """The caller making a shared call was stopped (e.g. by a Streamlit rerun) before it finished."""
+
+
+def _join(key):
+    """Return (future, True) for the caller that has to make the call, or (future, False) to wait on it."""
+    with _lock:
+        future = _in_flight.get(key)
+        if future is not None:
+            stats['coalesced'] += 1
+            return future, False
+        future = Future()
+        _in_flight[key] = future
+        stats['calls'] += 1
+        return future, True
+
+
+def _finish(key, future, result=None, error=None):
+    with _lock:
+        del _in_flight[key]
+    if error is None:
+        future.set_result(result)
+    else:
+        future.set_exception(error)
+
+
+def run(key, call):
+    """Run call() unless an identical call is in flight, and share its result.
+
+    Returns (result, shared), where shared is True when the result came from another caller's
+    call. Its errors are raised in every waiting caller; if it was interrupted instead, the
+    waiting callers make the call themselves.
+    """
+    future, leader = _join(key)
+    if not leader:
+        try:
+            return future.result(), True
+        except LeaderInterrupted:
+            return call(), False
+    try:
+        result = call()
+    except Exception as e:
+        _finish(key, future, error=e)
+        raise
+    except BaseException:
+        _finish(key, future, error=LeaderInterrupted())
+        raise
+    _finish(key, future, result)
+    return result, False
+
+
+async def run_async(key, call):
+    """run for a coroutine function call; waiting callers await the shared future on their own loop."""
+    future, leader = _join(key)
+    if not leader:
+        try:
+            return await asyncio.wrap_future(future), True
+        except LeaderInterrupted:
+            return await call(), False
+    try:
+        result = await call()
+    except Exception as e:
+        _finish(key, future, error=e)
+        raise
+    except BaseException:
+        _finish(key, future, error=LeaderInterrupted())
+        raise
+    _finish(key, future, result)
+    return result, False
@@ -0,0 +1,184 @@
+import json
+
+from sqlalchemy import func, select
+
+from models import Kitchen, Recipe, RecipeIngredient, RecipeStep
+
+KITCHEN_EQUIPMENT = [col.name for col in Kitchen.__table__.columns if col.name not in ('id', 'user_id')]
+
+# JSON schema the model fills in for one recipe. Strict structured output requires every
+# property to be listed as required and no additional properties.
+RECIPE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'name': {'type': 'string'},
+        'cooking_method': {'type': 'string'},
+        'calories_per_day': {'type': 'integer'},
+        'ingredients': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'name': {'type': 'string'},
+                    'quantity': {'type': 'number'},
+                    'unit': {'type': 'string'},
+                },
+                'required': ['name', 'quantity', 'unit'],
+                'additionalProperties': False,
+            },
+        },
+        'steps': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'description': {'type': 'string'},
+                    'duration_minutes': {'type': 'number'},
+                    'equipment': {'type': 'array', 'items': {'type': 'string', 'enum': KITCHEN_EQUIPMENT}},
+                    'hands_on': {'type': 'boolean'},
+                },
+                'required': ['description', 'duration_minutes', 'equipment', 'hands_on'],
+                'additionalProperties': False,
+            },
+        },
+    },
+    'required': ['name', 'cooking_method', 'calories_per_day', 'ingredients', 'steps'],
+    'additionalProperties': False,
+}
+
+RECIPE_RESPONSE_FORMAT = {
+    'type': 'json_schema',
+    'json_schema': {'name': 'recipe', 'strict': True, 'schema': RECIPE_SCHEMA},
+}
+
+
+class InvalidRecipe(ValueError):
+    """A structured-output response that does not match RECIPE_SCHEMA."""
+
+
+# Python types of the JSON schema types RECIPE_SCHEMA uses. bool is an int, so it is rejected for numbers separately.
+_JSON_TYPES = {'string': str, 'integer': int, 'number': (int, float), 'boolean': bool, 'array': list,
+               'object': dict}
+
+
+def _schema_errors(value, schema, path):
+    """Where value does not have the types and required properties of schema, as "path: problem" strings."""
+    expected = schema['type']
+    if not isinstance(value, _JSON_TYPES[expected]) or (
+            isinstance(value, bool) and expected in ('integer', 'number')):
+        return [f"{path}: not of type {expected}"]
+    if expected == 'object':
+        missing = [key for key in schema['required'] if key not in value]
+        if missing:
+            return [f"{path}: missing {', '.join(missing)}"]
+        return [error for key in schema['required']
+                for error in _schema_errors(value[key], schema['properties'][key], f"{path}.{key}")]
+    if expected == 'array':
+        return [error for n, item in enumerate(value)
+                for error in _schema_errors(item, schema['items'], f"{path}[{n}]")]
+    if 'enum' in schema and value not in schema['enum']:
+        return [f"{path}: {value!r} is not one of the allowed values"]
+    return []
+
+
+def parse_recipe(text, meal, label):
+    """Parse a structured-output response into a recipe dict, raising InvalidRecipe if it is not
+    valid JSON or does not match RECIPE_SCHEMA, nested ingredients and steps included."""
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise InvalidRecipe(f"The recipe for {meal!r} was not valid JSON: {e}")
+    errors = _schema_errors(data, RECIPE_SCHEMA, 'recipe')
+    if errors:
+        raise InvalidRecipe(f"The recipe for {meal!r} is malformed ({'; '.join(errors[:3])})")
+    recipe = {'meal': meal, 'label': label, **data}
+    recipe['text'] = render_recipe(recipe)
+    return recipe
+
+
+def format_amount(quantity, unit):
+    return f"{quantity:g} {unit}".strip() if quantity is not None else (unit or '')
+
+
+def render_recipe(recipe):
+    """Render a structured recipe as the markdown block used in the plan text."""
+    equipment = sorted({column for step in recipe['steps'] for column in step['equipment']})
+    lines = [
+        f"### {recipe['label']}: {recipe['name']}",
+        f"**Cooking method**: {recipe['cooking_method']}",
+        f"**Calories**: {recipe['calories_per_day']} per day",
+        "**Ingredients**",
+        *(f"- {i['name']}: {format_amount(i['quantity'], i['unit'])}" for i in recipe['ingredients']),
+        "**Equipment**",
+        *(f"- {column.replace('_', ' ')}" for column in equipment or ['basic equipment only']),
+        "**Instructions**",
+        *(f"{n}. {step['description']} ({step['duration_minutes']:g} min)"
+          for n, step in enumerate(recipe['steps'], start=1)),
+    ]
+    return '\n'.join(lines)
+
+
+def save_recipes(session, meal_plan, recipes):
+    """Add normalized Recipe, RecipeIngredient and RecipeStep rows for a meal plan to the session."""
+    for recipe in recipes:
+        row = Recipe(
+            meal_plan=meal_plan,
+            name=f"{recipe['label']}: {recipe['name']}",
+            ingredients='\n'.join(f"{i['name']}: {format_amount(i['quantity'], i['unit'])}"
+                                  for i in recipe['ingredients']),
+            instructions='\n'.join(step['description'] for step in recipe['steps'])
+        )
+        row.ingredient_lines = [
+            RecipeIngredient(meal_plan=meal_plan, name=i['name'].strip().lower(),
+                             quantity=i['quantity'], unit=i['unit'])
+            for i in recipe['ingredients']
+        ]
+        row.steps = [
+            RecipeStep(meal_plan=meal_plan, position=n, description=step['description'],
+                       duration_minutes=step['duration_minutes'], equipment=','.join(step['equipment']),
+                       hands_on=step['hands_on'])
+            for n, step in enumerate(recipe['steps'], start=1)
+        ]
+        session.add(row)
+
+
+def recipe_steps(recipes):
+    """[(recipe name, [step dict, ...]), ...] of structured recipes, as scheduler.tasks_from_recipes takes."""
+    return [(f"{recipe['label']}: {recipe['name']}", recipe['steps']) for recipe in recipes]
+
+
+def stored_recipe_steps(session, meal_plan_id):
+    """Same as recipe_steps, read from the recipe_steps table of a saved plan."""
+    rows = session.execute(
+        select(Recipe.name, RecipeStep.description, RecipeStep.duration_minutes, RecipeStep.equipment,
+               RecipeStep.hands_on)
+        .join(RecipeStep, RecipeStep.recipe_id == Recipe.id)
+        .where(RecipeStep.meal_plan_id == meal_plan_id)
+        .order_by(Recipe.id, RecipeStep.position)
+    )
+    recipes = {}
+    for name, description, duration, equipment, hands_on in rows:
+        recipes.setdefault(name, []).append({
+            'description': description, 'duration_minutes': duration,
+            'equipment': [column for column in (equipment or '').split(',') if column], 'hands_on': hands_on,
+        })
+    return list(recipes.items())
+
+
+def stored_grocery_totals(session, meal_plan_ids):
+    """{meal plan id: [(recipe id, name, total quantity, unit), ...]} for saved plans, in one query.
+
+    Quantities are summed per recipe, ingredient and unit; the rows are grocery.aggregate items.
+    """
+    rows = session.execute(
+        select(RecipeIngredient.meal_plan_id, RecipeIngredient.recipe_id, RecipeIngredient.name,
+               func.sum(RecipeIngredient.quantity), RecipeIngredient.unit)
+        .where(RecipeIngredient.meal_plan_id.in_(meal_plan_ids))
+        .group_by(RecipeIngredient.meal_plan_id, RecipeIngredient.recipe_id, RecipeIngredient.name,
+                  RecipeIngredient.unit)
+        .order_by(RecipeIngredient.meal_plan_id, RecipeIngredient.name, RecipeIngredient.recipe_id)
+    )
+    totals = {}
+    for meal_plan_id, *row in rows:
+        totals.setdefault(meal_plan_id, []).append(tuple(row))
+    return totals
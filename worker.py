@@ -0,0 +1,68 @@
+"""Drain the generation job queue outside the Streamlit process.
+
+Run the app with FPREP_JOB_QUEUE=1 so it only enqueues jobs, and start workers against the
+same database:
+
+    python -m worker --processes 4
+"""
+import argparse
+import logging
+import multiprocessing
+import signal
+import time
+
+import jobs
+from models import init_db
+
+logger = logging.getLogger('worker')
+
+
+def run_worker(poll_seconds):
+    """Claim and run jobs one at a time until SIGTERM or SIGINT."""
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    signal.signal(signal.SIGINT, lambda *_: stopping.append(True))
+    worker = jobs.worker_name()
+    logger.info("Worker %s started", worker)
+    while not stopping:
+        jobs.dead_letter_expired()
+        job_id = jobs.claim(worker)
+        if job_id is None:
+            time.sleep(poll_seconds)
+            continue
+        started = time.perf_counter()
+        jobs.execute(job_id, worker)
+        logger.info("Job %s finished in %.1f s", job_id, time.perf_counter() - started)
+    logger.info("Worker %s stopped", worker)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=1, help="number of worker processes")
+    parser.add_argument('--poll', type=float, default=jobs.POLL_SECONDS,
+                        help="seconds to wait when the queue is empty")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(message)s')
+
+    init_db()
+    if args.processes == 1:
+        run_worker(args.poll)
+        return
+    # Spawned, not forked, so no process inherits another's database connections
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(args.poll,), name=f"worker-{i}")
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    main()